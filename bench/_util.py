@@ -0,0 +1,107 @@
+"""What the benchmarks share: a theme, stand-in backends full of profiles,
+and a timer that counts backend calls."""
+
+from __future__ import absolute_import, division, with_statement
+
+import os
+import os.path
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), os.pardir))
+from termitheme_lib import core
+
+
+def make_theme (name=u'Benchmark Theme'):
+    """Return a profile with a full palette and foreground/background."""
+
+    profile = core.TerminalProfile(name)
+    for i in range(16):
+        profile['color%d' % i] = [i * 4096, 65535 - i * 4096, 32768]
+    profile['fgcolor'] = [65535, 65535, 65535]
+    profile['bgcolor'] = [0, 0, 0]
+    return profile
+
+def write_theme (dirname, profile, basename='theme.zip'):
+    """Write profile to a theme file in dirname; return its filename."""
+
+    filename = os.path.join(dirname, basename)
+    core.ThemeFile(filename).write(profile)
+    return filename
+
+def timed (backend, fn):
+    """Run fn; return (seconds taken, calls it made to backend)."""
+
+    backend.calls = 0
+    t0 = time.time()
+    fn()
+    return (time.time() - t0, backend.calls)
+
+def populate_gconf (client, count):
+    """Fill an InMemoryGConf with count gnome-terminal profiles.
+
+    Returns their names; the first is the default."""
+
+    IO = core.GnomeTerminalIO
+    dirs = ['Profile%d' % i for i in range(count)]
+    for i, d in enumerate(dirs):
+        path = IO.PROFILE_ROOT + '/' + d + '/'
+        palette = ':'.join([core.color.to48([(i * 97 + j * 4099) % 65536] * 3)
+                            for j in range(16)])
+        values = [('visible_name', u'Profile number %d' % i),
+                  ('palette', palette),
+                  ('background_color', u'#000000000000'),
+                  ('foreground_color', u'#aaaaaaaaaaaa'),
+                  ('bold_color', u'#ffffffffffff'),
+                  ('bold_color_same_as_fg', True),
+                  ('allow_bold', True),
+                  ('cursor_shape', u'block'),
+                  ('font', u'Monospace 10'),
+                  ('use_system_font', True),
+                  ('use_theme_colors', True),
+                  ('scrollback_lines', 512),
+                  ('scroll_on_output', False),
+                  ('word_chars', u'-A-Za-z0-9,./?%&#:_'),
+                  ('login_shell', False),
+                  ('title', u'Terminal')]
+        for k, v in values:
+            client.set(path + k, core.gconf_box(v))
+    client.set_list(IO.PROFILE_LIST, None, dirs)
+    client.set_string(IO.DEFAULT_NAME, dirs[0])
+    return [u'Profile number %d' % i for i in range(count)]
+
+# settings of a saved PuTTY session that themes don't touch; PuTTY has ~150
+PUTTY_PRIVATE_VALUES = 120
+
+def populate_winreg (winreg, count):
+    """Fill an InMemoryWinreg with count PuTTY sessions; return their names."""
+
+    names = [u'Session number %d' % i for i in range(count)]
+    io = core.PuttyWinIO(winreg)
+    for i, name in enumerate(names):
+        values = [('HostName', u'host%d.example.com' % i, winreg.REG_SZ),
+                  ('PortNumber', 22, winreg.REG_DWORD),
+                  ('Font', u'Courier New', winreg.REG_SZ)]
+        values.extend([('Setting%d' % j, j, winreg.REG_DWORD)
+                       for j in range(PUTTY_PRIVATE_VALUES)])
+        for j in range(22):
+            c = (i + j) % 256
+            values.append(('Colour%d' % j, u'%d,%d,%d' % (c, c, c),
+                           winreg.REG_SZ))
+        io.registry.set_values(io._session_key(name), values)
+    return names
+
+def populate_putty_dir (dirname, names):
+    """Save a PuTTY-on-Unix session for each of names under dirname, which
+    can then be used as PUTTYDIR."""
+
+    io = core.PuttyFileIO(dirname)
+    for name in names:
+        io.write_profile(make_theme(name))
+
+def newest_section (profile):
+    """Return profile's theme.ini text for the newest version only."""
+
+    tf = core.ThemeFile(None)
+    tf.min_version = core._versions[0][0].replace('_', '.')
+    return tf._format(profile)
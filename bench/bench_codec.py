@@ -0,0 +1,393 @@
+#!/usr/bin/env python
+"""Benchmark suite for the theme codec and archive paths, with baselines.
+
+Run from the source tree:
+    python bench/bench_codec.py [-n NUMBER] [-k PATTERN]
+    python bench/bench_codec.py --save baseline.json
+    python bench/bench_codec.py --compare baseline.json [-t PERCENT]
+
+Every case works on synthetic themes shaped like the ones in the gallery:
+all profile keys set, colors drawn from a small popular set, a non-ASCII
+name, and a few lines of credits.  The cases take turns for REPEAT rounds,
+so that a burst of load on the machine slows all of them a little rather
+than one of them a lot.  Times are the median round, in microseconds per
+operation, and the spread is the interquartile range of the rounds.
+
+--save records the results to a JSON baseline.  --compare runs the suite
+again and exits with status 1 if any case is more than PERCENT slower
+than its baseline, and by more than NOISE_FACTOR times the uncertainty of
+the two medians, which is estimated from their spreads; on a busy machine,
+more rounds bring that down.  A baseline also records a fixed pure-Python
+workload; one taken on another machine is scaled by it, so that it is
+still usable as a rough guide.
+"""
+
+from __future__ import absolute_import, division, with_statement
+
+import codecs
+import fnmatch
+import json
+import math
+import optparse
+import os
+import os.path
+import platform
+import random
+import shutil
+import sys
+import tempfile
+import timeit
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), os.pardir))
+from termitheme_lib import core, formats
+
+from _util import newest_section
+
+BASELINE_VERSION = 2
+THEME_COUNT = 20 # distinct synthetic themes per case
+CALIBRATION_RUNS = 21
+# a change within this many standard errors of the medians is noise
+NOISE_FACTOR = 3
+
+
+#{{{ Synthetic themes
+
+def make_profile (rnd, i):
+    popular = [[rnd.randint(0, 255) * 257 for c in range(3)]
+               for j in range(32)]
+    profile = core.TerminalProfile(u"Th\u00e8me %d" % i)
+    for k in core.TerminalProfile.PROFILE_KEY_NAMES:
+        if k == 'cursor_shape':
+            profile[k] = rnd.choice([u'block', u'ibeam', u'underline'])
+        elif k == 'font':
+            profile[k] = u'Monospace %d' % rnd.randint(8, 14)
+        elif k in ('force_font', 'allow_bold', 'use_fgbold'):
+            profile[k] = rnd.choice([True, False])
+        else:
+            profile[k] = rnd.choice(popular)
+    return profile
+
+def make_credits (rnd, i):
+    lines = [u"Theme %d by Someone N\u00f6body" % i,
+             u"License: CC-BY-SA 3.0"]
+    lines.extend(u"Note %d: %s" % (j, u"x" * rnd.randint(20, 70))
+                 for j in range(rnd.randint(1, 5)))
+    return u"\n".join(lines) + u"\n"
+
+
+class Fixture (object):
+    """Synthetic themes, in every form the cases need, in a temp dir."""
+
+    def __init__ (self, seed=1):
+        rnd = random.Random(seed)
+        self.dir = tempfile.mkdtemp(prefix='termitheme-bench-')
+        self.profiles = [make_profile(rnd, i) for i in range(THEME_COUNT)]
+        self.zips = []
+        self.inis = []
+        for i, profile in enumerate(self.profiles):
+            credits = os.path.join(self.dir, 'credits%d.txt' % i)
+            with codecs.open(credits, 'w', core.CHARSET) as f:
+                f.write(make_credits(rnd, i))
+            tf = core.ThemeFile(os.path.join(self.dir, 'theme%d.zip' % i))
+            tf.set_credits(credits)
+            tf.write(profile)
+            self.zips.append(tf.filename)
+
+            ini = os.path.join(self.dir, 'theme%d.ini' % i)
+            with open(ini, 'w') as f:
+                f.write(newest_section(profile).encode('utf-8'))
+            self.inis.append(ini)
+
+        self.credits = os.path.join(self.dir, 'credits0.txt')
+        self.colors = [c for p in self.profiles for c in p.values()
+                       if core.color.is_color(c)]
+        # (spec, key, value, marshalled value) for every key of every theme
+        self.marshalled = []
+        for ver, spec in core._versions:
+            for p in self.profiles:
+                for k, v in sorted(p.items()):
+                    if spec.has_key(k):
+                        self.marshalled.append((spec, k, v,
+                                                spec.marshal_value(k, v)))
+
+    def cleanup (self):
+        shutil.rmtree(self.dir)
+
+#}}}
+
+
+#{{{ Cases
+# Each case returns (ops, fn): calling fn() performs ops operations.
+
+def case_color_parse (fx):
+    color = core.color
+    s24 = [color.to24(c) for c in fx.colors]
+    s48 = [color.to48(c) for c in fx.colors]
+    s24dec = [color.to24dec(c) for c in fx.colors]
+    def run ():
+        map(color.parse24, s24)
+        map(color.parse48, s48)
+        map(color.parse24dec, s24dec)
+    return (3 * len(fx.colors), run)
+
+def case_color_format (fx):
+    color = core.color
+    colors = fx.colors
+    def run ():
+        map(color.to24, colors)
+        map(color.to48, colors)
+        map(color.to24dec, colors)
+    return (3 * len(colors), run)
+
+def case_parse_value (fx):
+    items = [(spec, k, s) for spec, k, v, s in fx.marshalled]
+    def run ():
+        for spec, k, s in items:
+            spec.parse_value(k, s)
+    return (len(items), run)
+
+def case_marshal_value (fx):
+    items = [(spec, k, v) for spec, k, v, s in fx.marshalled]
+    def run ():
+        for spec, k, v in items:
+            spec.marshal_value(k, v)
+    return (len(items), run)
+
+def case_format (fx):
+    tf = core.ThemeFile(None)
+    def run ():
+        for p in fx.profiles:
+            tf._format(p)
+    return (len(fx.profiles), run)
+
+def case_write (fx):
+    outdir = os.path.join(fx.dir, 'out')
+    os.mkdir(outdir)
+    files = []
+    for i, p in enumerate(fx.profiles):
+        tf = core.ThemeFile(os.path.join(outdir, 'theme%d.zip' % i))
+        tf.set_credits(fx.credits)
+        files.append((tf, p))
+    def run ():
+        for tf, p in files:
+            tf.write(p, force=True)
+    return (len(files), run)
+
+def case_read (fx):
+    def run ():
+        for filename in fx.zips:
+            core.ThemeFile(filename).read()
+    return (len(fx.zips), run)
+
+def case_read_bytes (fx):
+    blobs = []
+    for filename in fx.zips:
+        with open(filename, 'rb') as f:
+            blobs.append(f.read())
+    def run ():
+        for data in blobs:
+            core.ThemeFile.from_bytes(data).read()
+    return (len(blobs), run)
+
+def case_to_bytes (fx):
+    tf = core.ThemeFile(None)
+    tf.set_credits(fx.credits)
+    def run ():
+        for p in fx.profiles:
+            tf.to_bytes(p)
+    return (len(fx.profiles), run)
+
+def case_read_credits (fx):
+    def run ():
+        for filename in fx.zips:
+            tf = core.ThemeFile(filename)
+            with tf:
+                tf.read()
+                tf.get_credits()
+    return (len(fx.zips), run)
+
+def case_read_ini (fx):
+    def run ():
+        for filename in fx.inis:
+            core.ThemeFile(None).read_ini(filename)
+    return (len(fx.inis), run)
+
+def case_render_formats (fx):
+    fmts = [formats.get(name) for name in sorted(formats.FORMATS)]
+    def run ():
+        for p in fx.profiles:
+            for fmt in fmts:
+                fmt.render(p)
+    return (len(fx.profiles) * len(fmts), run)
+
+CASES = [
+    ('color.parse', case_color_parse),
+    ('color.format', case_color_format),
+    ('version.parse_value', case_parse_value),
+    ('version.marshal_value', case_marshal_value),
+    ('ThemeFile._format', case_format),
+    ('ThemeFile.write', case_write),
+    ('ThemeFile.to_bytes', case_to_bytes),
+    ('ThemeFile.read', case_read),
+    ('ThemeFile.from_bytes+read', case_read_bytes),
+    ('ThemeFile.read+credits', case_read_credits),
+    ('ThemeFile.read_ini', case_read_ini),
+    ('formats.render', case_render_formats),
+]
+
+#}}}
+
+
+def _median (values):
+    values = sorted(values)
+    return values[len(values) // 2]
+
+def machine_id ():
+    """Identify this machine and interpreter, to recognize our baselines."""
+
+    return ' '.join([platform.node(), platform.machine(),
+                     platform.python_implementation(),
+                     platform.python_version()])
+
+def calibrate ():
+    """Time a fixed pure-Python workload, for scaling across machines."""
+
+    def work ():
+        d = {}
+        for i in xrange(20000):
+            d[str(i)] = i * 2
+        return sorted(d.items())
+    return _median(timeit.repeat(work, number=1, repeat=CALIBRATION_RUNS))
+
+def run_cases (pattern, number, repeat):
+    """Return {case name: (median time, spread)}; see the module docs."""
+
+    fx = Fixture()
+    try:
+        cases = [(name, setup(fx)) for name, setup in CASES
+                 if not pattern or fnmatch.fnmatch(name, pattern)]
+        samples = dict([(name, []) for name, case in cases])
+        for i in range(repeat):
+            for name, (ops, fn) in cases:
+                t = timeit.timeit(fn, number=number)
+                samples[name].append(t * 1e6 / (ops * number))
+    finally:
+        fx.cleanup()
+
+    results = {}
+    for name, times in samples.items():
+        times.sort()
+        n = len(times)
+        median = times[n // 2]
+        results[name] = (median, (times[3 * n // 4] - times[n // 4]) / median)
+    return results
+
+def load_baseline (filename):
+    with open(filename, 'rb') as f:
+        data = json.load(f)
+    if data.get('version') != BASELINE_VERSION:
+        raise ValueError("%s: unsupported baseline version" % filename)
+    return data
+
+def _median_error (spread, rounds):
+    # the standard error of a median is about 0.93 IQR / sqrt(n)
+    return 0.93 * spread / math.sqrt(rounds)
+
+def compare (baseline, calibration, results, repeat, threshold):
+    """Print a comparison table; return the names of regressed cases."""
+
+    if baseline.get('machine') == machine_id():
+        scale = 1.0
+    else:
+        scale = calibration / baseline['calibration']
+    print "%-28s %12s %12s %9s %9s" % ("case", "base (us)", "now (us)",
+                                       "change", "limit")
+    regressed = []
+    for name, _ in CASES:
+        if name not in results:
+            continue
+        now, spread = results[name]
+        if name not in baseline['results']:
+            print "%-28s %12s %12.2f %9s" % (name, "-", now, "new")
+            continue
+        base = baseline['results'][name] * scale
+        change = (now / base - 1) * 100
+        error = math.hypot(_median_error(spread, repeat),
+                           _median_error(baseline['spread'][name],
+                                         baseline['repeat']))
+        noise = NOISE_FACTOR * error * 100
+        limit = max(threshold, noise)
+        flag = ''
+        if change > limit:
+            regressed.append(name)
+            flag = '  REGRESSED'
+        print "%-28s %12.2f %12.2f %+8.1f%% %8.1f%%%s" % (
+            name, base, now, change, limit, flag)
+    if scale != 1.0:
+        print "(baseline from another machine, scaled by %.2f)" % scale
+    return regressed
+
+def main (argv=None):
+    p = optparse.OptionParser(usage="%prog [options]")
+    ao = p.add_option
+    ao("-n", "--number", dest="number", type="int", default=20,
+       help="Run each case NUMBER times per repeat (default %default)")
+    ao("-r", "--repeat", dest="repeat", type="int", default=15,
+       help="Time each case in REPEAT rounds (default %default)")
+    ao("-k", "--cases", dest="pattern", metavar="PATTERN",
+       help="Only run cases whose name matches the glob PATTERN")
+    ao("-s", "--save", dest="save", metavar="FILE",
+       help="Record the results to FILE as a baseline")
+    ao("-c", "--compare", dest="compare", metavar="FILE",
+       help="Compare the results to the baseline in FILE")
+    ao("-t", "--threshold", dest="threshold", type="float", default=20.0,
+       metavar="PERCENT",
+       help="With --compare, fail if a case is more than PERCENT slower "
+            "(default %default)")
+    opts, args = p.parse_args(argv)
+
+    baseline = None
+    if opts.compare:
+        try:
+            baseline = load_baseline(opts.compare)
+        except (IOError, ValueError), e:
+            print >>sys.stderr, "Cannot read baseline: %s" % e
+            return 2
+
+    calibration = calibrate()
+    results = run_cases(opts.pattern, opts.number, opts.repeat)
+
+    rv = 0
+    if baseline:
+        regressed = compare(baseline, calibration, results, opts.repeat,
+                            opts.threshold)
+        if regressed:
+            print "%d case(s) regressed by more than %g%%: %s" % (
+                len(regressed), opts.threshold, ', '.join(regressed))
+            rv = 1
+    else:
+        print "%-28s %12s %9s" % ("case", "time (us)", "spread")
+        for name, _ in CASES:
+            if name in results:
+                print "%-28s %12.2f %8.1f%%" % (name, results[name][0],
+                                                results[name][1] * 100)
+
+    if opts.save:
+        data = {'version': BASELINE_VERSION,
+                'python': platform.python_version(),
+                'numpy': core.load_numpy() is not None,
+                'machine': machine_id(),
+                'repeat': opts.repeat,
+                'calibration': calibration,
+                'results': dict([(name, median) for name, (median, spread)
+                                 in results.items()]),
+                'spread': dict([(name, spread) for name, (median, spread)
+                                in results.items()])}
+        with open(opts.save, 'wb') as f:
+            json.dump(data, f, indent=1, sort_keys=True)
+            f.write('\n')
+        print "Saved baseline to %s" % opts.save
+    return rv
+
+if __name__ == '__main__':
+    sys.exit(main())
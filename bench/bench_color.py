@@ -0,0 +1,107 @@
+#!/usr/bin/env python
+"""Microbenchmark: table-driven color parsing vs. the regex-only path.
+
+Run from the source tree:  python bench/bench_color.py [-n NUMBER]
+"""
+
+from __future__ import absolute_import, division, with_statement
+
+import optparse
+import os.path
+import random
+import sys
+import timeit
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), os.pardir))
+from termitheme_lib import core
+
+color = core.color
+REPEAT = 15
+
+
+#{{{ Regex-only reference versions of the _ColorParser methods
+
+def re_parse24 (v):
+    m = color._color_re['24'].match(v)
+    if m is None:
+        raise ValueError("Invalid 24-bit hex color '%s'" % v)
+    return [color._double(int(h, 16)) for h in m.groups()]
+
+def re_parse48 (v):
+    m = color._color_re['48'].match(v)
+    if m is None:
+        raise ValueError("Invalid 48-bit hex color '%s'" % v)
+    return [int(h, 16) for h in m.groups()]
+
+def re_parse24dec (v):
+    m = color._color_re['24dec'].match(v)
+    if m is None:
+        raise ValueError("Invalid 24-bit decimal color '%s'" % v)
+    return [color._double(int(d, 10)) for d in m.groups()]
+
+def re_read_entry (v):
+    # GnomeTerminalIO.read_profile before as48: is48, then parse48
+    if isinstance(v, basestring) and color._color_re['48'].match(v):
+        return re_parse48(v)
+    return v
+
+def read_entry (v):
+    # GnomeTerminalIO._build_profile
+    c48 = (color.as48(v) if isinstance(v, basestring) and
+           12 <= len(v) <= 14 else None)
+    return v if c48 is None else c48
+
+#}}}
+
+
+def make_data (count=1000, seed=1):
+    rnd = random.Random(seed)
+    chan = lambda: [rnd.randint(0, 255) * 257 for i in range(3)]
+    colors = [chan() for i in range(count)]
+    # what read_profile sees from gconf: a few colors among other values
+    entries = [u'block', True, 512, u'Monospace 10', u'#000000000000',
+               u'system', False, u'#ffffffffffff', u'-_./?%&#:', 0.5]
+    return {
+        '24': [color.to24(c) for c in colors],
+        '48': [color.to48(c) for c in colors],
+        '24dec': [color.to24dec(c) for c in colors],
+        'entries': entries * (count // len(entries)),
+    }
+
+def run_all (number):
+    data = make_data()
+    palette = ':'.join(data['48'][:16])
+    cases = [
+        ('parse24', lambda: map(re_parse24, data['24']),
+                    lambda: map(color.parse24, data['24'])),
+        ('parse48', lambda: map(re_parse48, data['48']),
+                    lambda: map(color.parse48, data['48'])),
+        ('parse24dec', lambda: map(re_parse24dec, data['24dec']),
+                       lambda: map(color.parse24dec, data['24dec'])),
+        ('gconf entries', lambda: map(re_read_entry, data['entries']),
+                          lambda: map(read_entry, data['entries'])),
+        ('16-color palette', lambda: map(re_parse48, palette.split(':')),
+                             lambda: color.parse_palette(palette, '48')),
+    ]
+
+    print "%-22s %12s %12s %8s" % ("case", "regex (s)", "fast (s)",
+                                   "speedup")
+    for name, old, new in cases:
+        # alternate the two, so that load on the machine hits both alike
+        t_old = t_new = float('inf')
+        for i in range(REPEAT):
+            t_old = min(t_old, timeit.timeit(old, number=number))
+            t_new = min(t_new, timeit.timeit(new, number=number))
+        print "%-22s %12.4f %12.4f %7.2fx" % (name, t_old, t_new,
+                                              t_old / t_new)
+
+def main (argv=None):
+    p = optparse.OptionParser(usage="%prog [-n NUMBER]")
+    p.add_option("-n", "--number", dest="number", type="int", default=50,
+                 help="Run each case NUMBER times per repeat")
+    opts, args = p.parse_args(argv)
+    run_all(opts.number)
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,84 @@
+#!/usr/bin/env python
+"""Benchmark GnomeTerminalIO against an in-memory gconf with many profiles.
+
+Run from the source tree:
+    python bench/bench_gconf.py [-s 10,1000,10000] [-l LATENCY_MS]
+
+For each profile count, this times GnomeTerminalIO.__init__, read_profile
+(of the default and of a profile halfway down the list), write_profile
+(of an existing profile) and a whole import round-trip, and reports the
+number of gconf calls each one made.  With -l, every gconf call sleeps
+for LATENCY_MS milliseconds, to model the round-trip to gconfd.
+"""
+
+from __future__ import absolute_import, division, with_statement
+
+import optparse
+import os
+import os.path
+import shutil
+import sys
+import tempfile
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), os.pardir))
+from termitheme_lib import core
+
+from _util import make_theme, populate_gconf, timed, write_theme
+
+IO = core.GnomeTerminalIO
+
+
+def run_size (count, latency, theme):
+    client = core.InMemoryGConf()
+    names = populate_gconf(client, count)
+    client.latency = latency
+    middle = names[len(names) // 2]
+
+    def import_theme ():
+        io = IO(client)
+        src = core.ThemeFile(theme).read()
+        dst = io.read_profile()
+        name = u'Imported %d' % client.commits
+        if io.profile_exists(name):
+            raise ValueError("Profile exists: %s" % name)
+        dst.update(src)
+        dst.name = name
+        io.write_profile(dst)
+
+    def write_existing ():
+        io = IO(client)
+        io.write_profile(profile)
+
+    profile = IO(client).read_profile(middle)
+    cases = [
+        ('__init__', lambda: IO(client)),
+        ('read_profile()', lambda: IO(client).read_profile()),
+        ('read_profile(middle)', lambda: IO(client).read_profile(middle)),
+        ('write_profile(middle)', write_existing),
+        ('import round-trip', import_theme),
+    ]
+    for name, fn in cases:
+        elapsed, calls = timed(client, fn)
+        print "%8d  %-22s %10.2f %8d" % (count, name, elapsed * 1000, calls)
+
+def main (argv=None):
+    p = optparse.OptionParser(usage="%prog [-s SIZES] [-l LATENCY_MS]")
+    p.add_option("-s", "--sizes", dest="sizes", default="10,1000,10000",
+                 help="Comma-separated profile counts (default %default)")
+    p.add_option("-l", "--latency", dest="latency", type="float", default=0,
+                 help="Milliseconds to sleep on each gconf call")
+    opts, args = p.parse_args(argv)
+
+    tmpdir = tempfile.mkdtemp(prefix='termitheme-bench-')
+    try:
+        theme = write_theme(tmpdir, make_theme())
+        print "%8s  %-22s %10s %8s" % ("profiles", "operation", "time (ms)",
+                                       "calls")
+        for size in [int(s) for s in opts.sizes.split(',')]:
+            run_size(size, opts.latency / 1000, theme)
+    finally:
+        shutil.rmtree(tmpdir)
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main())
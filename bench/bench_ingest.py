@@ -0,0 +1,82 @@
+#!/usr/bin/env python
+"""Throughput of bulk theme import through the ingestion pipeline.
+
+Run from the source tree:
+    python bench/bench_ingest.py [-n THEMES] [-j 1,4] [-l LATENCY_MS]
+
+Writes THEMES theme files to a temp dir, then imports all of them into an
+in-memory gconf, the way `termitheme import` does: archives are read by
+pipeline.Ingest on up to JOBS threads, and each profile is saved by the
+single writer.  With -l, every gconf call sleeps for LATENCY_MS
+milliseconds, to model a slow backend; reading then overlaps with writing.
+"""
+
+from __future__ import absolute_import, division, with_statement
+
+import optparse
+import os
+import os.path
+import shutil
+import sys
+import tempfile
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), os.pardir))
+from termitheme_lib import core, pipeline
+from termitheme_lib.commands import _read_theme
+
+from _util import populate_gconf
+
+
+def make_themes (dirname, count):
+    filenames = []
+    for i in range(count):
+        profile = core.TerminalProfile(u'Ingested %d' % i)
+        for j in range(16):
+            profile['color%d' % j] = [(i * 257 + j * 4099) % 65536] * 3
+        profile['fgcolor'] = [65535, 65535, 65535]
+        profile['bgcolor'] = [0, 0, 0]
+        filename = os.path.join(dirname, 'theme%d.zip' % i)
+        core.ThemeFile(filename).write(profile)
+        filenames.append(filename)
+    return filenames
+
+def run (filenames, jobs, latency):
+    client = core.InMemoryGConf()
+    populate_gconf(client, 10)
+    client.latency = latency
+    io = core.GnomeTerminalIO(client)
+    base = io.read_profile()
+
+    themes = pipeline.Ingest(_read_theme, jobs).start(filenames)
+    for filename, themefile, src in themes:
+        dst = base.copy()
+        dst.update(src)
+        dst.name = src.name
+        io.write_profile(dst)
+    return themes.stats
+
+def main (argv=None):
+    p = optparse.OptionParser(usage="%prog [-n THEMES] [-j JOBS] "
+                              "[-l LATENCY_MS]")
+    p.add_option("-n", "--themes", dest="themes", type="int", default=200,
+                 help="Import THEMES theme files (default %default)")
+    p.add_option("-j", "--jobs", dest="jobs", default="1,4",
+                 help="Comma-separated reader thread counts (default "
+                      "%default)")
+    p.add_option("-l", "--latency", dest="latency", type="float", default=0,
+                 help="Milliseconds to sleep on each gconf call")
+    opts, args = p.parse_args(argv)
+
+    tmpdir = tempfile.mkdtemp(prefix='termitheme-bench-')
+    try:
+        filenames = make_themes(tmpdir, opts.themes)
+        for jobs in [int(j) for j in opts.jobs.split(',')]:
+            print "jobs=%d:" % jobs
+            stats = run(filenames, jobs, opts.latency / 1000)
+            print "  " + stats.report().replace("\n", "\n  ")
+    finally:
+        shutil.rmtree(tmpdir)
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main())
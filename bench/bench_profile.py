@@ -0,0 +1,99 @@
+#!/usr/bin/env python
+"""Memory and time to load many profiles: TerminalProfile vs. the compact
+CompactTerminalProfile.
+
+Run from the source tree:  python bench/bench_profile.py [-n COUNT]
+
+Memory is the deep sys.getsizeof of all loaded profiles, counting each
+shared object (such as an interned color) once.
+"""
+
+from __future__ import absolute_import, division, with_statement
+
+import ConfigParser
+import optparse
+import os.path
+import random
+import StringIO
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), os.pardir))
+from termitheme_lib import core
+
+from _util import newest_section
+
+
+def make_theme_ini (rnd, i):
+    # Gallery themes draw on a fairly small set of popular colors.
+    popular = [[rnd.randint(0, 255) * 257 for c in range(3)]
+               for j in range(64)]
+    profile = core.TerminalProfile(u"Theme %d" % i)
+    for k in core.TerminalProfile.PROFILE_KEY_NAMES:
+        if k in ('cursor_shape', 'font'):
+            profile[k] = rnd.choice([u'block', u'Monospace 10'])
+        elif k in ('force_font', 'allow_bold', 'use_fgbold'):
+            profile[k] = rnd.choice([True, False])
+        else:
+            profile[k] = rnd.choice(popular)
+    return newest_section(profile)
+
+def make_parsers (count, seed=1):
+    rnd = random.Random(seed)
+    parsers = []
+    for i in range(count):
+        cp = ConfigParser.RawConfigParser()
+        cp.readfp(StringIO.StringIO(make_theme_ini(rnd, i)))
+        parsers.append(cp)
+    return parsers
+
+def deep_sizeof (obj, seen):
+    if id(obj) in seen:
+        return 0
+    seen.add(id(obj))
+    size = sys.getsizeof(obj)
+    if isinstance(obj, dict):
+        for k, v in obj.iteritems():
+            size += deep_sizeof(k, seen) + deep_sizeof(v, seen)
+    elif isinstance(obj, (list, tuple, set)):
+        for v in obj:
+            size += deep_sizeof(v, seen)
+    for attr in getattr(type(obj), '__slots__', ()):
+        if hasattr(obj, attr):
+            size += deep_sizeof(getattr(obj, attr), seen)
+    if hasattr(obj, '__dict__'):
+        size += deep_sizeof(obj.__dict__, seen)
+    return size
+
+def load (profile_class, parsers, count):
+    tf = core.ThemeFile(None, profile_class)
+    return [tf.read_profile(parsers[i % len(parsers)]) for i in xrange(count)]
+
+def main (argv=None):
+    p = optparse.OptionParser(usage="%prog [-n COUNT]")
+    p.add_option("-n", "--count", dest="count", type="int", default=10000,
+                 help="Load COUNT profiles (default 10000)")
+    opts, args = p.parse_args(argv)
+
+    # Many different theme files, so names and strings are not all shared
+    parsers = make_parsers(min(opts.count, 1000))
+    # Keep constants and class data out of the per-profile accounting
+    baseline = set([id(None), id(True), id(False)])
+    baseline.update(id(k) for k in core.TerminalProfile.PROFILE_KEY_NAMES)
+    baseline.add(id(core._missing))
+
+    print "%-24s %10s %14s %10s" % ("class", "load (s)", "memory (KiB)",
+                                    "per profile")
+    for cls in (core.TerminalProfile, core.CompactTerminalProfile):
+        t0 = time.time()
+        profiles = load(cls, parsers, opts.count)
+        elapsed = time.time() - t0
+        size = deep_sizeof(profiles, set(baseline))
+        print "%-24s %10.3f %14.1f %10d" % (cls.__name__, elapsed,
+                                            size / 1024.0,
+                                            size // opts.count)
+        del profiles
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main())
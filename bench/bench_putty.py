@@ -0,0 +1,74 @@
+#!/usr/bin/env python
+"""Benchmark PuttyWinIO against an in-memory registry with many sessions.
+
+Run from the source tree:
+    python bench/bench_putty.py [-s 10,1000,5000] [-l LATENCY_MS]
+
+For each session count, this times profile_names, read_profile and
+write_profile (of a session halfway down the list), a whole import
+round-trip, applying a theme to every session and dumping them all, and
+reports the number of registry calls each one made.  With -l, every
+registry call sleeps for LATENCY_MS milliseconds.
+"""
+
+from __future__ import absolute_import, division, with_statement
+
+import optparse
+import os
+import os.path
+import sys
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), os.pardir))
+from termitheme_lib import core
+
+from _util import make_theme, populate_winreg, timed
+
+IO = core.PuttyWinIO
+
+
+def run_size (count, latency, theme):
+    winreg = core.InMemoryWinreg()
+    names = populate_winreg(winreg, count)
+    winreg.latency = latency
+    middle = names[len(names) // 2]
+
+    def import_theme ():
+        io = IO(winreg)
+        dst = io.read_profile(names[0])
+        name = u'Imported %d' % len(io.profile_names())
+        if io.profile_exists(name):
+            raise ValueError("Profile exists: %s" % name)
+        dst.update(theme)
+        dst.name = name
+        io.write_profile(dst)
+
+    profile = IO(winreg).read_profile(middle)
+    cases = [
+        ('profile_names()', lambda: IO(winreg).profile_names()),
+        ('read_profile(middle)', lambda: IO(winreg).read_profile(middle)),
+        ('write_profile(middle)', lambda: IO(winreg).write_profile(profile)),
+        ('import round-trip', import_theme),
+        ("apply_theme('*')", lambda: IO(winreg).apply_theme(theme, u'*')),
+        ('dump()', lambda: list(IO(winreg).dump())),
+    ]
+    for name, fn in cases:
+        elapsed, calls = timed(winreg, fn)
+        print "%8d  %-22s %10.2f %8d" % (count, name, elapsed * 1000, calls)
+
+def main (argv=None):
+    p = optparse.OptionParser(usage="%prog [-s SIZES] [-l LATENCY_MS]")
+    p.add_option("-s", "--sizes", dest="sizes", default="10,1000,5000",
+                 help="Comma-separated session counts (default %default)")
+    p.add_option("-l", "--latency", dest="latency", type="float", default=0,
+                 help="Milliseconds to sleep on each registry call")
+    opts, args = p.parse_args(argv)
+
+    theme = make_theme()
+    print "%8s  %-22s %10s %8s" % ("sessions", "operation", "time (ms)",
+                                   "calls")
+    for size in [int(s) for s in opts.sizes.split(',')]:
+        run_size(size, opts.latency / 1000, theme)
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,87 @@
+#!/usr/bin/env python
+"""Cold-start time of the termitheme command line.
+
+Run from the source tree:  python bench/bench_startup.py [-n NUMBER]
+
+Each case runs ./termitheme in a fresh interpreter NUMBER times and
+reports the fastest and median wall-clock times.  The "python" case is the
+bare interpreter, for comparison.  export reads a session of PuTTY on
+Unix, from a PUTTYDIR in a temp dir, so it needs no terminal installed;
+on Windows, where there is no such thing, it reads PuTTY's Default
+Settings from the registry instead, and is reported as unavailable if
+that fails.
+"""
+
+from __future__ import absolute_import, division, with_statement
+
+import optparse
+import os
+import os.path
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+from _util import make_theme, populate_putty_dir, write_theme
+
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir)
+SCRIPT = os.path.join(ROOT, 'termitheme')
+
+
+def run_once (argv, cwd, env=None):
+    devnull = open(os.devnull, 'w')
+    try:
+        t0 = time.time()
+        rc = subprocess.call(argv, cwd=cwd, env=env, stdout=devnull,
+                             stderr=devnull)
+        return (time.time() - t0, rc)
+    finally:
+        devnull.close()
+
+def main (argv=None):
+    p = optparse.OptionParser(usage="%prog [-n NUMBER]")
+    p.add_option("-n", "--number", dest="number", type="int", default=10,
+                 help="Run each case NUMBER times (default %default)")
+    opts, args = p.parse_args(argv)
+
+    tmpdir = tempfile.mkdtemp(prefix='termitheme-bench-')
+    try:
+        theme = write_theme(tmpdir, make_theme(u'Startup'), 'Startup.zip')
+        out = os.path.join(tmpdir, 'out.zip')
+        puttydir = os.path.join(tmpdir, 'putty')
+        if os.name != 'nt':
+            populate_putty_dir(puttydir, [u'Default Settings'])
+        env = dict(os.environ, PUTTYDIR=puttydir)
+        py = sys.executable
+        cases = [
+            ('python', [py, '-c', 'pass']),
+            ('version', [py, SCRIPT, 'version']),
+            ('(usage)', [py, SCRIPT]),
+            ('import --help', [py, SCRIPT, 'import', '--help']),
+            ('import -c', [py, SCRIPT, 'import', '-c', theme]),
+            ('export', [py, SCRIPT, 'export', '-o', '-w', out, '-n', 'X',
+                        '-t', 'putty-unix' if os.name != 'nt' else 'putty',
+                        'Default Settings']),
+        ]
+
+        print "%-16s %10s %10s" % ("case", "min (ms)", "median (ms)")
+        for name, cmd in cases:
+            times = []
+            for i in range(opts.number):
+                elapsed, rc = run_once(cmd, tmpdir, env)
+                if rc and name != '(usage)': # usage exits 2 by design
+                    break
+                times.append(elapsed)
+            if not times:
+                print "%-16s %10s %10s" % (name, "n/a", "n/a")
+                continue
+            times.sort()
+            print "%-16s %10.1f %10.1f" % (name, times[0] * 1000,
+                                           times[len(times) // 2] * 1000)
+    finally:
+        shutil.rmtree(tmpdir)
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main())
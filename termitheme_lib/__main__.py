@@ -1,12 +1,38 @@
 from __future__ import absolute_import
 import locale
+import os
 import os.path
 import sys
-from . import core, commands, version
+import time
+_t_start = time.time()
+from . import trace
 
-VERSION = version.version
-if version.revision:
-    VERSION += " [rev " + version.revision + "]"
+# Tracing and profiling go before the command name, so that they can cover
+# everything from here on.  The environment can also turn them on.
+trace_file = os.environ.get(trace.TRACE_ENV)
+profile_file = os.environ.get(trace.PROFILE_ENV)
+_n_global = 0
+while (len(sys.argv) > _n_global + 2 and
+       sys.argv[_n_global + 1] in ('--trace', '--profile')):
+    if sys.argv[_n_global + 1] == '--trace':
+        trace_file = sys.argv[_n_global + 2]
+    else:
+        profile_file = sys.argv[_n_global + 2]
+    _n_global += 2
+if trace_file:
+    trace.start(trace_file, t0=_t_start)
+
+from . import core, commands
+try:
+    from . import version
+except ImportError:
+    # a source checkout: version.py is written by setup.py's build_py
+    VERSION, FAMILY = "(unreleased)", "source checkout"
+else:
+    VERSION, FAMILY = version.version, version.family
+    if version.revision:
+        VERSION += " [rev " + version.revision + "]"
+trace.record('import', _t_start)
 
 def usage (argv, e=None):
     if __name__ == '__main__':
@@ -16,12 +42,12 @@ def usage (argv, e=None):
     if e:
         print "Error: %s" % e.args[0]
     else:
-        print "Usage: %s <command> [command arguments...]" % prog
+        print ("Usage: %s [--trace FILE] [--profile FILE] "
+               "<command> [command arguments...]" % prog)
         print
         print "Available commands:"
         for cmd,handler_cls in commands.get_cmd_iter():
-            handler = handler_cls()
-            handler.show_usage(argv[0])
+            handler_cls.show_usage(argv[0])
         print
         print "For help on a command, use %s <command> --help" % prog
         print
@@ -35,47 +61,78 @@ class PrintVersion (commands.Command):
             p = self.get_parser(argv[0])
             p.parse_args(['--help'])
         else:
-            print "termitheme version %s (%s)" % (VERSION, version.family)
+            print "termitheme version %s (%s)" % (VERSION, FAMILY)
             return 0
 
 
-# Platform encoding support
-# Bust us out of 'C' locale
-locale.setlocale(locale.LC_ALL, '')
-charset = None
-try:
-    charset = locale.nl_langinfo(locale.CODESET)
-except AttributeError:
-    # fall back to ANSI code page on win32
-    if sys.platform.startswith("win"):
-        charset = 'mbcs'
-if not charset:
-    charset = 'utf-8'
+def setup_locale ():
+    """Set up the locale and tell core about its charset; return argv."""
 
-# Push our detected encoding to termitheme
-# (otherwise it just assumes utf-8)
-core.CHARSET = charset
+    # Platform encoding support
+    # Bust us out of 'C' locale
+    locale.setlocale(locale.LC_ALL, '')
+    charset = None
+    try:
+        charset = locale.nl_langinfo(locale.CODESET)
+    except AttributeError:
+        # fall back to ANSI code page on win32
+        if sys.platform.startswith("win"):
+            charset = 'mbcs'
+    if not charset:
+        charset = 'utf-8'
 
-argv = []
-if sys.platform.startswith("win"):
-    argv = core.win32_unicode_argv()
-else:
-    argv = [a.decode(charset) if isinstance(a, str) else a
+    # Push our detected encoding to termitheme
+    # (otherwise it just assumes utf-8)
+    core.CHARSET = charset
+
+    if sys.platform.startswith("win"):
+        return core.win32_unicode_argv()
+    return [a.decode(charset) if isinstance(a, str) else a
             for a in sys.argv]
 
+
 commands.register_cmd(PrintVersion)
 _cmdnames = commands.get_cmd_names()
 
+# The version and usage messages are plain ASCII, so only the other
+# commands need to wait for the locale.
+if (len(sys.argv) > _n_global + 1 and
+    sys.argv[_n_global + 1] in _cmdnames and
+    sys.argv[_n_global + 1] != PrintVersion.cmdname):
+    _t_locale = time.time()
+    argv = setup_locale()
+    trace.record('locale', _t_locale)
+else:
+    argv = sys.argv[:]
+del argv[1:1 + _n_global] # tracing options were handled above
+
 if len(argv) > 1 and argv[1] in _cmdnames:
     cmdname = argv[1]
     del argv[1:2] # consume argument
-    try:
-        rc = commands.run_cmd(cmdname, argv)
-    except Exception, e:
-        usage(argv, e)
-        rc = 2
+    rc = None
+    # A running daemon has the backend loaded already; traced and profiled
+    # runs always stay in this process.
+    if not (trace_file or profile_file):
+        from . import daemon
+        rc = daemon.handoff(cmdname, argv)
+    if rc is None:
+        try:
+            with trace.span('command', command=cmdname):
+                if profile_file:
+                    rc = trace.profiled(profile_file, commands.run_cmd,
+                                        cmdname, argv)
+                else:
+                    rc = commands.run_cmd(cmdname, argv)
+        except Exception, e:
+            usage(argv, e)
+            rc = 2
 else:
     rc = usage(argv)
 
+try:
+    trace.finish()
+except EnvironmentError, e:
+    print >>sys.stderr, "Failed to write trace to '%s': %s" % (trace_file, e)
+
 sys.exit(rc)
 
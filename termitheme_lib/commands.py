@@ -1,19 +1,171 @@
 from __future__ import absolute_import, division, with_statement
 
-import optparse
 import os.path
 import sys
 
-from . import core
+# index, search, daemon, snapshot, formats, optparse and multiprocessing
+# are imported where they are used, so that commands which don't need them
+# start faster.
+from . import core, pipeline, trace
 
 # argv[0] used if a command is called without argv
 self_argv0 = __name__
 _handlers = None
-
+# filename meaning standard input or output
+STDIO = '-'
+# export format of termitheme's own theme files; see formats for the others
+THEMEFILE_FORMAT = 'termitheme'
 
 def p_err (str):
     print >>sys.stderr, str
 
+def _binary (fp):
+    """Put fp in binary mode on Windows, where text mode mangles zips."""
+
+    if sys.platform.startswith("win"):
+        import msvcrt
+        msvcrt.setmode(fp.fileno(), os.O_BINARY)
+    return fp
+
+def _write_stdout (data):
+    out = _binary(sys.stdout)
+    out.write(data)
+    out.flush()
+
+def _show_value (v):
+    if v is None:
+        return u"(unset)"
+    elif isinstance(v, str):
+        return v.decode('utf-8', 'replace')
+    elif isinstance(v, (list, tuple)):
+        return u",".join([_show_value(i) for i in v])
+    return unicode(v)
+
+def print_changes (changes):
+    """Print (key, old, new) changes planned by a terminal backend."""
+
+    enc = sys.stdout.encoding or core.CHARSET
+    for k, old, new in changes:
+        line = u"\t%s: %s -> %s" % (_show_value(k), _show_value(old),
+                                     _show_value(new))
+        print line.encode(enc, 'xmlcharrefreplace')
+
+def theme_filenames (args):
+    """Expand directories in args to the theme zips they contain."""
+
+    rv = []
+    for arg in args:
+        if os.path.isdir(arg):
+            names = [n for n in sorted(os.listdir(arg))
+                     if n.lower().endswith('.zip')]
+            rv.extend([os.path.join(arg, n) for n in names])
+        else:
+            rv.append(arg)
+    return rv
+
+def pool_map (fn, items, jobs=pipeline.DEFAULT_JOBS):
+    """Iterate over fn(item) for items, computed on up to jobs threads.
+
+    Results are yielded in the order of items, as soon as each one is ready,
+    so the caller can do serialized work (like backend writes) meanwhile."""
+
+    ThreadPool = None
+    if jobs > 1 and len(items) > 1:
+        try:
+            from multiprocessing.pool import ThreadPool
+        except ImportError: # Python 2.5
+            pass
+    if ThreadPool is None:
+        for i in items:
+            yield fn(i)
+        return
+
+    pool = ThreadPool(min(jobs, len(items)))
+    try:
+        for rv in pool.imap(fn, items):
+            yield rv
+    finally:
+        pool.terminate()
+
+def _unique_filename (dirname, name, used, suffix='.zip'):
+    """Return a path in dirname for theme name, not already in used.
+
+    The chosen path is added to used."""
+
+    base = core.fs_filename(name)
+    filename = os.path.join(dirname, base + suffix)
+    i = 1
+    while filename in used:
+        i += 1
+        filename = os.path.join(dirname, "%s-%d%s" % (base, i, suffix))
+    used.add(filename)
+    return filename
+
+def _read_theme (filename, credits=False):
+    """Read filename, returning (filename, themefile, profile or None).
+
+    If credits is true, they are loaded into themefile from the same open
+    archive."""
+
+    try:
+        if filename == STDIO:
+            # zipfile has to seek, so the archive is held in memory
+            themefile = core.ThemeFile.from_bytes(_binary(sys.stdin).read())
+        else:
+            themefile = core.ThemeFile(filename)
+        with trace.span('ThemeFile.read', file=filename):
+            with themefile:
+                profile = themefile.read()
+                if credits:
+                    themefile.get_credits()
+        return (filename, themefile, profile)
+    except:
+        return (filename, None, None)
+
+def _read_theme_credits (filename):
+    return _read_theme(filename, True)
+
+def _format_suffix (fmt):
+    if fmt == THEMEFILE_FORMAT:
+        return '.zip'
+    from . import formats
+    return formats.get(fmt).suffix
+
+def _write_rendered (fmt, profile, filename, overwrite=False):
+    """Write profile to filename (or - for stdout) in a formats format."""
+
+    from . import formats
+    data = formats.get(fmt).render(profile)
+    if filename == STDIO:
+        _write_stdout(data)
+        return
+    if os.path.exists(filename) and not overwrite:
+        raise ValueError("File '%s' exists." % filename)
+    with open(filename, 'wb') as f:
+        f.write(data)
+
+def _write_theme (job):
+    """Write a (profile, filename, format, opts) job for export --all.
+
+    Returns (profile, filename, exception or None)."""
+
+    profile, filename, fmt, opts = job
+    try:
+        if fmt != THEMEFILE_FORMAT:
+            with trace.span('render', format=fmt, file=filename):
+                _write_rendered(fmt, profile, filename, opts.overwrite)
+            return (profile, filename, None)
+        themefile = core.ThemeFile(filename)
+        if opts.credits:
+            themefile.set_credits(opts.credits)
+        themefile.min_version = opts.min_version
+        with trace.span('ThemeFile.write', file=filename):
+            themefile.write(profile, opts.overwrite)
+    except Exception, e:
+        return (profile, filename, e)
+    return (profile, filename, None)
+
+
 class Command (object):
     cmdname = "command"
     usage_extended = "[command's options]"
@@ -22,6 +174,7 @@ class Command (object):
         return p.parse_args(argv[1:])
 
     def get_parser (self, argv0=None):
+        import optparse
         usage = '%prog ' + self.cmdname
         if self.usage_extended:
             usage += " " + self.usage_extended
@@ -33,8 +186,9 @@ class Command (object):
         self._add_options(p)
         return p
 
-    def show_usage (self, argv0=None, outfp=None):
-        print "  %s %s" % (self.cmdname, self.usage_extended)
+    @classmethod
+    def show_usage (cls, argv0=None, outfp=None):
+        print "  %s %s" % (cls.cmdname, cls.usage_extended)
 
     def error (self, msg):
         raise Exception("%s; use `%s --help` for help." % (msg, self.cmdname))
@@ -48,14 +202,30 @@ class Command (object):
 
 class Export (Command):
     cmdname = "export"
-    usage_extended = "[-c file] [-n name] [-t type] [-w file] [-U] profile"
+    usage_extended = ("[-c file] [-f formats] [-n name] [-t type] [-w file] "
+                      "[-U] profile\n"
+                      "  export -a [-c file] [-f formats] [-j jobs] [-t type] "
+                      "[-w dir] [-U]")
     def _add_options (self, p):
-        t_help = ("Export from terminal type TYPE (available types: %s)" %
-                  ", ".join(core.terminal.supported_types()))
+        from . import formats
+        t_help = ("Export from terminal type TYPE (known types: %s; default: "
+                  "this platform's)" % ", ".join(core.terminal.known_types()))
+        f_help = ("Write each profile in every one of the comma-separated "
+                  "FORMATS (known formats: %s; default: %s)" %
+                  (", ".join([THEMEFILE_FORMAT] + sorted(formats.FORMATS)),
+                   THEMEFILE_FORMAT))
 
         ao = p.add_option
+        ao("-a", "--all", dest="all", action="store_true",
+           help="Export every profile into the directory given by -w")
         ao("-c", "--credits", dest="credits", metavar="FILE",
            help="Include contents of FILE as credits in the exported file")
+        ao("-f", "--format", dest="formats", metavar="FORMATS",
+           default=THEMEFILE_FORMAT, help=f_help)
+        ao("-j", "--jobs", dest="jobs", metavar="N", type="int",
+           default=pipeline.DEFAULT_JOBS,
+           help="With -a, write up to N theme files at once (default %d)" %
+           pipeline.DEFAULT_JOBS)
         ao("-m", "--min-version", dest="min_version", metavar="VERSION",
            help="Limit compatibility of to termitheme >= VERSION")
         ao("-n", "--name", dest="name", metavar="NAME",
@@ -63,10 +233,10 @@ class Export (Command):
         ao("-o", "--overwrite", dest="overwrite", action="store_true",
            help="Delete existing output file, if any")
         ao("-t", "--terminal", dest="terminal", metavar="TYPE",
-           default=core.terminal.default_type,
            help=t_help)
         ao("-w", "--write", dest="filename", metavar="FILENAME",
-           help="Write output theme to FILENAME")
+           help="Write output theme to FILENAME (- for standard output); "
+                "with several formats, a directory")
         ao("-U", "--utf-8", "--utf8", dest="utf8", action="store_true",
            help="Treat files as containing UTF-8 character data")
 
@@ -77,7 +247,16 @@ class Export (Command):
             argv = ['<%s.cmd_export>' % self_argv0, profile]
 
         (opts, args) = self.parse_argv(argv)
-        if len(args) < 1:
+        fmts = self._parse_formats(opts.formats)
+        if opts.all:
+            if args or profile:
+                self.error("Profile names cannot be given with --all")
+            elif opts.name:
+                self.error("A name cannot be given with --all")
+            elif opts.filename == STDIO:
+                self.error("--all writes to a directory, not to -")
+            return self._run_all(opts, fmts, filename or opts.filename or '.')
+        elif len(args) < 1:
             self.error("Missing profile name")
         elif len(args) > 2:
             self.error("Too many arguments")
@@ -85,34 +264,95 @@ class Export (Command):
         real_name = opts.name if opts.name else args[0]
         profile_name = args[0]
 
-        # Figure out the filename.
+        # Figure out the filename, or the directory for several formats.
         # parameter > -w option > positional arg > default
         if not filename:
             if opts.filename:
                 filename = opts.filename
             elif len(args) == 2:
                 filename = args.pop()
-            else:
-                filename = core.fs_filename(real_name + '.zip')
+        if len(fmts) == 1:
+            targets = [(fmts[0], filename or
+                        core.fs_filename(real_name + _format_suffix(fmts[0])))]
+        elif filename == STDIO:
+            self.error("Several formats cannot be written to -")
+        else:
+            dirname = filename or ''
+            if dirname and not os.path.isdir(dirname):
+                p_err("Directory '%s' does not exist." % dirname)
+                return 1
+            targets = [(f, os.path.join(dirname, core.fs_filename(
+                            real_name + _format_suffix(f)))) for f in fmts]
 
         if opts.utf8:
             core.CHARSET = 'utf-8'
 
         try:
-            io = core.terminal.get_io(opts.terminal)
+            with trace.span('get_io', terminal=opts.terminal):
+                io = core.terminal.get_io(opts.terminal)
         except (KeyError, ValueError), e:
             p_err(e.args[0])
             return 2
 
         try:
-            dst = io.read_profile(profile_name)
+            with trace.span('read_profile', profile=profile_name):
+                dst = io.read_profile(profile_name)
             dst.name = real_name
         except:
             p_err("The theme '%s' does not exist." % profile_name)
             return 1
 
+        # the profile is read once, whatever the number of formats
+        rc = 0
+        for fmt, filename in targets:
+            rc = self._export_one(dst, profile_name, fmt, filename, opts) or rc
+        return rc
+
+    def _parse_formats (self, value):
+        """Return the format names in comma-separated value, in order."""
+
+        from . import formats
+        fmts = []
+        for fmt in value.split(','):
+            fmt = fmt.strip()
+            if fmt != THEMEFILE_FORMAT and fmt not in formats.FORMATS:
+                self.error("Unknown format '%s'" % fmt)
+            elif fmt not in fmts:
+                fmts.append(fmt)
+        return fmts
+
+    def _export_one (self, dst, profile_name, fmt, filename, opts):
+        """Write profile dst to filename in format fmt; return the exit
+        status."""
+
+        real_name = dst.name
+        to_stdout = (filename == STDIO)
+        if fmt != THEMEFILE_FORMAT:
+            try:
+                with trace.span('render', format=fmt, file=filename):
+                    _write_rendered(fmt, dst, filename, opts.overwrite)
+            except Exception, e:
+                p_err("Failed to write theme to '%s':" % filename)
+                p_err("\t%s" % e)
+                return 1
+        else:
+            rc = self._write_themefile(dst, filename, opts)
+            if rc:
+                return rc
+
+        if to_stdout: # keep the theme file alone on stdout
+            p_err("Exported theme '%s' as '%s' to standard output." % (
+                profile_name, real_name))
+        else:
+            print "Exported theme '%s' as '%s' to %s." % (profile_name,
+                                                          real_name,
+                                                          filename)
+        return 0
+
+    def _write_themefile (self, dst, filename, opts):
+        to_stdout = (filename == STDIO)
         try:
-            themefile = core.ThemeFile(filename)
+            themefile = core.ThemeFile(None if to_stdout else filename)
             if opts.credits:
                 themefile.set_credits(opts.credits)
 
@@ -122,37 +362,110 @@ class Export (Command):
                 p_err("Could not parse version string.")
                 return 2
 
-            themefile.write(dst, opts.overwrite)
+            with trace.span('ThemeFile.write', file=filename):
+                if to_stdout:
+                    _write_stdout(themefile.to_bytes(dst))
+                else:
+                    themefile.write(dst, opts.overwrite)
         except Exception, e:
             p_err("Failed to write theme to '%s':" % filename)
             p_err("\t%s" % e)
             return 1
-
-        print "Exported theme '%s' as '%s' to %s." % (profile_name,
-                                                      real_name,
-                                                      filename)
         return 0
 
+    def _run_all (self, opts, fmts, dirname):
+        if opts.utf8:
+            core.CHARSET = 'utf-8'
+
+        try:
+            with trace.span('get_io', terminal=opts.terminal):
+                io = core.terminal.get_io(opts.terminal)
+        except (KeyError, ValueError), e:
+            p_err(e.args[0])
+            return 2
+
+        if not os.path.isdir(dirname):
+            p_err("Directory '%s' does not exist." % dirname)
+            return 1
+
+        # Check the settings shared by every file once, up front.
+        try:
+            proto = core.ThemeFile(None)
+            if opts.credits:
+                proto.set_credits(opts.credits)
+            proto.min_version = opts.min_version
+        except ValueError:
+            p_err("Could not parse version string.")
+            return 2
+        except Exception, e:
+            p_err("Error reading credits: '%s'" % e.args[0])
+            return 1
+
+        # Backend reads stay serialized, one per profile whatever the number
+        # of formats; only the file writes are pooled.
+        jobs = []
+        failed = []
+        used = set()
+        with trace.span('profile_names'):
+            names = sorted(io.profile_names())
+        for name in names:
+            try:
+                with trace.span('read_profile', profile=name):
+                    profile = io.read_profile(name)
+            except:
+                p_err("The theme '%s' could not be read." % name)
+                failed.append(name)
+                continue
+            for fmt in fmts:
+                filename = _unique_filename(dirname, name, used,
+                                            _format_suffix(fmt))
+                jobs.append((profile, filename, fmt, opts))
+
+        for profile, filename, e in pool_map(_write_theme, jobs, opts.jobs):
+            if e is not None:
+                p_err("Failed to write theme to '%s':" % filename)
+                p_err("\t%s" % e)
+                if profile.name not in failed:
+                    failed.append(profile.name)
+            else:
+                print "Exported theme '%s' to %s." % (profile.name, filename)
+
+        print "Exported %d of %d profiles." % (len(names) - len(failed),
+                                               len(names))
+        return 1 if failed else 0
+
 
 class Import (Command):
     cmdname = "import"
-    usage_extended = "{-c | [-b profile] [-n name] [-o] [-t type]} filename"
+    usage_extended = ("{-c | [-b profile] [-d] [-n name] [-o] [-t type] "
+                      "[-S] | -m pattern [-d] [-t type]} [-j jobs] "
+                      "filename|directory...")
     def _add_options (self, p):
-        t_help = ("Import to terminal type TYPE (available types: %s)" %
-                  ", ".join(core.terminal.supported_types()))
+        t_help = ("Import to terminal type TYPE (known types: %s; default: "
+                  "this platform's)" % ", ".join(core.terminal.known_types()))
 
         ao = p.add_option
         ao("-b", "--base", dest="base", metavar="PROFILE",
            help="Base on PROFILE instead of the default profile")
         ao("-c", "--credits", dest="credits", action="store_true",
            help="Print theme credits and exit.")
+        ao("-d", "--dry-run", dest="dry_run", action="store_true",
+           help="Show the changes that would be made, without making them")
+        ao("-j", "--jobs", dest="jobs", metavar="N", type="int",
+           default=pipeline.DEFAULT_JOBS,
+           help="Read up to N theme files at once (default %d)" %
+           pipeline.DEFAULT_JOBS)
+        ao("-m", "--match", dest="match", metavar="PATTERN",
+           help="Apply the theme to every existing profile whose name "
+                "matches PATTERN (* and ? are wildcards)")
         ao("-n", "--name", dest="name", metavar="NAME",
            help="Name the newly created profile NAME")
         ao("-o", "--overwrite", dest="overwrite", action="store_true",
            help="Allow overwriting/updating an existing profile")
         ao("-t", "--terminal", dest="terminal", metavar="TYPE",
-           default=core.terminal.default_type,
            help=t_help)
+        ao("-S", "--stats", dest="stats", action="store_true",
+           help="Print reading and writing throughput at the end")
 
     def run (self, argv=None, filename=None):
         if not (argv or filename):
@@ -161,27 +474,116 @@ class Import (Command):
             argv = ['<%s.cmd_import>' % self_argv0, filename]
 
         (opts, args) = self.parse_argv(argv)
-        if args is None:
+        if not args:
             self.error("No filename given")
-        elif len(args) > 1:
-            self.error("Too many arguments")
-        else:
-            filename = args[0]
+
+        filenames = theme_filenames(args)
+        if not filenames:
+            p_err("No theme files found.")
+            return 1
+        elif opts.name and len(filenames) > 1:
+            self.error("A name can only be given when importing one file")
+        elif filenames.count(STDIO) > 1:
+            self.error("Standard input (-) can only be read once")
+        elif opts.match and (opts.name or opts.base):
+            self.error("--match cannot be combined with --name or --base")
+        elif opts.match and len(filenames) > 1:
+            self.error("A pattern can only be given with one file")
+
+        # Credits never touch the terminal, so its backend isn't loaded.
+        if opts.credits:
+            themes = pool_map(_read_theme_credits, filenames, opts.jobs)
+            return self._show_credits(themes, len(filenames) > 1)
 
         try:
-            io = core.terminal.get_io(opts.terminal)
+            with trace.span('get_io', terminal=opts.terminal):
+                io = core.terminal.get_io(opts.terminal)
         except (KeyError, ValueError), e:
             p_err(e.args[0])
             return 2
 
+        # Archives are read on the pipeline's threads, starting now, while
+        # backend writes stay in order on this one.
+        themes = pipeline.Ingest(_read_theme, opts.jobs).start(filenames)
         try:
-            themefile = core.ThemeFile(filename)
-            src = themefile.read()
-        except:
-            p_err("Theme file %s does not seem to be valid." % filename)
-            return 1
+            return self._import(io, themes, filenames, opts)
+        finally:
+            themes.stop()
 
-        if opts.credits:
+    def _import (self, io, themes, filenames, opts):
+        if opts.match:
+            return self._apply(io, themes, opts)
+        if not opts.base:
+            with trace.span('read_profile', profile=''):
+                base_profile = io.read_profile()
+            base = "default profile"
+        else:
+            try:
+                with trace.span('read_profile', profile=opts.base):
+                    base_profile = io.read_profile(opts.base)
+                base = opts.base
+            except:
+                p_err("The base theme %s does not exist." % opts.base)
+                return 1
+
+        failed = []
+        for filename, themefile, src in themes:
+            if src is None:
+                p_err("Theme file %s does not seem to be valid." % filename)
+                failed.append(filename)
+            else:
+                with trace.span('save', file=filename):
+                    if self._save(io, src, base_profile.copy(), base, opts):
+                        failed.append(filename)
+
+        if len(filenames) > 1:
+            print "Imported %d of %d theme files." % (
+                len(filenames) - len(failed), len(filenames))
+            for filename in failed:
+                p_err("\tFailed: %s" % filename)
+        if opts.stats:
+            print themes.stats.report()
+        return 1 if failed else 0
+
+    def _apply (self, io, themes, opts):
+        """Apply the one theme in themes to the profiles matching
+        opts.match, each based on itself."""
+
+        for filename, themefile, src in themes:
+            if src is None:
+                p_err("Theme file %s does not seem to be valid." % filename)
+                return 1
+            try:
+                with trace.span('apply_theme', pattern=opts.match):
+                    applied = io.apply_theme(src, opts.match, opts.dry_run)
+            except Exception, e:
+                p_err("Error writing profiles to storage:")
+                p_err("\t%s" % e.args[0])
+                return 1
+
+            if not applied:
+                p_err("No profile matches '%s'." % opts.match)
+                return 1
+            for name, changes in applied:
+                if opts.dry_run:
+                    print "Would apply theme '%s' to '%s', changing %d " \
+                          "value(s)" % (src.name, name, len(changes))
+                    print_changes(changes)
+                else:
+                    print "Applied theme '%s' to '%s'" % (src.name, name)
+        if opts.stats:
+            print themes.stats.report()
+        return 0
+
+    def _show_credits (self, themes, show_names):
+        rc = 0
+        for filename, themefile, src in themes:
+            if src is None:
+                p_err("Theme file %s does not seem to be valid." % filename)
+                rc = 1
+                continue
+            if show_names:
+                print "%s:" % filename
             try:
                 c = themefile.get_credits()
                 if c is None:
@@ -189,30 +591,25 @@ class Import (Command):
                 else:
                     print c.encode(sys.stdout.encoding or core.CHARSET,
                                    'xmlcharrefreplace')
-                return 0
             except Exception, e:
                 p_err("Error reading credits: '%s'" % e.args[0])
-                return 1
+                rc = 1
+        return rc
 
-        if not opts.base:
-            dst = io.read_profile()
-            base = "default profile"
-        else:
-            try:
-                dst = io.read_profile(opts.base)
-                base = opts.base
-            except:
-                p_err("The base theme %s does not exist." % opts.base)
-                return 1
+    def _save (self, io, src, dst, base, opts):
+        """Copy src into dst and write it out; return nonzero on failure."""
 
         dst_name = opts.name if opts.name else src.name
-        if io.profile_exists(dst_name) and not opts.overwrite:
+        with trace.span('profile_exists', profile=dst_name):
+            exists = io.profile_exists(dst_name)
+        if exists and not opts.overwrite:
             p_err("The theme '%s' exists and --overwrite was not given." %
                   dst_name)
             return 1
 
         try:
-            dst.update(src)
+            with trace.span('update'):
+                dst.update(src)
             dst.name = dst_name
         except Exception, e:
             p_err("Error copying theme into profile:")
@@ -220,12 +617,19 @@ class Import (Command):
             return 1
 
         try:
-            io.write_profile(dst)
+            with trace.span('write_profile', profile=dst.name):
+                changes = io.write_profile(dst, opts.dry_run)
         except Exception, e:
             p_err("Error writing new profile to storage:")
             p_err("\t%s" % e.args[0])
             return 1
 
+        if opts.dry_run:
+            print "Would save theme '%s' as '%s' (based on %s), " \
+                  "changing %d value(s)" % (src.name, dst.name, base,
+                                            len(changes))
+            print_changes(changes)
+            return 0
         print "Saved theme '%s' as '%s' (based on %s)" % (src.name,
                                                           dst.name,
                                                           base)
@@ -242,7 +646,7 @@ class Pack (Command):
         ao("-o", "--overwrite", dest="overwrite", action="store_true",
            help="Delete existing output file, if any")
         ao("-w", "--write", dest="filename", metavar="FILENAME",
-           help="Write output theme to FILENAME")
+           help="Write output theme to FILENAME (- for standard output)")
         ao("-U", "--utf-8", "--utf8", dest="utf8", action="store_true",
            help="Treat files as containing UTF-8 character data")
 
@@ -263,7 +667,11 @@ class Pack (Command):
 
         try:
             theme = core.ThemeFile(None)
-            profile = theme.read_ini(themefile)
+            with trace.span('read_ini', file=themefile):
+                if themefile == STDIO:
+                    profile = theme.read_ini(sys.stdin)
+                else:
+                    profile = theme.read_ini(themefile)
         except Exception, e:
             p_err("Theme file %s does not seem to be valid." % themefile)
             p_err("\t%s" % e.args[0])
@@ -276,7 +684,12 @@ class Pack (Command):
                 p_err("Error reading credits: '%s'" % e.args[0])
                 return 1
 
-        if opts.filename:
+        if opts.filename == STDIO:
+            with trace.span('ThemeFile.write', file=STDIO):
+                _write_stdout(theme.to_bytes(profile))
+            p_err("Packed theme '%s' to standard output" % profile.name)
+            return 0
+        elif opts.filename:
             theme.filename = opts.filename
         else:
             theme.filename = core.fs_filename(profile.name + '.zip')
@@ -285,11 +698,342 @@ class Pack (Command):
             p_err("File %s exists and overwrite option was not specified.")
             return 1
 
-        theme.write(profile, opts.overwrite)
+        with trace.span('ThemeFile.write', file=theme.filename):
+            theme.write(profile, opts.overwrite)
 
         print "Packed theme '%s' into '%s'" % (profile.name, theme.filename)
         return 0
 
+class Index (Command):
+    cmdname = "index"
+    usage_extended = ("[-f file] [-j jobs] directory\n"
+                      "  index -l [-f file] [-n pattern] [-v version] "
+                      "directory")
+    def _add_options (self, p):
+        from . import index
+        ao = p.add_option
+        ao("-f", "--file", dest="filename", metavar="FILE",
+           help="Keep the index in FILE (default: %s in the directory)" %
+           index.INDEX_FILENAME)
+        ao("-j", "--jobs", dest="jobs", metavar="N", type="int",
+           default=pipeline.DEFAULT_JOBS,
+           help="Read up to N theme files at once (default %d)" %
+           pipeline.DEFAULT_JOBS)
+        ao("-l", "--list", dest="list", action="store_true",
+           help="List indexed themes instead of updating the index")
+        ao("-n", "--name", dest="pattern", metavar="PATTERN",
+           help="With -l, list themes with names matching PATTERN")
+        ao("-v", "--version", dest="version", metavar="VERSION",
+           help="With -l, list themes readable by termitheme VERSION")
+
+    def run (self, argv=None, directory=None):
+        from . import index
+        if not (argv or directory):
+            self.error("A directory is required, via argv or directory")
+        elif not argv:
+            argv = ['<%s.cmd_index>' % self_argv0, directory]
+
+        (opts, args) = self.parse_argv(argv)
+        if len(args) != 1:
+            self.error("Exactly one directory is required")
+        directory = args[0]
+        if not os.path.isdir(directory):
+            p_err("Directory '%s' does not exist." % directory)
+            return 1
+
+        idx = index.ThemeIndex(directory, opts.filename)
+        try:
+            idx.load()
+        except Exception:
+            p_err("Index file %s could not be read; rebuilding it." %
+                  idx.filename)
+
+        if opts.list:
+            return self._list(idx, opts)
+
+        read_fn = lambda fn, paths: pool_map(fn, paths, opts.jobs)
+        read, removed = idx.update(read_fn)
+        try:
+            idx.save()
+        except EnvironmentError, e:
+            p_err("Failed to write index to '%s':" % idx.filename)
+            p_err("\t%s" % e)
+            return 1
+
+        entries = idx.entries(valid=False)
+        bad = [name for name, entry in entries if 'error' in entry]
+        for name in bad:
+            if name in read:
+                p_err("Theme file %s does not seem to be valid." % name)
+        print "Indexed %d theme files (%d read, %d removed, %d invalid)." % (
+            len(entries), len(read), len(removed), len(bad))
+        return 0
+
+    def _list (self, idx, opts):
+        try:
+            entries = idx.entries(opts.pattern, opts.version)
+        except ValueError:
+            p_err("Could not parse version string.")
+            return 2
+        enc = sys.stdout.encoding or core.CHARSET
+        for name, entry in entries:
+            line = u"%s\t%s" % (entry['name'], name)
+            print line.encode(enc, 'xmlcharrefreplace')
+        return 0
+
+
+class Search (Command):
+    cmdname = "search"
+    usage_extended = "[-f] [-N number] [-t type] {profile | -f file} directory"
+    def _add_options (self, p):
+        t_help = ("Read profile from terminal type TYPE (known types: %s; "
+                  "default: this platform's)" %
+                  ", ".join(core.terminal.known_types()))
+
+        ao = p.add_option
+        ao("-f", "--file", dest="file", action="store_true",
+           help="Search for the theme in a theme file instead of a profile")
+        ao("-N", "--number", dest="number", metavar="N", type="int",
+           default=10, help="Show the N closest themes (default 10)")
+        ao("-t", "--terminal", dest="terminal", metavar="TYPE",
+           help=t_help)
+
+    def run (self, argv=None):
+        from . import index, search
+        if not argv:
+            self.error("A profile and directory are required")
+
+        (opts, args) = self.parse_argv(argv)
+        if len(args) != 2:
+            self.error("A profile (or file) and a directory are required")
+        query, directory = args
+
+        if opts.file:
+            try:
+                src = core.ThemeFile(query).read()
+            except:
+                p_err("Theme file %s does not seem to be valid." % query)
+                return 1
+        else:
+            try:
+                io = core.terminal.get_io(opts.terminal)
+                src = io.read_profile(query)
+            except (KeyError, ValueError), e:
+                p_err(e.args[0])
+                return 1
+
+        if not os.path.isdir(directory):
+            p_err("Directory '%s' does not exist." % directory)
+            return 1
+        # Stat-only when the index is current; only changed files are read.
+        idx = index.ThemeIndex(directory)
+        try:
+            idx.load()
+        except Exception:
+            pass
+        if any(idx.update(pool_map)):
+            try:
+                idx.save()
+            except EnvironmentError:
+                pass # still usable in memory
+
+        corpus = search.PaletteSearch([(name, entry['palette'])
+                                       for name, entry in idx.entries()])
+        try:
+            results = corpus.nearest(src, opts.number)
+        except KeyError, e:
+            p_err(e.args[0])
+            return 1
+
+        enc = sys.stdout.encoding or core.CHARSET
+        entries = dict(idx.entries())
+        for dist, name in results:
+            line = u"%6.2f  %s\t%s" % (dist, entries[name]['name'], name)
+            print line.encode(enc, 'xmlcharrefreplace')
+        return 0
+
+
+class Dump (Command):
+    cmdname = "dump"
+    usage_extended = "[-o] [-t type] [-w file]"
+    def _add_options (self, p):
+        from . import snapshot
+        t_help = ("Dump terminal type TYPE (known types: %s; default: "
+                  "this platform's)" % ", ".join(core.terminal.known_types()))
+
+        ao = p.add_option
+        ao("-o", "--overwrite", dest="overwrite", action="store_true",
+           help="Delete existing output file, if any")
+        ao("-t", "--terminal", dest="terminal", metavar="TYPE",
+           help=t_help)
+        ao("-w", "--write", dest="filename", metavar="FILENAME",
+           default=snapshot.DEFAULT_FILENAME,
+           help="Write the snapshot to FILENAME (default %s; - for "
+                "standard output)" % snapshot.DEFAULT_FILENAME)
+
+    def run (self, argv=None):
+        from . import snapshot
+        (opts, args) = self.parse_argv(argv or ['<%s.cmd_dump>' %
+                                                self_argv0])
+        if args:
+            self.error("Too many arguments")
+        filename = opts.filename
+        to_stdout = (filename == STDIO)
+        if not (to_stdout or opts.overwrite) and os.path.exists(filename):
+            p_err("File %s exists and overwrite option was not specified." %
+                  filename)
+            return 1
+
+        try:
+            with trace.span('get_io', terminal=opts.terminal):
+                io = core.terminal.get_io(opts.terminal)
+        except (KeyError, ValueError), e:
+            p_err(e.args[0])
+            return 2
+        termname = opts.terminal or core.terminal.default_type
+
+        try:
+            with trace.span('dump', file=filename):
+                if to_stdout:
+                    count = snapshot.write(_binary(sys.stdout), termname,
+                                           io.dump())
+                    sys.stdout.flush()
+                else:
+                    with open(filename, 'wb') as f:
+                        count = snapshot.write(f, termname, io.dump())
+        except Exception, e:
+            p_err("Failed to write snapshot to '%s':" % filename)
+            p_err("\t%s" % e)
+            return 1
+
+        if to_stdout:
+            p_err("Dumped %d profiles to standard output." % count)
+        else:
+            print "Dumped %d profiles to %s." % (count, filename)
+        return 0
+
+
+class Restore (Command):
+    cmdname = "restore"
+    usage_extended = "[-d] [-t type] snapshot_file"
+    def _add_options (self, p):
+        t_help = ("Restore into terminal type TYPE (known types: %s; "
+                  "default: the snapshot's)" %
+                  ", ".join(core.terminal.known_types()))
+
+        ao = p.add_option
+        ao("-d", "--dry-run", dest="dry_run", action="store_true",
+           help="Show the changes that would be made, without making them")
+        ao("-t", "--terminal", dest="terminal", metavar="TYPE",
+           help=t_help)
+
+    def run (self, argv=None, filename=None):
+        from . import snapshot
+        if not (argv or filename):
+            self.error("A filename is required, via argv or filename")
+        elif not argv:
+            argv = ['<%s.cmd_restore>' % self_argv0, filename]
+
+        (opts, args) = self.parse_argv(argv)
+        if len(args) != 1:
+            self.error("Exactly one snapshot file is required")
+        filename = args[0]
+
+        try:
+            if filename == STDIO:
+                import cStringIO # gzip has to seek
+                f = cStringIO.StringIO(_binary(sys.stdin).read())
+            else:
+                f = open(filename, 'rb')
+        except EnvironmentError, e:
+            p_err("Snapshot %s could not be read:" % filename)
+            p_err("\t%s" % e)
+            return 1
+        from contextlib import closing # cStringIO has no __exit__
+        with closing(f):
+            try:
+                header, profiles = snapshot.read(f)
+            except ValueError, e:
+                p_err("Snapshot %s could not be read:" % filename)
+                p_err("\t%s" % e)
+                return 1
+
+            termname = opts.terminal or header.get('terminal')
+            try:
+                with trace.span('get_io', terminal=termname):
+                    io = core.terminal.get_io(termname)
+            except (KeyError, ValueError), e:
+                p_err(e.args[0])
+                return 2
+
+            names = []
+            def counted (profiles):
+                for p in profiles:
+                    names.append(p.name)
+                    yield p
+            try:
+                with trace.span('restore', file=filename):
+                    changes = io.restore(counted(profiles), opts.dry_run)
+            except Exception, e:
+                p_err("Error restoring profiles from %s:" % filename)
+                p_err("\t%s" % e)
+                return 1
+
+        if opts.dry_run:
+            print "Would restore %d profiles, changing %d value(s)" % (
+                len(names), len(changes))
+            print_changes(changes)
+        else:
+            print "Restored %d profiles from %s, changing %d value(s)." % (
+                len(names), filename, len(changes))
+        return 0
+
+
+class Daemon (Command):
+    cmdname = "daemon"
+    usage_extended = "[-s socket] [-T seconds]"
+    def _add_options (self, p):
+        from . import daemon
+        ao = p.add_option
+        ao("-s", "--socket", dest="socket", metavar="PATH",
+           help="Listen on the Unix socket PATH (default: $%s, or %s "
+                "in $XDG_RUNTIME_DIR)" % (daemon.SOCKET_ENV,
+                                          daemon.SOCKET_NAME))
+        ao("-T", "--ttl", dest="ttl", metavar="SECONDS", type="int",
+           default=daemon.DEFAULT_TTL,
+           help="Re-read profiles cached for over SECONDS (default %d)" %
+           daemon.DEFAULT_TTL)
+
+    def run (self, argv=None):
+        from . import daemon
+        (opts, args) = self.parse_argv(argv or ['<%s.cmd_daemon>' %
+                                                self_argv0])
+        if args:
+            self.error("Too many arguments")
+
+        server = daemon.Server(opts.socket, opts.ttl)
+        try:
+            server.listen()
+        except EnvironmentError, e:
+            p_err("Cannot listen on %s: %s" % (server.path,
+                                               e.strerror or e))
+            return 1
+
+        print "Serving %s on %s" % (", ".join(daemon.COMMANDS), server.path)
+        sys.stdout.flush()
+        import signal
+        def stop (signum, frame):
+            raise KeyboardInterrupt()
+        signal.signal(signal.SIGTERM, stop) # to remove the socket
+        try:
+            server.serve()
+        except KeyboardInterrupt:
+            pass
+        finally:
+            server.close()
+        return 0
+
+
 _handler_order = []
 _handlers = {}
 
@@ -319,4 +1063,9 @@ def register_cmd (handler, force=False):
 register_cmd(Import)
 register_cmd(Export)
 register_cmd(Pack)
+register_cmd(Index)
+register_cmd(Search)
+register_cmd(Dump)
+register_cmd(Restore)
+register_cmd(Daemon)
 
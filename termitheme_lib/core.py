@@ -4,27 +4,86 @@ from __future__ import absolute_import, division, with_statement
 
 # BATTERIES INCLUDED
 from contextlib import contextmanager # here
-import ConfigParser # here
-import codecs # here
-import datetime # here
 import os.path # both
 import re # here
-import StringIO # here; Python2.5 compatible hackery
 import sys # both
-import zipfile # here
+import time # here
+# Deferred to the functions that use them, so that commands which never
+# touch a theme file don't pay to import them: ConfigParser, codecs,
+# datetime, StringIO (Python2.5 compatible hackery) and zipfile.
 
 # PLATFORM SUPPORT
-# TODO: Check into supporting PuTTY on Linux
+# Backend modules are imported the first time their backend is asked for
+# (see _TerminalTypes), not on every run: gconf drags in all of GObject.
 
-try:
-    import gconf
-except ImportError:
-    gconf = None
+gconf = None
+_winreg = None
+_loaded = set() # names of the modules the load_* functions have tried
 
-try:
-    import _winreg
-except ImportError:
-    _winreg = None
+def load_gconf ():
+    """Import the gconf bindings if not yet tried; return them or None."""
+
+    global gconf, _gconf_values
+    if 'gconf' not in _loaded:
+        _loaded.add('gconf')
+        try:
+            import gconf
+            _gconf_values = gconf
+        except ImportError:
+            gconf = None
+    return gconf
+
+def load_winreg ():
+    """Import _winreg if not yet tried; return it or None."""
+
+    global _winreg
+    if '_winreg' not in _loaded:
+        _loaded.add('_winreg')
+        try:
+            import _winreg
+        except ImportError:
+            _winreg = None
+    return _winreg
+
+def putty_dir ():
+    """Return the directory where PuTTY on Unix keeps its settings ($PUTTYDIR
+    or ~/.putty), or None if there is none (always, on Windows)."""
+
+    if sys.platform.startswith("win"):
+        return None
+    dirname = os.environ.get('PUTTYDIR') or os.path.expanduser('~/.putty')
+    return dirname if os.path.isdir(dirname) else None
+
+# OPTIONAL ACCELERATION
+# NumPy takes longer to import than most commands take to run (~90ms), and
+# only beats plain Python on large batches of colors: even once imported,
+# it breaks even at about 22 colors for parsing and 16 for formatting.  So
+# it is imported the first time a batch of at least NUMPY_MIN_COLORS
+# colors comes along.  A profile's 16-color gconf palette and a theme
+# file's 22 colors are well below that and always take the per-color
+# path; only batches of many themes, such as a PaletteSearch corpus, use
+# NumPy.
+
+numpy = None
+NUMPY_MIN_COLORS = 64
+
+def load_numpy ():
+    """Import NumPy if not yet tried; return it or None."""
+
+    global numpy, _HEX_DIGITS, _HEX_VALUES
+    if 'numpy' not in _loaded:
+        _loaded.add('numpy')
+        try:
+            import numpy
+        except ImportError:
+            numpy = None
+            return None
+        _HEX_DIGITS = numpy.frombuffer('0123456789abcdef', dtype=numpy.uint8)
+        _HEX_VALUES = numpy.empty(256, dtype=numpy.uint8)
+        _HEX_VALUES.fill(255)
+        for i, c in enumerate('0123456789abcdef'):
+            _HEX_VALUES[ord(c)] = _HEX_VALUES[ord(c.upper())] = i
+    return numpy
 
 # Establish a default character set for everything
 CHARSET = 'utf-8'
@@ -87,6 +146,10 @@ def fs_filename (name, allow_pathsep=False):
 
 #{{{ Color conversion
 
+# What [0-9a-f] with re.I, and \s, match in a non-Unicode regex
+_HEX_CHARS = '0123456789abcdefABCDEF'
+_RE_SPACE = ' \t\n\r\f\v'
+
 class _ColorParser (object):
     def __init__ (self): #{{{
         def xdigits (len):
@@ -103,9 +166,59 @@ class _ColorParser (object):
             '48': re.compile('^#?' + (3 * xdigits(4)) + '$', re.I),
             '24dec': re.compile('^' + dec_str + '$'),
         }
+
+        # Table for _fast_dec: every byte string the '24dec' regex accepts,
+        # which is 0 through 255, plus 00 through 09
+        self._dec_bytes = dict(("%d" % i, self._double(i))
+                               for i in range(256))
+        self._dec_bytes.update(("%02d" % i, self._double(i))
+                               for i in range(10))
+    #}}}
+
+    #{{{ Regex-free decoding
+    # These accept exactly what the regexes do, and return None for
+    # anything else.  The regexes are only consulted for a trailing
+    # newline, which their '$' allows.
+
+    def _fast_hex (self, v, digits):
+        s = v[1:] if v[:1] == '#' else v
+        if len(s) == 3 * digits and not s.lstrip(_HEX_CHARS):
+            n = int(s, 16)
+            if digits == 2:
+                return [(n >> 16) * 257, ((n >> 8) & 0xff) * 257,
+                        (n & 0xff) * 257]
+            return [n >> 32, (n >> 16) & 0xffff, n & 0xffff]
+        elif len(s) != 3 * digits + 1:
+            return None
+
+        m = self._color_re['%d' % (digits * 12)].match(v)
+        if m is None:
+            return None
+        elif digits == 2:
+            return [self._double(int(h, 16)) for h in m.groups()]
+        return [int(h, 16) for h in m.groups()]
+
+    def _fast_dec (self, v):
+        parts = v.split(',')
+        if len(parts) == 3:
+            t = self._dec_bytes
+            try:
+                return [t[parts[0]], t[parts[1].lstrip(_RE_SPACE)],
+                        t[parts[2].lstrip(_RE_SPACE)]]
+            except KeyError:
+                pass
+
+        m = self._color_re['24dec'].match(v) if v.endswith('\n') else None
+        if m is None:
+            return None
+        return [self._double(int(d, 10)) for d in m.groups()]
     #}}}
 
     def parse24 (self, color): #{{{
+        if isinstance(color, basestring):
+            rv = self._fast_hex(color, 2)
+            if rv is not None:
+                return rv
         m = self._color_re['24'].match(color)
         if m is None:
             raise ValueError("Invalid 24-bit hex color '%s'" % color)
@@ -114,16 +227,20 @@ class _ColorParser (object):
     def to24 (self, color):
         if len(color) != 3:
             raise ValueError("Unexpected color length.")
-        rgb = ''.join(["%02x" % (v//256,) for v in color])
-        return '#' + rgb
+        r, g, b = color
+        return '#%02x%02x%02x' % (r//256, g//256, b//256)
 
     def is24 (self, v):
-        if isinstance(v, basestring) and self._color_re['24'].match(v):
+        if isinstance(v, basestring) and self._fast_hex(v, 2) is not None:
             return True
         return False
     #}}}
 
     def parse24dec (self, color): #{{{
+        if isinstance(color, basestring):
+            rv = self._fast_dec(color)
+            if rv is not None:
+                return rv
         m = self._color_re['24dec'].match(color)
         if m is None:
             raise ValueError("Invalid 24-bit decimal color '%s'" % color)
@@ -132,15 +249,20 @@ class _ColorParser (object):
     def to24dec (self, color):
         if len(color) != 3:
             raise ValueError("Unexpected color length.")
-        return ','.join(["%d" % (v//256,) for v in color])
+        r, g, b = color
+        return '%d,%d,%d' % (r//256, g//256, b//256)
 
     def is24dec (self, v):
-        if isinstance(v, basestring) and self._color_re['24dec'].match(v):
+        if isinstance(v, basestring) and self._fast_dec(v) is not None:
             return True
         return False
     #}}}
 
     def parse48 (self, color): #{{{
+        if isinstance(color, basestring):
+            rv = self._fast_hex(color, 4)
+            if rv is not None:
+                return rv
         m = self._color_re['48'].match(color)
         if m is None:
             raise ValueError("Invalid 48-bit hex color '%s'" % color)
@@ -149,13 +271,23 @@ class _ColorParser (object):
     def to48 (self, color):
         if len(color) != 3:
             raise ValueError("Unexpected color length.")
-        rgb = ''.join(["%04x" % v for v in color])
-        return '#' + rgb
+        return '#%04x%04x%04x' % tuple(color)
 
     def is48 (self, v):
-        if isinstance(v, basestring) and self._color_re['48'].match(v):
+        if isinstance(v, basestring) and self._fast_hex(v, 4) is not None:
             return True
         return False
+
+    def as48 (self, v):
+        """Return v parsed as a 48-bit hex color, or None if it isn't one."""
+        # only 12 digits, with '#' or '\n' or both, can be a color
+        if not isinstance(v, basestring) or not 12 <= len(v) <= 14:
+            return None
+        s = v[1:] if v[:1] == '#' else v
+        if len(s) == 12 and not s.lstrip(_HEX_CHARS):
+            n = int(s, 16)
+            return [n >> 32, (n >> 16) & 0xffff, n & 0xffff]
+        return self._fast_hex(v, 4)
     #}}}
 
     def parsehex (self, color): #{{{
@@ -166,7 +298,7 @@ class _ColorParser (object):
     #}}}
 
     def is_color (self, v): #{{{
-        if isinstance(v, list) and len(v) == 3:
+        if isinstance(v, (list, tuple)) and len(v) == 3:
             # test channel values
             return all([0 <= ch <= 65535 for ch in v])
         return False
@@ -178,6 +310,125 @@ class _ColorParser (object):
         raise ValueError("Byte value out of range: %d" % byteval)
     #}}}
 
+    #{{{ Whole-palette conversion
+    # A palette block is an Nx3 array of 16-bit channels: a contiguous
+    # uint16 numpy array for NUMPY_MIN_COLORS or more colors when NumPy is
+    # available, else a list of lists.
+    # Anything the fast path can't handle goes through the per-color
+    # methods above, so the results and error messages are the same.
+    _hex_widths = {None: (6, 7, 12, 13), '24': (6, 7), '48': (12, 13)}
+
+    def palette_block (self, colors):
+        """Pack a sequence of colors into a palette block."""
+
+        if numpy is not None and isinstance(colors, numpy.ndarray):
+            return colors
+        elif len(colors) < NUMPY_MIN_COLORS or load_numpy() is None:
+            return [list(c) for c in colors]
+
+        try:
+            a = numpy.array(colors, dtype=numpy.int64)
+        except (TypeError, ValueError):
+            a = None
+        if (a is not None and a.ndim == 2 and a.shape[1] == 3 and
+            a.size and a.min() >= 0 and a.max() <= 65535):
+            return a.astype(numpy.uint16)
+        return [list(c) for c in colors]
+
+    def palette_colors (self, block):
+        """Unpack a palette block into a list of [r, g, b] lists."""
+
+        if numpy is not None and isinstance(block, numpy.ndarray):
+            return block.tolist()
+        return [list(c) for c in block]
+
+    def parse_palette (self, colors, fmt=None):
+        """Parse color strings into a palette block.
+
+        colors is a sequence of strings, or one string of colors separated
+        by ':' as gnome-terminal stores them.  fmt may be '24', '48' or
+        '24dec' to accept only that format, as parse24, parse48 and
+        parse24dec do; by default, either hex width is accepted like
+        parsehex."""
+
+        if isinstance(colors, basestring):
+            colors = colors.split(':')
+        block = None
+        if (fmt in self._hex_widths and len(colors) >= NUMPY_MIN_COLORS and
+            load_numpy() is not None):
+            block = self._np_parse_palette(colors, fmt)
+        if block is None:
+            fn = dict(zip([None, '24', '48', '24dec'],
+                          [self.parsehex, self.parse24, self.parse48,
+                           self.parse24dec]))[fmt]
+            block = [fn(c) for c in colors]
+        return block
+
+    def format_palette (self, block, fmt='48'):
+        """Format a palette block as a list of strings.
+
+        fmt is one of '24', '48' or '24dec', for the to24, to48 and to24dec
+        formats, respectively."""
+
+        if numpy is not None or len(block) >= NUMPY_MIN_COLORS:
+            block = self.palette_block(block)
+            if numpy is not None and isinstance(block, numpy.ndarray):
+                if fmt == '24dec':
+                    return ["%d,%d,%d" % tuple(c)
+                            for c in (block >> 8).tolist()]
+                return self._np_format_hex(block, fmt)
+        fn = dict(zip(['24', '48', '24dec'],
+                      [self.to24, self.to48, self.to24dec]))[fmt]
+        return [fn(c) for c in block]
+
+    def _np_parse_palette (self, colors, fmt):
+        n = len(colors)
+        if not n:
+            return None
+        widths = set([len(c) for c in colors])
+        if len(widths) != 1: # mixed widths; let the scalar parser judge
+            return None
+        width = widths.pop()
+        if width not in self._hex_widths[fmt]:
+            return None
+        try:
+            raw = ''.join(colors).encode('ascii')
+        except (TypeError, UnicodeError):
+            return None
+
+        a = numpy.frombuffer(raw, dtype=numpy.uint8).reshape(n, width)
+        if width % 2:
+            if (a[:, 0] != ord('#')).any():
+                return None
+            a = a[:, 1:]
+        nibbles = _HEX_VALUES[a]
+        if (nibbles > 15).any():
+            return None
+
+        digits = (width // 6) * 2
+        nibbles = nibbles.reshape(n, 3, digits).astype(numpy.uint16)
+        block = numpy.zeros((n, 3), dtype=numpy.uint16)
+        for i in range(digits):
+            block = (block << 4) | nibbles[:, :, i]
+        if digits == 2:
+            block *= 257 # same as _double
+        return block
+
+    def _np_format_hex (self, block, fmt):
+        n = len(block)
+        if fmt == '24':
+            shifts = numpy.array([12, 8], dtype=numpy.uint16)
+        else:
+            shifts = numpy.array([12, 8, 4, 0], dtype=numpy.uint16)
+        nibbles = (block[:, :, None] >> shifts) & 15
+        chars = numpy.empty((n, 1 + 3 * len(shifts)), dtype=numpy.uint8)
+        chars[:, 0] = ord('#')
+        chars[:, 1:] = _HEX_DIGITS[nibbles.reshape(n, -1)]
+        width = chars.shape[1]
+        raw = chars.tostring()
+        return [raw[i:i+width] for i in xrange(0, len(raw), width)]
+    #}}}
+
 color = _ColorParser()
 
 #}}}
@@ -206,9 +457,12 @@ class _ThemeFileVersion (object):
     # parser_func, marshaller_func/None, comment_func/None, type shorthand.
     # The type shorthand is only useful for upgrade_colors right now.
     _keytable = None
+    # color types and their _ColorParser.format_palette formats
+    _palette_formats = {'c48': '48', 'c24': '24'}
     _readonly = None
     _files = None
     _fns = None
+    _parsers = None # key => parser_func, built by parsers()
 
     def __init__ (self, other=None):
         self._keytable = other._keytable.copy() if other else {}
@@ -225,6 +479,7 @@ class _ThemeFileVersion (object):
     def _add (self, iterable, typename):
         for k in iterable:
             self._keytable[k] = typename
+        self._parsers = None
 
     def set_readonly (self, iterable):
         for k in iterable:
@@ -252,6 +507,7 @@ class _ThemeFileVersion (object):
         for k, v in self._keytable.items():
             if v == 'c24':
                 self._keytable[k] = 'c48'
+        self._parsers = None
 
     def add_archive_files (self, mapping):
         self._files.update(mapping)
@@ -272,16 +528,72 @@ class _ThemeFileVersion (object):
             return True
         return False
 
+    def parsers (self):
+        """Return a dict of each key's parse function."""
+
+        if self._parsers is None:
+            self._parsers = dict((k, self._fns[t][0])
+                                 for k, t in self._keytable.items())
+        return self._parsers
+
     def parse_value (self, k, v):
-        typename = self._keytable[k]
-        parse_fn = self._fns[typename][0]
-        return parse_fn(v)
+        return self.parsers()[k](v)
 
     def marshal_value (self, k, v):
         typename = self._keytable[k]
         marshal_fn = self._fns[typename][1]
         return marshal_fn(v)
 
+    def marshal_items (self, items, cache=None):
+        """Marshal and comment a list of (key, value) pairs.
+
+        Returns a list of (key, comment or None, marshalled value) in the
+        same order.  Colors of each type are converted as one palette
+        (which, at 22 colors or fewer, is too small for NumPy).
+
+        cache is an optional dict to share between calls for the same
+        values, such as when writing one profile in several versions.  Each
+        key is then marshalled once per type, and a 24-bit color is cut
+        from its 48-bit form, comment and all, if that is in the cache."""
+
+        if cache is None:
+            cache = {}
+        rv = [None] * len(items)
+        batches = {}
+        for i, (k, v) in enumerate(items):
+            typename = self._keytable[k]
+            hit = cache.get((typename, k))
+            if hit is None and typename == 'c24':
+                hit = self._cut24(cache.get(('c48', k)))
+            if hit is not None:
+                rv[i] = cache[(typename, k)] = hit
+            elif typename in self._palette_formats:
+                batches.setdefault(typename, []).append(i)
+            else:
+                rv[i] = cache[(typename, k)] = (k, self.comment_value(k, v),
+                                                self.marshal_value(k, v))
+
+        for typename, indexes in batches.items():
+            block = color.palette_block([items[i][1] for i in indexes])
+            values = color.format_palette(block,
+                                          self._palette_formats[typename])
+            comments = color.format_palette(block, '24dec')
+            for i, v, comment in zip(indexes, values, comments):
+                k = items[i][0]
+                rv[i] = cache[(typename, k)] = (k, '; %s\n' % comment, v)
+        return rv
+
+    def _cut24 (self, marshalled48):
+        """Turn a marshalled c48 entry into the c24 one, or None."""
+
+        if marshalled48 is None:
+            return None
+        k, comment, v = marshalled48
+        # to24 takes the high byte of each channel: the first two digits
+        if len(v) != 13 or '-' in v:
+            return None
+        return (k, comment, '#' + v[1:3] + v[5:7] + v[9:11])
+
     def comment_value (self, k, v):
         typename = self._keytable[k]
         comment_fn = self._fns[typename][2]
@@ -332,22 +644,176 @@ v1_2.add_archive_files(dict(credits="credits.txt"))
 v1.set_readonly("fgbold use_fgbold".split())
 
 _versions = [('1_2', v1_2), ('1', v1)]
+for _ver, _spec in _versions:
+    _spec.parsers() # build the parse tables now, once
+del v1, v1_2, _ver, _spec
+
+def version_key (ver):
+    """Convert a termitheme version like '1.2' to its key, like '1_2'.
+
+    Raises ValueError if ver can't be parsed."""
+
+    mv = "%.1f" % float(ver)
+    return mv.replace(".", "_").rstrip("_0")
+
+
+#{{{ Single-section theme.ini reader
+# A theme.ini has one section per version, and only the newest one is read,
+# so there's no need to build a ConfigParser of all of them.  _scan_theme_ini
+# follows RawConfigParser's rules exactly for the usual kinds of line, and
+# gives up (returns None) on anything else: continuation lines, a DEFAULT
+# section, lines ConfigParser would reject, or no Termitheme section at
+# all.  Callers then fall back to ConfigParser, which produces the same
+# result or raises the same error.
+
+_SECTION_RE = re.compile(r'\[([^]]+)\]') # as ConfigParser.SECTCRE
+_section_rank = dict(('Termitheme' + ver, i)
+                     for i, (ver, spec) in enumerate(_versions))
+
+def _scan_theme_ini (text):
+    """Return (spec, keys, values) for the newest section in text, or None.
+
+    keys lists the section's option names in order of first appearance,
+    and values maps them to their (last) raw values."""
+
+    sections = {} # rank in _versions => (keys, values)
+    cur = None # (keys, values) for a Termitheme section, False for others
+    for line in text.split('\n'):
+        if not line.strip() or line[0] in '#;':
+            continue
+        elif line[0] in 'rR' and line.split(None, 1)[0].lower() == 'rem':
+            continue
+        elif line[0].isspace():
+            return None # a continuation line, or an error
+
+        m = _SECTION_RE.match(line)
+        if m:
+            header = m.group(1)
+            if header == 'DEFAULT':
+                return None
+            rank = _section_rank.get(header)
+            if rank is None:
+                cur = False
+            else:
+                cur = sections.setdefault(rank, ([], {}))
+            continue
+        elif cur is None:
+            return None # no section header yet
+
+        # "option = value" or "option: value", split at the first of either
+        i = line.find('=')
+        j = line.find(':')
+        if i < 0 or 0 <= j < i:
+            i = j
+        if i <= 0:
+            return None
+        elif cur is False:
+            continue
+        k = line[:i].rstrip().lower()
+        v = line[i + 1:].lstrip(_RE_SPACE)
+        pos = v.find(';') # a comment, if it follows a space
+        if pos != -1 and v[pos - 1].isspace():
+            v = v[:pos]
+        v = v.strip()
+        if v == '""':
+            v = ''
+        keys, values = cur
+        if k not in values:
+            keys.append(k)
+        values[k] = v
+
+    if not sections:
+        return None
+    rank = min(sections)
+    keys, values = sections[rank]
+    return (_versions[rank][1], keys, values)
 
-del v1, v1_2
+#}}}
 
 
 class ThemeFile (object):
     filename = None
+    fileobj = None
     version = None
 
     def __init__ (self, filename, profile_class=None):
-        self.filename = sys_filename(filename)
+        """filename is the path of the theme file, or a seekable file
+        object to read it from or write it to (which stays open)."""
+
+        if hasattr(filename, 'read') or hasattr(filename, 'write'):
+            self.fileobj = filename
+        else:
+            self.filename = sys_filename(filename)
         if not profile_class:
             profile_class = TerminalProfile
         self._profile_ctor = profile_class
 
         self._files = dict()
         self._min_version = _versions[-1][0]
+        self._zf = None # open archive, if any
+        self._members = None # names in the open archive
+
+    #{{{ Archive handle
+    # Within a `with themefile:` block (or between open and close), every
+    # read shares one open archive.  Outside of one, each read opens and
+    # closes the archive by itself.
+
+    def __enter__ (self):
+        self.open()
+        return self
+
+    def __exit__ (self, *exc_info):
+        self.close()
+
+    def open (self):
+        """Open the archive for reading until close()."""
+
+        if self._zf is None:
+            import zipfile
+            source = self.filename if self.fileobj is None else self.fileobj
+            self._zf = zipfile.ZipFile(source, 'r') # can raise IOError
+            self._members = set(self._zf.namelist())
+
+    def close (self):
+        """Close the archive opened by open(), if any."""
+
+        if self._zf is not None:
+            self._zf.close()
+            self._zf = self._members = None
+
+    def members (self):
+        """Return the sorted names of all files in the archive."""
+
+        with self._archive():
+            return sorted(self._members)
+
+    def has_member (self, name):
+        """Return whether the archive contains the file name."""
+
+        with self._archive():
+            return name in self._members
+
+    def read_member (self, name):
+        """Return the raw contents of file name, or None if it is missing."""
+
+        with self._archive() as zf:
+            if name not in self._members:
+                return None
+            return zf.read(name)
+
+    @contextmanager
+    def _archive (self):
+        """Give the open archive to a block, opening it there if need be."""
+
+        if self._zf is not None:
+            yield self._zf
+            return
+        self.open()
+        try:
+            yield self._zf
+        finally:
+            self.close()
+    #}}}
 
     def _get_min_version (self):
         return self._min_version
@@ -355,9 +821,7 @@ class ThemeFile (object):
         if not min_ver:
             self._min_version = _versions[-1][0]
         else:
-            mv = "%.1f" % float(min_ver)
-            mv = mv.replace(".", "_").rstrip("_0")
-            self._min_version = mv
+            self._min_version = version_key(min_ver)
             return
     min_version = property(_get_min_version, _set_min_version)
 
@@ -375,40 +839,66 @@ class ThemeFile (object):
             self._files['credits'] = self._get_file('credits')
         return self._files['credits']
 
+    def set_credits_text (self, text):
+        """Use the unicode text as the credits, instead of a file's."""
+
+        self._files['credits'] = text
+
+    @classmethod
+    def from_bytes (cls, data, profile_class=None):
+        """Return a ThemeFile reading the archive held in the string data."""
+
+        import cStringIO
+        return cls(cStringIO.StringIO(data), profile_class)
+
     def read_ini (self, src_filename):
-        """Read a theme from an INI file (not a termitheme zip)."""
+        """Read a theme from an INI file (not a termitheme zip), given
+        its path or a file object."""
 
-        cp = ConfigParser.SafeConfigParser()
-        cp.read(src_filename)
-        return self.read_profile(cp)
+        text = None
+        if hasattr(src_filename, 'read'):
+            text = src_filename.read()
+            profile = self._read_text(text, True)
+        else:
+            try:
+                with open(src_filename) as f:
+                    profile = self._read_text(f.read(), True)
+            except IOError:
+                profile = None
+        if profile is None:
+            import ConfigParser
+            cp = ConfigParser.SafeConfigParser()
+            if text is None:
+                cp.read(src_filename)
+            else:
+                import StringIO
+                cp.readfp(StringIO.StringIO(text))
+            profile = self.read_profile(cp)
+        return profile
 
     def _read_fs (self, filename):
         """Read a file from the filesystem in native encoding."""
 
+        import codecs
         with codecs.open(sys_filename(filename), 'r', CHARSET) as f:
             return f.read()
 
     def _get_file (self, key):
-        """Read a file from the zip archive at self.filename."""
+        """Read a file from the theme's zip archive."""
 
+        import zipfile
         try:
-            zf = zipfile.ZipFile(self.filename, 'r')
-        except:
+            with self._archive():
+                for ver, spec in _versions:
+                    if not spec.has_archive_file(key):
+                        # Reached a version that precedes this feature
+                        return None
+                    s = self.read_member(spec.get_archive_file(key))
+                    if s is not None:
+                        return s.decode('utf-8', 'replace')
+        except (IOError, zipfile.BadZipfile):
             return None
 
-        try:
-            for ver, spec in _versions:
-                if not spec.has_archive_file(key):
-                    # Reached a version that precedes this feature
-                    return None
-                try:
-                    s = zf.read(spec.get_archive_file(key))
-                    return s.decode('utf-8', 'replace')
-                except:
-                    pass
-        finally:
-            zf.close()
-
         # All versions supported it, but it still wasn't found
         return None
     #}}}
@@ -417,19 +907,25 @@ class ThemeFile (object):
         """Return a ConfigParser associated with the theme file."""
 
         # Open zipfile and validate expected theme.ini file found
-        zf = zipfile.ZipFile(self.filename, 'r') # can raise IOError
-        # Python2.5 doesn't have ZipFile.open(), and ConfigParser doesn't
-        # have any way to read directly from a string.
-        fp = StringIO.StringIO(zf.read('theme.ini')) # can raise KeyError
-        zf.close()
+        with self._archive() as zf: # can raise IOError
+            text = zf.read('theme.ini') # can raise KeyError
+        return self._parser(text)
+
+    def _parser (self, text):
+        """Return a RawConfigParser of theme.ini text."""
 
+        import ConfigParser
+        import StringIO
+        # Python2.5 doesn't have ZipFile.open(), and ConfigParser
+        # doesn't have any way to read directly from a string.
         cp = ConfigParser.RawConfigParser()
-        cp.readfp(fp)
+        cp.readfp(StringIO.StringIO(text))
         return cp
 
     def read_profile (self, parser):
         """Populate a profile with the data from the parser."""
 
+        import ConfigParser
         profile_class = self._profile_ctor
         section = None
         for v in _versions:
@@ -458,23 +954,68 @@ class ThemeFile (object):
         return p
 
     def read (self):
-        """Read the theme file in self.filename and return a profile."""
-        return self.read_profile(self.read_open())
+        """Read the theme file and return a profile."""
 
-    def write (self, profile, force=False):
-        """Write the profile into self.filename."""
+        with self._archive() as zf: # can raise IOError
+            text = zf.read('theme.ini') # can raise KeyError
+        profile = self._read_text(text)
+        if profile is None:
+            profile = self.read_profile(self._parser(text))
+        return profile
 
-        datasets = []
-        for ver, spec in _versions:
-            datasets.append(self._format_version(profile, ver, spec))
-            if self._min_version and ver <= self._min_version:
-                break
-        data = '\n'.join(datasets)
-        spec = _versions[0][1]
+    def _read_text (self, text, interpolate=False):
+        """Read a profile from theme.ini text without ConfigParser.
+
+        Returns None if ConfigParser is needed after all; see
+        _scan_theme_ini.  If interpolate is true, that includes values
+        SafeConfigParser would interpolate."""
+
+        scanned = _scan_theme_ini(text)
+        if scanned is None:
+            return None
+        spec, keys, values = scanned
+        if interpolate and any('%' in v for v in values.itervalues()):
+            return None
+        elif 'name' not in values:
+            raise KeyError("Theme file does not have a 'name' key.")
+
+        parsers = spec.parsers()
+        p = self._profile_ctor(parsers['name'](values['name']))
+        for k in keys:
+            if k == 'name' or k == '__name__': # special keys
+                continue
+            try:
+                p[k] = parsers[k](values[k])
+            except KeyError:
+                pass
+        return p
 
+    def write (self, profile, force=False):
+        """Write the profile into self.filename, or self.fileobj."""
+
+        if self.fileobj is not None:
+            self._write_zip(self.fileobj, profile)
+            return
         if os.path.exists(self.filename) and not force:
             raise ValueError("File '%s' exists." % self.filename)
-        zf = zipfile.ZipFile(self.filename, 'w', zipfile.ZIP_DEFLATED)
+        self._write_zip(self.filename, profile)
+
+    def to_bytes (self, profile):
+        """Return the theme file for profile as a string."""
+
+        import cStringIO
+        buf = cStringIO.StringIO()
+        self._write_zip(buf, profile)
+        return buf.getvalue()
+
+    def _write_zip (self, target, profile):
+        """Write the archive for profile to target, a path or file object."""
+
+        data = self._format(profile)
+        spec = _versions[0][1]
+
+        import zipfile
+        zf = zipfile.ZipFile(target, 'w', zipfile.ZIP_DEFLATED)
         # main theme
         zf.writestr(self._zipinfo('theme.ini'), data.encode('utf-8'))
         for key, content in self._files.items(): # other archive files
@@ -483,18 +1024,39 @@ class ThemeFile (object):
             zf.writestr(self._zipinfo(name), content.encode('utf-8'))
         zf.close()
 
-    def _format_version (self, profile, ver, m):
-        lines = ["[Termitheme%s]\n" % ver, "name = %s\n" % profile.name]
-        for k,v in sorted(profile.items()):
-            if not m.writable_key(k):
-                continue
-            comment = m.comment_value(k, v)
+    def _format (self, profile):
+        """Return the theme.ini text for profile, down to min_version.
+
+        Values are sorted once, and marshalled once per type, for all of
+        the versions."""
+
+        items = sorted(profile.items())
+        cache = {}
+        lines = []
+        for ver, spec in _versions:
+            if lines:
+                lines.append('\n')
+            self._format_lines(profile, ver, spec, items, cache, lines)
+            if self._min_version and ver <= self._min_version:
+                break
+        return ''.join(lines)
+
+    def _format_lines (self, profile, ver, m, items, cache, lines):
+        """Append version ver's section for profile to lines.
+
+        items are profile's sorted items; cache is for marshal_items."""
+
+        lines.append("[Termitheme%s]\n" % ver)
+        lines.append("name = %s\n" % profile.name)
+        items = [(k, v) for k, v in items if m.writable_key(k)]
+        for k, comment, v in m.marshal_items(items, cache):
             if comment:
                 lines.append(comment)
-            lines.append("%s = %s\n" % (k, m.marshal_value(k, v)))
-        return ''.join(lines)
+            lines.append("%s = %s\n" % (k, v))
 
     def _zipinfo (self, filename):
+        import datetime
+        import zipfile
         info = zipfile.ZipInfo()
         info.filename = filename
         # No mtime_utc for credits.txt: the stat result is os-dependent.
@@ -552,20 +1114,35 @@ class TerminalProfile (dict):
             self._io_data[slave_name] = {}
         yield self._io_data[slave_name]
 
+    def ioslave_names (self):
+        """Return the names of the slaves that have private data."""
+        return sorted(self._io_data)
+
     #{{{ Dictionary interface
     def update (self, other):
         """Copy other's dictionary keys and ioslave data into self."""
 
-        if not isinstance(other, TerminalProfile):
+        if not isinstance(other, (TerminalProfile, CompactTerminalProfile)):
             raise TypeError("update requires a TerminalProfile")
         # Copy private data
-        for k in other._io_data.keys():
+        for k in (other._io_data or {}).keys():
             if k in self._io_data:
                 self._io_data[k].update(other._io_data[k])
             else:
                 self._io_data[k] = other._io_data[k]
         return dict.update(self, other)
 
+    def copy (self):
+        """Return a new profile with the same keys and ioslave data.
+
+        The private dicts are copied, so updating the copy leaves self alone."""
+
+        p = self.__class__(self.name)
+        dict.update(p, self)
+        for k, v in self._io_data.items():
+            p._io_data[k] = v.copy()
+        return p
+
     def __getitem__ (self, k):
         if k not in self._valid_keys:
             raise KeyError(self._bad_key(k))
@@ -588,6 +1165,139 @@ class TerminalProfile (dict):
     def _bad_key (self, k):
         return "Key '%s' is not a valid TerminalProfile key." % k
 
+
+_interned_colors = {}
+
+def intern_color (v):
+    """Return a shared tuple equal to the color v."""
+    t = tuple(v)
+    return _interned_colors.setdefault(t, t)
+
+_missing = object() # marks unset keys in CompactTerminalProfile
+
+class CompactTerminalProfile (object):
+    """Generic terminal theme, stored compactly.
+
+    This can stand in for TerminalProfile (e.g. as the profile_class of a
+    ThemeFile) when thousands of profiles are kept in memory.  Values live
+    in a fixed-size list indexed by key, and colors become shared tuples
+    from intern_color, so a profile costs a few hundred bytes.  Setting
+    any value that is not a color works like it does on TerminalProfile."""
+
+    __slots__ = ('name', '_values', '_io_data')
+
+    PROFILE_KEY_NAMES = TerminalProfile.PROFILE_KEY_NAMES
+    _index = dict((k, i) for i, k in enumerate(PROFILE_KEY_NAMES))
+
+    def __init__ (self, name):
+        self.name = name
+        self._values = [_missing] * len(self.PROFILE_KEY_NAMES)
+        self._io_data = None # created by ioslave when needed
+
+    def is_valid_key (self, k):
+        """Return True if k is a TerminalProfile key."""
+        return k in self._index
+
+    @contextmanager
+    def ioslave (self, slave_name):
+        """Give a reference to a slave-private dict to a block.
+
+        See TerminalProfile.ioslave."""
+        if self._io_data is None:
+            self._io_data = {}
+        if slave_name not in self._io_data:
+            self._io_data[slave_name] = {}
+        yield self._io_data[slave_name]
+
+    def ioslave_names (self):
+        """Return the names of the slaves that have private data."""
+        return sorted(self._io_data or ())
+
+    #{{{ Dictionary interface
+    def update (self, other):
+        """Copy other's dictionary keys and ioslave data into self."""
+
+        if not isinstance(other, (TerminalProfile, CompactTerminalProfile)):
+            raise TypeError("update requires a TerminalProfile")
+        for k, v in (other._io_data or {}).items():
+            with self.ioslave(k) as private_data:
+                private_data.update(v)
+        for k, v in other.items():
+            self[k] = v
+
+    def copy (self):
+        """Return a new profile with the same keys and ioslave data."""
+
+        p = self.__class__(self.name)
+        p._values[:] = self._values
+        for k, v in (self._io_data or {}).items():
+            with p.ioslave(k) as private_data:
+                private_data.update(v)
+        return p
+
+    def __getitem__ (self, k):
+        v = self._values[self._key_index(k)]
+        if v is _missing:
+            raise KeyError(k)
+        return v
+
+    def __setitem__ (self, k, v):
+        i = self._key_index(k)
+        if color.is_color(v):
+            v = intern_color(v)
+        self._values[i] = v
+
+    def __delitem__ (self, k):
+        i = self._key_index(k)
+        if self._values[i] is _missing:
+            raise KeyError(k)
+        self._values[i] = _missing
+
+    def __contains__ (self, k):
+        i = self._index.get(k)
+        return i is not None and self._values[i] is not _missing
+
+    has_key = __contains__
+
+    def __len__ (self):
+        return len(self._values) - self._values.count(_missing)
+
+    def __iter__ (self):
+        return iter(self.keys())
+
+    def get (self, k, default=None):
+        try:
+            return self[k]
+        except KeyError:
+            return default
+
+    def keys (self):
+        return [k for k, v in zip(self.PROFILE_KEY_NAMES, self._values)
+                if v is not _missing]
+
+    def values (self):
+        return [v for v in self._values if v is not _missing]
+
+    def items (self):
+        return [(k, v) for k, v in zip(self.PROFILE_KEY_NAMES, self._values)
+                if v is not _missing]
+
+    iterkeys = __iter__
+    def itervalues (self):
+        return iter(self.values())
+    def iteritems (self):
+        return iter(self.items())
+    #}}}
+
+    def __str__ (self):
+        return "<CompactTerminalProfile %s>" % self.name
+
+    def _key_index (self, k):
+        try:
+            return self._index[k]
+        except KeyError:
+            raise KeyError("Key '%s' is not a valid TerminalProfile key." % k)
+
 #}}}
 
 
@@ -608,9 +1318,45 @@ class TerminalIOBase (object):
     def read_profile (self, name=None):
         raise NotImplementedError("TerminalIOBase#read_profile")
 
-    def write_profile (self, profile):
+    def write_profile (self, profile, dry_run=False):
+        """Store profile, writing only the values that differ from what is
+        stored already.
+
+        Returns the changes as (key, old value, new value) triples, where
+        old is None if the key is not set yet.  With dry_run, the changes
+        are only planned, not made."""
         raise NotImplementedError("TerminalIOBase#write_profile")
 
+    def dump (self):
+        """Yield every stored profile, private data included."""
+
+        for name in self.profile_names():
+            yield self.read_profile(name)
+
+    def restore (self, profiles, dry_run=False):
+        """Store each of profiles, as write_profile does; return all the
+        changes.  Backends may batch the writes."""
+
+        plan = []
+        for profile in profiles:
+            plan.extend(self.write_profile(profile, dry_run))
+        return plan
+
+    def apply_theme (self, theme, pattern, dry_run=False):
+        """Copy theme's keys into every profile whose name matches the
+        shell-style pattern, and store them as write_profile does.
+
+        Returns (name, changes) for each matching profile."""
+
+        import fnmatch
+        rv = []
+        for name in self.profile_names():
+            if fnmatch.fnmatchcase(name, pattern):
+                p = self.read_profile(name)
+                p.update(theme)
+                rv.append((name, self.write_profile(p, dry_run)))
+        return rv
+
 #}}}
 
 
@@ -648,25 +1394,25 @@ def _gconf_box_primitive (v, gtype=None): #{{{
     # first, all bool and float parameters are converted to int.
     # This may be a Python2-ism
     if isinstance(v, basestring):
-        t = gconf.VALUE_STRING
+        t = _gconf_values.VALUE_STRING
         if isinstance(v, unicode):
             v = v.encode('utf-8')
     elif isinstance(v, bool):
-        t = gconf.VALUE_BOOL
+        t = _gconf_values.VALUE_BOOL
     elif isinstance(v, float):
-        t = gconf.VALUE_FLOAT
+        t = _gconf_values.VALUE_FLOAT
     elif isinstance(v, int):
         # bounds check (handles 64-bit ints and int/long unification)
         if v >= 2**31 or v < -2**31:
             raise ValueError("Integer out of range for gconf")
-        t = gconf.VALUE_INT
+        t = _gconf_values.VALUE_INT
     else:
         raise TypeError("Invalid type for primitive GConfValue: %s" % type(v))
 
-    if gtype and gv.type != gtype:
-        raise TypeError("List type mismatch: %s is not %s" % (gv.type, gtype))
+    if gtype and t != gtype:
+        raise TypeError("List type mismatch: %s is not %s" % (t, gtype))
 
-    gv = gconf.Value(t)
+    gv = _gconf_values.Value(t)
     m = getattr(gv, 'set_' + gv.type.value_nick)
     m(v)
     return gv
@@ -701,25 +1447,89 @@ def gconf_box (v, is_pair=False): #{{{
     if is_pair:
         if len(v) != 2:
             raise ValueError("Pair value is not actually a pair of items.")
-        gv = gconf.Value(gconf.VALUE_PAIR)
+        gv = _gconf_values.Value(_gconf_values.VALUE_PAIR)
         gv.set_car(_gconf_box_primitive(v[0]))
         gv.set_cdr(_gconf_box_primitive(v[1]))
     elif isinstance(v, (list, tuple)):
         # This boxes v[0] twice, but it is way easier.
         v0 = _gconf_box_primitive(v[0])
-        gv = gconf.Value(gconf.VALUE_LIST)
+        gv = _gconf_values.Value(_gconf_values.VALUE_LIST)
         gv.set_list_type(v0.type)
         gv.set_list([_gconf_box_primitive(i, v0.type) for i in v])
     else:
         gv = _gconf_box_primitive(v)
     return gv
     #}}}
+
+#{{{ Stand-ins for the gconf module's values and change sets
+# gconf_box/gconf_unbox use these when the bindings aren't installed, so
+# that MockGConf and friends work anywhere.
+
+class _StandInValueType (object):
+    def __init__ (self, nick):
+        self.value_nick = nick
+
+    def __repr__ (self):
+        return "<GConfValueType %s>" % self.value_nick
+
+class _StandInValue (object):
+    """Look-alike of gconf.Value: get_TYPE/set_TYPE for each type nick."""
+
+    _fields = set(['string', 'bool', 'int', 'float', 'list', 'list_type',
+                   'car', 'cdr'])
+
+    def __init__ (self, vtype):
+        self.type = vtype
+        self._data = {}
+
+    def __getattr__ (self, name):
+        op, sep, field = name.partition('_')
+        if field not in self._fields or op not in ('get', 'set'):
+            raise AttributeError(name)
+        elif op == 'get':
+            return lambda: self._data.get(field)
+        return lambda v: self._data.__setitem__(field, v)
+
+class _StandInGConf (object):
+    """The parts of the gconf module used for boxing values."""
+
+    VALUE_STRING = _StandInValueType('string')
+    VALUE_BOOL = _StandInValueType('bool')
+    VALUE_INT = _StandInValueType('int')
+    VALUE_FLOAT = _StandInValueType('float')
+    VALUE_LIST = _StandInValueType('list')
+    VALUE_PAIR = _StandInValueType('pair')
+    Value = _StandInValue
+
+_gconf_values = _StandInGConf # until load_gconf() finds the real module
+
+class _StandInChangeSet (object):
+    """Look-alike of gconf.ChangeSet: pending writes, last one wins."""
+
+    def __init__ (self):
+        self._keys = []
+        self._values = {}
+
+    def set (self, k, v):
+        if k not in self._values:
+            self._keys.append(k)
+        self._values[k] = v
+
+    def size (self):
+        return len(self._keys)
+
+    def items (self):
+        """Return the (key, gconf value) pairs in the order first set."""
+        return [(k, self._values[k]) for k in self._keys]
+#}}}
 #}}}
 
 
 #{{{ Gnome-terminal
 
 class MockGConf (object):
+    ChangeSet = _StandInChangeSet # see GnomeTerminalIO._new_change_set
+
     def set (self, k, v):
         self._print(k, gconf_unbox(v))
     def set_string (self, k, v):
@@ -730,9 +1540,108 @@ class MockGConf (object):
         self._print(k, v)
     def set_int (self, k, v):
         self._print(k, v)
+    def set_list (self, k, list_type, v):
+        self._print(k, v)
+    def commit_change_set (self, cs, remove_committed):
+        for k, v in cs.items():
+            self.set(k, v)
     def _print (self, k, v):
         print "SET: %s = %s" % (k, repr(v))
 
+class RecordingGConf (MockGConf):
+    """MockGConf that records writes and counts round-trips to gconfd.
+
+    Every client call counts as one round-trip, including a change set
+    commit, which is also counted in commits.  Values written can be read
+    back with get_string and get_list, so GnomeTerminalIO can create
+    profiles on it."""
+
+    def __init__ (self):
+        self.writes = [] # (key, Python value), in order
+        self.values = {}
+        self.calls = 0
+        self.commits = 0
+
+    def get_list (self, k, list_type):
+        self._call()
+        return list(self.values.get(k, []))
+
+    def get_string (self, k):
+        self._call()
+        v = self.values.get(k)
+        return v.encode('utf-8') if isinstance(v, unicode) else v
+
+    def dir_exists (self, d):
+        self._call()
+        prefix = d + '/'
+        return any(k.startswith(prefix) for k in self.values)
+
+    def commit_change_set (self, cs, remove_committed):
+        self._call()
+        self.commits += 1
+        for k, v in cs.items():
+            self._record(k, gconf_unbox(v))
+
+    def _print (self, k, v):
+        self._call()
+        self._record(k, v)
+
+    def _call (self):
+        self.calls += 1
+
+    def _record (self, k, v):
+        self.writes.append((k, v))
+        self.values[k] = v
+
+class _StandInEntry (object):
+    """Look-alike of gconf.Entry, as returned by all_entries."""
+
+    def __init__ (self, key, value):
+        self._key = key
+        self._value = value
+
+    def get_key (self):
+        return self._key
+
+    def get_value (self):
+        return self._value
+
+class InMemoryGConf (RecordingGConf):
+    """A gconf client that keeps everything in memory.
+
+    It implements every client call GnomeTerminalIO makes, so profiles can
+    be read, written and timed without gconfd.  If latency is given, each
+    call sleeps that many seconds, to model the cost of a round-trip to
+    a real gconfd."""
+
+    def __init__ (self, latency=0):
+        RecordingGConf.__init__(self)
+        self.latency = latency
+        self._entries = {} # dir => set of keys directly in it
+
+    def dir_exists (self, d):
+        self._call()
+        return d in self._entries
+
+    def all_entries (self, d):
+        self._call()
+        return [_StandInEntry(k, gconf_box(self.values[k]))
+                for k in sorted(self._entries.get(d, ()))]
+
+    def _call (self):
+        RecordingGConf._call(self)
+        if self.latency:
+            time.sleep(self.latency)
+
+    def _record (self, k, v):
+        RecordingGConf._record(self, k, v)
+        d = k[:k.rfind('/')]
+        self._entries.setdefault(d, set()).add(k)
+        # parents exist as long as something is under them
+        while d.count('/') > 1:
+            d = d[:d.rfind('/')]
+            self._entries.setdefault(d, set())
+
 class GnomeTerminalIO (TerminalIOBase):
     """GConf backend reader/writer for gnome-terminal."""
 
@@ -757,6 +1666,9 @@ class GnomeTerminalIO (TerminalIOBase):
     STD_KEYS = [('use_theme_colors', False)]
 
     _slavename = 'gnome-terminal' # given to profile.ioslave(...)
+    # private data naming the profile dir a dumped profile came from; no
+    # gconf key can start with '.', so it never clashes with a setting
+    _DIR_KEY = '.dir'
 
     def __init__ (self, gconf_client=None): #{{{
         # initialize parent
@@ -768,58 +1680,122 @@ class GnomeTerminalIO (TerminalIOBase):
             if v is None:
                 self.THEME_KEYS[k] = k
 
-        # initialize gconf
+        # initialize gconf; a given client still needs real gconf values
+        load_gconf()
         c = gconf_client if gconf_client else gconf.client_get_default()
         self._gconf = c
 
-        # initialize visible-name => gconf-profile-root-path mapping
-        # and record the maximum Profile## that we see
-        path = {}
-        max_prof = None
-        for dir in c.get_list(self.PROFILE_LIST, gconf.VALUE_STRING):
-            name = c.get_string(self.PROFILE_ROOT + '/' + dir +
-                                self.PROFILE_NAME).decode('utf-8')
-            path[name] = self.PROFILE_ROOT + '/' + dir + '/'
-            if name.startswith("Profile"):
-                if not max_prof or int(name[7:]) > max_prof:
-                    max_prof = int(name[7:])
-        self._path_of = path
-        self._max_profile = max_prof if max_prof else -1
+        # visible-name <=> profile dir mappings, filled in on demand
+        self._dirs = None # profile_list contents
+        self._next_dir = 0 # index of the first dir not yet resolved
+        self._path_of = {} # visible name => gconf profile root path
+        self._name_of = {} # profile dir => visible name
         #}}}
 
     def profile_names (self):
         """Return a list of all defined profile names."""
+        self._resolve()
         return self._path_of.keys()
 
     def profile_exists (self, name):
         """Return whether the named profile exists."""
-        return name in self._path_of
+        return self._path_for(name) is not None
 
     def read_profile (self, name=None): # {{{
         """Read the given profile, or the default one if no name is given."""
 
         if name is None:
             name = self._get_default_name()
-        p = self._profile_ctor(name)
 
-        if name not in self._path_of:
+        path = self._path_for(name)
+        if path is None:
             raise KeyError("No profile named '%s' exists." % name)
 
         c = self._gconf
-        path = self._path_of[name]
 
         if not c.dir_exists(path[:-1]):
             raise ValueError("Profile named '%s' has no gconf tree at %s." %
                              (name, path))
+        return self._build_profile(name, c.all_entries(path[:-1]))
+        #}}}
+
+    def write_profile (self, profile, dry_run=False): #{{{
+        """Write the profile to gconf; see TerminalIOBase.write_profile."""
+
+        changes = _StandInChangeSet()
+        stored = {}
+        dir, is_new = self._stage(profile, changes, stored, set())
+        new = [(profile.name, dir)] if is_new else []
+        self._stage_profile_list([d for n, d in new], changes, stored)
+        plan = self._diff(changes, stored)
+        if not dry_run:
+            self._apply(plan, new)
+        return plan
+        #}}}
+
+    def dump (self): #{{{
+        """Yield every profile in the profile list.
+
+        Each profile dir is read with one all_entries call, which also
+        gives its visible name, so names are not resolved separately.
+        The dir is kept in the profile's private data, so that restore
+        can tell apart profiles that share a visible name."""
+
+        c = self._gconf
+        for dir in list(self._profile_dirs()):
+            entries = c.all_entries(self.PROFILE_ROOT + '/' + dir)
+            names = [gconf_unbox(e.get_value()) for e in entries
+                     if self._relative_key(e.get_key()) == 'visible_name']
+            if not names:
+                continue # listed, but it has no tree
+            name = names[0]
+            self._name_of[dir] = name
+            self._path_of.setdefault(name, self.PROFILE_ROOT + '/' + dir + '/')
+            p = self._build_profile(name, entries)
+            with p.ioslave(self._slavename) as private_data:
+                private_data[self._DIR_KEY] = dir
+            yield p
+        #}}}
+
+    def restore (self, profiles, dry_run=False): #{{{
+        """Write all the profiles in one change set; see
+        TerminalIOBase.restore."""
+
+        changes = _StandInChangeSet()
+        stored = {}
+        taken = set()
+        new = []
+        for profile in profiles:
+            # as stored: the theme-enabling defaults are not forced
+            dir, is_new = self._stage(profile, changes, stored, taken, False)
+            if is_new:
+                new.append((profile.name, dir))
+        self._stage_profile_list([d for n, d in new], changes, stored)
+        plan = self._diff(changes, stored)
+        if not dry_run:
+            self._apply(plan, new)
+        return plan
+        #}}}
+
+    #{{{ Reading and writing profile dirs
+    def _build_profile (self, name, entries):
+        """Return a profile named name, from the entries of its dir."""
+
+        p = self._profile_ctor(name)
         # Duplicate ALL gnome-terminal settings so that non-theme settings
         # won't revert to their defaults in write_profile.
         with p.ioslave(self._slavename) as private_data:
             theme = self.THEME_KEYS
-            for e in c.all_entries(path[:-1]):
+            as48 = color.as48
+            for e in entries:
                 k = self._relative_key(e.get_key())
                 v = gconf_unbox(e.get_value())
-                if color.is48(v):
-                    v = color.parse48(v)
+                # most entries are booleans, numbers and short strings,
+                # which can't be colors: don't make a call to find out
+                c48 = (as48(v) if isinstance(v, basestring) and
+                       12 <= len(v) <= 14 else None)
+                if c48 is not None:
+                    v = c48
                 elif k in self.REVERSE_BOOLS:
                     # fix up use_system_font vs. force_font, etc.
                     v = not v
@@ -831,33 +1807,47 @@ class GnomeTerminalIO (TerminalIOBase):
             del private_data['palette']
 
         return p
-        #}}}
 
-    def write_profile (self, profile): #{{{
-        """Write the profile to gconf."""
+    def _stage (self, profile, changes, stored, taken, defaults=True):
+        """Stage all of profile's keys into changes, a key set twice keeping
+        the last value, and read what its dir holds now into stored.
+        With defaults, STD_KEYS are staged too.
 
-        c = self._gconf
-        if profile.name in self._path_of:
+        Returns (dir, is_new).  A profile that dump recorded a dir for
+        goes back to that dir; any other goes to the dir of the profile
+        with its name.  A new profile gets the next unused profile dir
+        that is not in taken, and the dir is added there."""
+
+        with profile.ioslave(self._slavename) as private_data:
+            recorded = private_data.get(self._DIR_KEY)
+        if isinstance(recorded, unicode):
+            recorded = recorded.encode('utf-8') # as read back from JSON
+        if not (isinstance(recorded, str) and recorded and
+                '/' not in recorded):
+            recorded = None
+
+        path = None if recorded else self._path_for(profile.name)
+        if recorded:
+            dir = self.PROFILE_ROOT + '/' + recorded
+            is_new = (recorded not in self._profile_dirs() and
+                      dir not in taken)
+            taken.add(dir)
+            self._read_stored(dir, stored)
+        elif path is not None:
             # Modified profile: save into current path
-            path = self._path_of[profile.name]
             dir = path[:-1]
-            save_path = False
+            is_new = False
+            self._read_stored(dir, stored)
         else:
-            # New profile: get next unused profile number
-            i = self._max_profile + 1
-            dir = self.PROFILE_ROOT + '/Profile' + str(i)
-            while c.dir_exists(dir):
-                i += 1
-                dir = self.PROFILE_ROOT + '/Profile' + str(i)
-            save_path = True
+            dir = self._new_dir(taken)
+            is_new = True
 
-        # Write all our keys to that profile dir
         path = dir + '/'
-        #c=MockGConf()
         # Private keys (copied from default profile)
         with profile.ioslave(self._slavename) as private_data:
             for k, v in private_data.items():
-                c.set(path + k, gconf_box(v))
+                if k != self._DIR_KEY:
+                    changes.set(path + k, gconf_box(v))
         # Common theme keys
         for k, k_prof in self.THEME_KEYS.items():
             if k_prof in profile:
@@ -866,27 +1856,112 @@ class GnomeTerminalIO (TerminalIOBase):
                     val = color.to48(val)
                 elif k in self.REVERSE_BOOLS:
                     val = not val
-                c.set(path + k, gconf_box(val))
+                changes.set(path + k, gconf_box(val))
         # defaults for making the theme take hold (must overwrite ioslave)
-        for k, v in self.STD_KEYS:
-            c.set(path + k, gconf_box(v))
+        if defaults:
+            for k, v in self.STD_KEYS:
+                changes.set(path + k, gconf_box(v))
         # Special keys
-        c.set_string(path + 'palette',
-                     self._get_palette_from_profile(profile))
-        c.set_string(path + 'visible_name', profile.name.encode('utf-8'))
+        changes.set(path + 'palette',
+                    gconf_box(self._get_palette_from_profile(profile)))
+        changes.set(path + 'visible_name', gconf_box(profile.name))
+        return (dir, is_new)
 
-        if isinstance(c, MockGConf):
-            return
+    def _new_dir (self, taken):
+        """Return the next unused profile dir, adding it to taken."""
+
+        c = self._gconf
+        i = self._max_profile() + 1
+        dir = self.PROFILE_ROOT + '/Profile' + str(i)
+        while dir in taken or c.dir_exists(dir):
+            i += 1
+            dir = self.PROFILE_ROOT + '/Profile' + str(i)
+        taken.add(dir)
+        return dir
+
+    def _stage_profile_list (self, new_dirs, changes, stored):
+        """Stage the addition of new_dirs to the profile list, unless the
+        client can't read it (like MockGConf)."""
+
+        c = self._gconf
+        if new_dirs and hasattr(c, 'get_list'):
+            plst = c.get_list(self.PROFILE_LIST, _gconf_values.VALUE_STRING)
+            stored[self.PROFILE_LIST] = plst
+            added = [self._relative_key(d) for d in new_dirs]
+            added = [d for d in added if d not in plst]
+            if added:
+                changes.set(self.PROFILE_LIST, gconf_box(plst + added))
+
+    def _read_stored (self, dir, stored):
+        """Read the values stored in dir into the stored dict, with one
+        all_entries call (if the client has it)."""
+
+        c = self._gconf
+        if hasattr(c, 'all_entries'):
+            for e in c.all_entries(dir):
+                stored[e.get_key()] = gconf_unbox(e.get_value())
+
+    def _diff (self, changes, stored):
+        """Return (key, old, new) for the staged changes whose values
+        differ from those in stored.
 
-        # Add the profile to the profile list
-        if not save_path: # unless this was a modification
+        Values are compared unboxed, so that no gconf call is needed;
+        keys that were not read count as changed."""
+
+        plan = []
+        for k, v in changes.items():
+            new = gconf_unbox(v)
+            if k in stored and stored[k] == new:
+                continue
+            plan.append((k, stored.get(k), new))
+        return plan
+
+    def _apply (self, plan, new):
+        """Commit the planned changes; new lists the (name, dir) of the
+        profiles they create."""
+
+        if plan:
+            changes = _StandInChangeSet()
+            for k, old, v in plan:
+                changes.set(k, gconf_box(v))
+            self._commit(changes)
+
+        # Keep later lookups from this object pointed at the new dirs
+        for name, dir in new:
+            base_dir = self._relative_key(dir)
+            self._profile_dirs().append(base_dir)
+            self._name_of[base_dir] = name
+            self._path_of.setdefault(name, dir + '/')
+    #}}}
+
+    def _new_change_set (self):
+        """Return an empty change set for our client, or None if the client
+        can't commit change sets.
+
+        Stand-in clients name the change set class they take as ChangeSet;
+        real clients take gconf.ChangeSet."""
+
+        c = self._gconf
+        if not hasattr(c, 'commit_change_set'):
+            return None
+        cs_class = getattr(c, 'ChangeSet', None)
+        if cs_class is None:
+            cs_class = getattr(gconf, 'ChangeSet', None)
+        return cs_class() if cs_class else None
+
+    def _commit (self, changes):
+        """Write staged changes to gconf, in one commit if possible."""
+
+        c = self._gconf
+        cs = self._new_change_set()
+        if cs is None: # one round-trip per key
+            for k, v in changes.items():
+                c.set(k, v)
             return
-        plst = c.get_list(self.PROFILE_LIST, gconf.VALUE_STRING)
-        base_dir = self._relative_key(dir)
-        if base_dir not in plst:
-            plst.append(base_dir)
-            c.set_list(self.PROFILE_LIST, gconf.VALUE_STRING, plst)
-        #}}}
+
+        for k, v in changes.items():
+            cs.set(k, v)
+        c.commit_change_set(cs, False)
 
     #{{{ Internal interfaces
     def _relative_key (self, abs_key):
@@ -898,31 +1973,98 @@ class GnomeTerminalIO (TerminalIOBase):
         if def_path is None:
             raise ValueError("Default name not found at %s." %
                              self.DEFAULT_NAME)
-        tail = '/' + def_path + '/'
-        for name, path in self._path_of.items():
-            if path.endswith(tail):
-                return name
-        raise ValueError("Default name does not have a path mapping.")
+        name = self._name_for_dir(def_path)
+        if name is None:
+            raise ValueError("Default name does not have a path mapping.")
+        return name
+
+    #{{{ Profile name resolution
+    # Reading every profile's visible_name up front costs a gconf call per
+    # profile, so names are read only until the one wanted turns up.  What
+    # has been read is kept for the life of this object.
+
+    def _profile_dirs (self):
+        if self._dirs is None:
+            self._dirs = self._gconf.get_list(self.PROFILE_LIST,
+                                              _gconf_values.VALUE_STRING)
+        return self._dirs
+
+    def _path_for (self, name):
+        """Return the profile root path for a visible name, or None."""
+
+        if name not in self._path_of:
+            self._resolve(name)
+        return self._path_of.get(name)
+
+    def _name_for_dir (self, dir):
+        """Return the visible name of a profile dir, or None if the dir is
+        not in the profile list."""
+
+        if dir not in self._name_of:
+            if dir not in self._profile_dirs():
+                return None
+            self._read_name(dir)
+        return self._name_of[dir]
+
+    def _resolve (self, wanted=None):
+        """Read visible names until wanted is found, or all of them."""
+
+        dirs = self._profile_dirs()
+        while self._next_dir < len(dirs):
+            dir = dirs[self._next_dir]
+            self._next_dir += 1
+            if dir not in self._name_of and self._read_name(dir) == wanted:
+                return
+
+    def _read_name (self, dir):
+        name = self._gconf.get_string(self.PROFILE_ROOT + '/' + dir +
+                                      self.PROFILE_NAME).decode('utf-8')
+        self._name_of[dir] = name
+        self._path_of.setdefault(name, self.PROFILE_ROOT + '/' + dir + '/')
+        return name
+
+    def _max_profile (self):
+        """Return the highest N among ProfileN dirs, or -1."""
+
+        numbers = [int(d[7:]) for d in self._profile_dirs()
+                   if d.startswith("Profile") and d[7:].isdigit()]
+        return max(numbers) if numbers else -1
+    #}}}
 
     def _set_colors_from_palette (self, profile, palette):
-        colors = [color.parse48(i) for i in palette.split(":")]
-        if len(colors) < 16:
+        """Set profile's color0-15 from a ':'-separated gconf palette."""
+
+        # too few colors for NumPy: parse_palette does them one by one
+        entries = palette.split(":")
+        if len(entries) < 16:
             raise ValueError("Palette does not contain enough colors.")
+        colors = color.palette_colors(color.parse_palette(entries, '48'))
         for i in range(16):
             profile["color%d" % i] = colors[i]
 
     def _get_palette_from_profile (self, profile):
-        pal = [color.to48(profile["color%d" % i]) for i in range(16)]
-        return ":".join(pal)
+        """Return profile's color0-15 as a gconf palette string."""
+
+        block = color.palette_block([profile["color%d" % i]
+                                     for i in range(16)])
+        return ":".join(color.format_palette(block, '48'))
     #}}}
 
 #}}}
 
 
-#{{{ PuTTY + Windows registry
+#{{{ PuTTY
+
+class _PuttyIOBase (TerminalIOBase):
+    """PuTTY sessions, wherever they are stored.
+
+    Subclasses provide the storage: _session_values(name) returns a
+    session's values as (key, data, type) triples, or None if there is no
+    such session, and _store_session(name, changed, values) writes the
+    changed (key, (data, type)) pairs over the values that were read.
+    _theme_types maps each kind of theme value to (read function, write
+    function, type)."""
 
-class PuttyWinIO (TerminalIOBase):
-    SESSIONS_DIR = r'Software\SimonTatham\PuTTY\Sessions'
     THEME_KEYS = {'Colour0': ('fgcolor',),
                   'Colour1': ('fgbold',),
                   'Colour2': ('bgcolor',),
@@ -953,44 +2095,55 @@ class PuttyWinIO (TerminalIOBase):
         if k.startswith("Colour"):
             THEME_KEYS[k] = (THEME_KEYS[k][0], 'color')
 
-    _slavename = 'putty-win'
-
-    def __init__ (self):
-        # initialize parent
-        TerminalIOBase.__init__(self)
-
-        if not _winreg:
-            raise RuntimeError("Windows registry not available.")
-
-        self._HIVE = _winreg.HKEY_CURRENT_USER
-        self._theme_types = {
-            'bool_int': (bool, int, _winreg.REG_DWORD),
-            'color': (color.parse24dec, color.to24dec, _winreg.REG_SZ),
-            'string': (None, None, _winreg.REG_SZ),
-        }
-
-    def profile_names (self):
-        return self._winreg_map(_winreg.EnumKey,
-                                self.SESSIONS_DIR)
-
-    def profile_exists (self, name):
-        try:
-            _winreg.OpenKey(self._HIVE, self._session_key(name))
-            return True
-        except WindowsError: # XXX: test - does missing key cause this?
-            return False
+    _slavename = None
+    _name_charset = None # of session names; None for CHARSET
 
     def read_profile (self, name=None): #{{{
         p = self._profile_ctor(name)
         if name is None:
             return p
 
-        try:
-            values = self._winreg_map(_winreg.EnumValue,
-                                      self._session_key(name))
-        except WindowsError:
+        values = self._session_values(name)
+        if values is None:
             raise KeyError("No profile named '%s' exists." % name)
+        self._fill_profile(p, values)
+        return p
+    #}}}
 
+    def write_profile (self, profile, dry_run=False):
+        """Write the profile to its session; see
+        TerminalIOBase.write_profile."""
+        return self._write(profile, dry_run)
+
+    def restore (self, profiles, dry_run=False):
+        """Write the profiles as they were stored, without forcing the
+        theme-enabling defaults; see TerminalIOBase.restore."""
+
+        plan = []
+        for profile in profiles:
+            plan.extend(self._write(profile, dry_run, False))
+        return plan
+
+    def apply_theme (self, theme, pattern, dry_run=False): #{{{
+        """See TerminalIOBase.apply_theme; each session is read once and
+        written once."""
+
+        import fnmatch
+        rv = []
+        for name in self.profile_names():
+            if not fnmatch.fnmatchcase(name, pattern):
+                continue
+            values = self._session_values(name)
+            if values is None: # removed since it was listed
+                continue
+            p = self._profile_ctor(name)
+            self._fill_profile(p, values)
+            p.update(theme)
+            rv.append((name, self._write(p, dry_run, True, values)))
+        return rv
+    #}}}
+
+    def _fill_profile (self, p, values):
         with p.ioslave(self._slavename) as private_data:
             theme = self.THEME_KEYS
             for k, v, t in values:
@@ -1001,41 +2154,39 @@ class PuttyWinIO (TerminalIOBase):
                     p[theme[k][0]] = v
                 else:
                     private_data[k] = (v, t)
-        return p
-    #}}}
-
-    def write_profile (self, profile): #{{{
-        try:
-            key = _winreg.CreateKey(self._HIVE,
-                                    self._session_key(profile.name))
-
-            try:
-                # Private keys copied from base profile
-                with profile.ioslave(self._slavename) as private_data:
-                    for k, (v, t) in private_data.items():
-                        _winreg.SetValueEx(key, k, 0, t, v)
-                # Theme keys
-                for putty_key, (t_key, typename) in self.THEME_KEYS.items():
-                    if t_key in profile:
-                        t, v = self._reg_serial(typename, profile[t_key])
-                        _winreg.SetValueEx(key, putty_key, 0, t, v)
-                # Defaults for making the theme take hold
-                for k, v, t_name in self.STD_KEYS:
-                    t, v = self._reg_serial(t_name, v)
-                    _winreg.SetValueEx(key, k, 0, t, v)
-                # No special keys for PuTTY/win
-            finally:
-                key.Close()
-
-        except WindowsError, e:
-            raise RuntimeError("Registry error writing profile '%s'" %
-                               profile.name)
 
+    def _write (self, profile, dry_run, defaults=True, values=None): #{{{
+        # Stage every value as (data, type); a name set twice keeps the
+        # last one.
+        staged = _StandInChangeSet()
+        # Private keys copied from base profile
+        with profile.ioslave(self._slavename) as private_data:
+            for k, (v, t) in private_data.items():
+                staged.set(k, (v, t))
+        # Theme keys
+        for putty_key, (t_key, typename) in self.THEME_KEYS.items():
+            if t_key in profile:
+                t, v = self._reg_serial(typename, profile[t_key])
+                staged.set(putty_key, (v, t))
+        # Defaults for making the theme take hold
+        if defaults:
+            for k, v, t_name in self.STD_KEYS:
+                t, v = self._reg_serial(t_name, v)
+                staged.set(k, (v, t))
+        # No special keys for PuTTY
+
+        if values is None:
+            values = self._session_values(profile.name) or [] # [] if new
+        stored = dict((k, (v, t)) for k, v, t in values)
+        changed = [(k, vt) for k, vt in staged.items() if stored.get(k) != vt]
+        plan = [(k, stored[k][0] if k in stored else None, vt[0])
+                for k, vt in changed]
+        if dry_run or not changed:
+            return plan
+        self._store_session(profile.name, changed, values)
+        return plan
     #}}}
 
-    def _session_key (self, name):
-        return self.SESSIONS_DIR + '\\' + self._putty_name(name)
-
     def _reg_serial (self, typename, value):
         m, t = self._theme_types[typename][1:3]
         v = m(value) if m else value
@@ -1043,13 +2194,15 @@ class PuttyWinIO (TerminalIOBase):
 
     def _putty_name (self, in_name):
         if isinstance(in_name, unicode): # expected
-            raw_name = in_name.encode('mbcs', 'replace')
+            raw_name = in_name.encode(self._name_charset or CHARSET,
+                                      'replace')
         else: # weird
             raw_name = in_name
         # encoding based on examination of WINDOWS/WINSTORE.C mungestr()
         always_encode = ' \\*?%.'
         dot_ok = False
         out = []
+        import codecs
         hex_encode = codecs.getencoder('hex_codec')
         for c in raw_name:
             printable = ord(' ') <= ord(c) <= ord('~')
@@ -1062,22 +2215,343 @@ class PuttyWinIO (TerminalIOBase):
                 always_encode = always_encode.rstrip('.')
         return ''.join(out)
 
+    def _session_name (self, putty_name):
+        """Return the name that _putty_name encoded as putty_name."""
 
-    def _winreg_map (self, winreg_method, key): #{{{
-        rv = []
-        h = _winreg.OpenKey(self._HIVE, key)
+        import urllib # %XX escapes, as PuTTY's unmungestr() reads them
+        return urllib.unquote(putty_name).decode(
+            self._name_charset or CHARSET, 'replace')
+
+#}}}
+
+
+#{{{ PuTTY + Windows registry
+
+class WinRegistry (object):
+    """The keys under one registry hive, through a _winreg module.
+
+    Opened keys are kept open, up to MAX_HANDLES of them, so that reading
+    and writing a session opens its key once rather than on every call.
+    Keys are counted with QueryInfoKey before they are enumerated, so a
+    listing costs one call per item.  Errors are EnvironmentErrors
+    (WindowsError, with the real _winreg)."""
+
+    MAX_HANDLES = 64
+
+    def __init__ (self, winreg, hive):
+        self.winreg = winreg
+        self.hive = hive
+        self._handles = {} # (path, writable) => open key
+        self._order = [] # of _handles' keys, oldest first
+
+    def open (self, path, writable=False):
+        """Return an open key; a writable one is created if missing."""
+
+        k = (path, writable)
+        h = self._handles.get(k)
+        if h is None:
+            if writable:
+                h = self.winreg.CreateKey(self.hive, path)
+            else:
+                h = self.winreg.OpenKey(self.hive, path)
+            if len(self._order) >= self.MAX_HANDLES:
+                self._handles.pop(self._order.pop(0)).Close()
+            self._handles[k] = h
+            self._order.append(k)
+        return h
+
+    def exists (self, path):
         try:
-            i = 0
-            while True:
-                x = winreg_method(h, i)
-                rv.append(x)
-                i += 1
-        except WindowsError:
-            pass
-        finally:
-            h.Close()
-        return rv
+            self.open(path)
+            return True
+        except EnvironmentError:
+            return False
+
+    def subkeys (self, path):
+        """Return the names of the keys directly under path."""
+
+        h = self.open(path)
+        enum = self.winreg.EnumKey
+        return [enum(h, i) for i in xrange(self.winreg.QueryInfoKey(h)[0])]
+
+    def values (self, path):
+        """Return the values of path as (name, data, type) triples."""
+
+        h = self.open(path)
+        enum = self.winreg.EnumValue
+        return [enum(h, i) for i in xrange(self.winreg.QueryInfoKey(h)[1])]
+
+    def set_values (self, path, values):
+        """Write (name, data, type) values to path, creating it if needed."""
+
+        h = self.open(path, True)
+        set_value = self.winreg.SetValueEx
+        for name, data, t in values:
+            set_value(h, name, 0, t, data)
+
+    def close (self):
+        for k in self._order:
+            self._handles.pop(k).Close()
+        del self._order[:]
+
+
+class _StandInRegKey (object):
+    """A key of InMemoryWinreg, which is also its own handle."""
+
+    def __init__ (self, name):
+        self.name = name
+        self.subkeys = {} # lowercased name => _StandInRegKey
+        self.names = [] # subkey names, sorted as the registry lists them
+        self.values = {} # lowercased name => (name, data, type)
+        self.order = [] # lowercased value names, first set first
+
+    def Close (self):
+        pass
+
+class InMemoryWinreg (object):
+    """Look-alike of the _winreg module, with one hive kept in memory.
+
+    It has the calls WinRegistry makes, so PuttyWinIO can be run and timed
+    on any platform.  Like the registry, it ignores the case of names.
+    calls counts the calls made; if latency is given, each one sleeps that
+    many seconds."""
+
+    REG_SZ = 1
+    REG_DWORD = 4
+
+    def __init__ (self, latency=0):
+        self.HKEY_CURRENT_USER = _StandInRegKey('HKEY_CURRENT_USER')
+        self.latency = latency
+        self.calls = 0
+
+    def OpenKey (self, key, sub_key):
+        self._call()
+        return self._find(key, sub_key, False)
+
+    def CreateKey (self, key, sub_key):
+        self._call()
+        return self._find(key, sub_key, True)
+
+    def QueryInfoKey (self, key):
+        self._call()
+        return (len(key.names), len(key.order), 0L)
+
+    def EnumKey (self, key, index):
+        self._call()
+        if index >= len(key.names):
+            raise self._error(259, "No more data is available")
+        return key.names[index]
+
+    def EnumValue (self, key, index):
+        self._call()
+        if index >= len(key.order):
+            raise self._error(259, "No more data is available")
+        return key.values[key.order[index]]
+
+    def SetValueEx (self, key, value_name, reserved, type, value):
+        self._call()
+        if type == self.REG_SZ:
+            value = unicode(value) # as _winreg reads it back
+        k = value_name.lower()
+        if k not in key.values:
+            key.order.append(k)
+        key.values[k] = (value_name, value, type)
+
+    def _find (self, key, sub_key, create):
+        import bisect
+        for name in sub_key.split('\\'):
+            sub = key.subkeys.get(name.lower())
+            if sub is None:
+                if not create:
+                    raise self._error(2, "The system cannot find the "
+                                         "file specified")
+                sub = key.subkeys[name.lower()] = _StandInRegKey(name)
+                bisect.insort(key.names, name)
+            key = sub
+        return key
+
+    def _error (self, code, message):
+        return OSError(code, message) # WindowsError is one, too
+
+    def _call (self):
+        self.calls += 1
+        if self.latency:
+            time.sleep(self.latency)
+
+
+class PuttyWinIO (_PuttyIOBase):
+    SESSIONS_DIR = r'Software\SimonTatham\PuTTY\Sessions'
+    _slavename = 'putty-win'
+    # only Windows has mbcs; InMemoryWinreg can be used anywhere
+    _name_charset = 'mbcs' if sys.platform.startswith("win") else None
+
+    def __init__ (self, winreg=None):
+        """Use the registry through winreg, by default the _winreg module."""
+
+        # initialize parent
+        TerminalIOBase.__init__(self)
+
+        if winreg is None:
+            winreg = load_winreg()
+            if not winreg:
+                raise RuntimeError("Windows registry not available.")
+
+        self.registry = WinRegistry(winreg, winreg.HKEY_CURRENT_USER)
+        self._theme_types = {
+            'bool_int': (bool, int, winreg.REG_DWORD),
+            'color': (color.parse24dec, color.to24dec, winreg.REG_SZ),
+            'string': (None, None, winreg.REG_SZ),
+        }
+
+    def profile_names (self):
+        try:
+            names = self.registry.subkeys(self.SESSIONS_DIR)
+        except EnvironmentError: # PuTTY never saved a session
+            return []
+        return [self._session_name(k) for k in names]
+
+    def profile_exists (self, name):
+        return self.registry.exists(self._session_key(name))
+
+    def _session_values (self, name):
+        try:
+            return self.registry.values(self._session_key(name))
+        except EnvironmentError:
+            return None
+
+    def _store_session (self, name, changed, values):
+        try:
+            self.registry.set_values(self._session_key(name),
+                                     [(k, v, t) for k, (v, t) in changed])
+        except EnvironmentError, e:
+            raise RuntimeError("Registry error writing profile '%s'" % name)
+
+    def _session_key (self, name):
+        return self.SESSIONS_DIR + '\\' + self._putty_name(name)
+#}}}
+
+
+#{{{ PuTTY + session files (Unix)
+
+class PuttyFileIO (_PuttyIOBase):
+    """PuTTY on Unix, which keeps each session in a file of key=value
+    lines in the sessions directory of putty_dir().
+
+    Values there are untyped strings, so the type of every value is None.
+    A changed session is rewritten whole: to a temporary file in the same
+    directory, which then replaces the old one."""
+
+    # Unix PuTTY stores the font under its own name
+    THEME_KEYS = dict(_PuttyIOBase.THEME_KEYS)
+    THEME_KEYS['FontName'] = THEME_KEYS.pop('Font')
+    _slavename = 'putty-unix'
+    # bytes that UNIX/UXSTORE.C make_session_filename() leaves alone; the
+    # rest become %XX.  Other files (ours are temporary) aren't sessions.
+    _SAFE_BYTES = frozenset('+-.@_0123456789'
+                            'ABCDEFGHIJKLMNOPQRSTUVWXYZ'
+                            'abcdefghijklmnopqrstuvwxyz')
+    _SESSION_FILE_RE = re.compile(r'^(?:[-+.@\w]|%[0-9A-Fa-f]{2})+$')
+    _ESCAPE_RE = re.compile(r'%([0-9A-Fa-f]{2})')
+
+    def __init__ (self, dirname=None):
+        # initialize parent
+        TerminalIOBase.__init__(self)
+
+        dirname = dirname or putty_dir()
+        if not dirname:
+            raise RuntimeError("PuTTY settings directory not found.")
+        self.sessions_dir = os.path.join(dirname, 'sessions')
+        self._theme_types = {
+            'bool_int': (lambda v: v != '0', lambda v: str(int(v)), None),
+            'color': (color.parse24dec, color.to24dec, None),
+            'string': (lambda v: v.decode(CHARSET, 'replace'),
+                       lambda v: v.encode(CHARSET, 'replace'), None),
+        }
+
+    def profile_names (self):
+        try:
+            names = os.listdir(self.sessions_dir)
+        except OSError:
+            return []
+        return [self._session_name(n) for n in sorted(names)
+                if self._SESSION_FILE_RE.match(n)]
+
+    def profile_exists (self, name):
+        return os.path.isfile(self._session_file(name))
+
+    def _session_file (self, name):
+        return os.path.join(self.sessions_dir, self._putty_name(name))
+
+    def _putty_name (self, in_name):
+        # as UNIX/UXSTORE.C make_session_filename(), which differs from
+        # the registry's mungestr()
+        if isinstance(in_name, unicode):
+            in_name = in_name.encode(CHARSET, 'replace')
+        safe = self._SAFE_BYTES
+        return ''.join([c if c in safe else '%%%02X' % ord(c)
+                        for c in in_name])
+
+    def _session_name (self, putty_name):
+        # as UNIX/UXSTORE.C decode_session_filename()
+        raw = self._ESCAPE_RE.sub(lambda m: chr(int(m.group(1), 16)),
+                                  putty_name)
+        return raw.decode(CHARSET, 'replace')
+
+    def _session_values (self, name):
+        try:
+            with open(self._session_file(name), 'rb') as f:
+                lines = f.read().splitlines()
+        except IOError, e:
+            import errno
+            if e.errno == errno.ENOENT:
+                return None
+            raise
+        values = []
+        for line in lines:
+            k, sep, v = line.partition('=')
+            if sep: # PuTTY skips anything else, too
+                values.append((k, v, None))
+        return values
+
+    def _store_session (self, name, changed, values): #{{{
+        # Keep the order of the file, with new keys at the end
+        lines = [[k, v] for k, v, t in values]
+        index = dict((line[0], i) for i, line in enumerate(lines))
+        for k, (v, t) in changed:
+            if k in index:
+                lines[index[k]][1] = v
+            else:
+                index[k] = len(lines)
+                lines.append([k, v])
+        data = ''.join(["%s=%s\n" % (self._file_str(k), self._file_str(v))
+                        for k, v in lines])
+
+        import tempfile
+        filename = self._session_file(name)
+        try:
+            if not os.path.isdir(self.sessions_dir):
+                os.makedirs(self.sessions_dir, 0700)
+            # PuTTY escapes ',', so this is never taken for a session
+            fd, tmpname = tempfile.mkstemp(dir=self.sessions_dir, prefix=',' +
+                                           os.path.basename(filename))
+            try:
+                with os.fdopen(fd, 'wb') as f:
+                    f.write(data)
+                if os.path.exists(filename):
+                    import stat
+                    os.chmod(tmpname, stat.S_IMODE(os.stat(filename).st_mode))
+                os.rename(tmpname, filename)
+            except:
+                os.remove(tmpname)
+                raise
+        except EnvironmentError, e:
+            raise RuntimeError("Error writing profile '%s': %s" %
+                               (name, e.strerror))
     #}}}
+
+    def _file_str (self, s):
+        # restored snapshots hold unicode
+        return s.encode(CHARSET) if isinstance(s, unicode) else s
 #}}}
 
 #}}}
@@ -1087,44 +2561,90 @@ class PuttyWinIO (TerminalIOBase):
 
 
 class _TerminalTypes (dict):
-    def _set_io (self, termname, io_class, set_default=False):
-        self[termname] = io_class
-        if set_default:
-            self.default_type = termname
+    # Maps terminal names to (IO class, loader).  The loader imports the
+    # backend's platform module and returns it, or None where it's missing;
+    # nothing is imported until a terminal is looked up.
+    def __init__ (self):
+        dict.__init__(self)
+        self._order = []
+        self._kept = None # termname => IO object, once keep_io is called
+        self._keep_wrapper = None
+
+    def _set_io (self, termname, io_class, loader):
+        self[termname] = (io_class, loader)
+        self._order.append(termname)
 
     def supports (self, termname):
         """Return whether a terminal is supported on the current platform."""
 
-        return (termname in self and self[termname] is not None)
+        return (termname in self and self[termname][1]() is not None)
 
     def supported_types (self):
         """Return terminals actually supported on the current platform."""
 
-        return sorted([k for k, v in self.items() if v])
+        return sorted([k for k in self if self.supports(k)])
+
+    def known_types (self):
+        """Return every terminal name, without checking platform support."""
+
+        return sorted(self)
 
-    def get_io (self, termname, wrapper=None):
+    def _get_default_type (self):
+        # the last supported terminal in registration order
+        supported = [k for k in self._order if self.supports(k)]
+        return supported[-1] if supported else None
+    default_type = property(_get_default_type)
+
+    def get_io (self, termname=None, wrapper=None):
         """Get the IO class corresponding to termname.
 
-        If wrapper is provided, it should be a function accepting the class,
-        and returning a TerminalIO object."""
+        termname defaults to default_type.  If wrapper is provided, it
+        should be a function accepting the class, and returning a
+        TerminalIO object."""
 
+        if termname is None:
+            termname = self.default_type
+            if termname is None:
+                raise ValueError("No terminal type is supported on this " +
+                                 "platform.")
         if termname not in self:
             raise KeyError("Unknown terminal type: '%s'" % termname)
-        elif not self[termname]:
+        elif not self.supports(termname):
             raise ValueError("Terminal type is not supported on this " +
                              "platform.")
 
-        ctor = self[termname]
+        ctor = self[termname][0]
+        if not wrapper and self._kept is not None:
+            if termname not in self._kept:
+                wrap = self._keep_wrapper
+                self._kept[termname] = wrap(ctor) if wrap else ctor()
+            return self._kept[termname]
         if wrapper:
             return wrapper(ctor)
         else:
             return ctor()
 
-terminal = _TerminalTypes(dict(gnome=None, putty=None))
-if gconf:
-    terminal._set_io('gnome', GnomeTerminalIO, True)
-if _winreg:
-    terminal._set_io('putty', PuttyWinIO, True)
+    def keep_io (self, wrapper=None):
+        """Make get_io build one IO object per terminal type, and return
+        that one from then on (for long-running processes).
+
+        wrapper is used to build them, as with get_io."""
+
+        self._kept = {}
+        self._keep_wrapper = wrapper
+
+    def forget_io (self):
+        """Drop the IO objects kept since keep_io, so that get_io builds
+        fresh ones."""
+
+        if self._kept is not None:
+            self._kept.clear()
+
+terminal = _TerminalTypes()
+# before gnome, which stays the default where both are supported
+terminal._set_io('putty-unix', PuttyFileIO, putty_dir)
+terminal._set_io('gnome', GnomeTerminalIO, load_gconf)
+terminal._set_io('putty', PuttyWinIO, load_winreg)
 
 #}}}
 
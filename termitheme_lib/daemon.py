@@ -0,0 +1,459 @@
+"""Long-running termitheme process, serving commands over a Unix socket.
+
+`termitheme daemon` keeps the terminal IO objects and the profiles read
+through them between commands, so that a run of import, export and pack
+calls pays for loading the backend only once.  The termitheme command hands
+those commands to the daemon whenever one is listening on the socket, and
+runs them itself otherwise, or when the daemon declines them.
+
+Requests are served one at a time.  The client sends its arguments,
+working directory, umask, charset and the environment variables that
+decide which profiles the backends see.  If those variables differ from
+the daemon's, it declines the request.  Otherwise it streams back what
+the command prints on stdout and stderr, asks for the client's stdin only
+if the command reads it, and finishes with the exit status.  Every message is
+a frame: one byte of kind, four bytes of length, then the data.  A request
+that handoff could not have sent gets an error and exit status 2.
+
+Profiles cached by the daemon are dropped after --ttl seconds, so changes
+made outside termitheme (in the terminal's own preferences) show up after
+that long at most."""
+
+from __future__ import absolute_import, division, with_statement
+
+import os
+import os.path
+import sys
+import threading
+import time
+
+from . import core, commands
+
+# Environment variable naming the socket; set it empty to never hand off.
+SOCKET_ENV = 'TERMITHEME_SOCKET'
+SOCKET_NAME = 'termitheme.sock'
+# Commands handed to a running daemon
+COMMANDS = ('import', 'export', 'pack')
+DEFAULT_TTL = 30
+# Variables deciding which profiles the backends see (gconf's through the
+# session bus); the daemon runs a command only if the client's match its own
+ENVIRONMENT = ('HOME', 'PUTTYDIR', 'XDG_CONFIG_HOME', 'XDG_DATA_HOME',
+               'XDG_RUNTIME_DIR', 'DBUS_SESSION_BUS_ADDRESS', 'DISPLAY')
+
+# Frame kinds
+REQUEST = 'q'  # client: JSON request
+STDIN = 'i'    # daemon: send your stdin; client: here it is
+STDOUT = 'o'
+STDERR = 'e'
+EXIT = 'x'     # daemon: the command's exit status
+DECLINE = 'n'  # daemon: run the command yourself
+
+
+def socket_path ():
+    """Return the path of the daemon's socket for this user."""
+
+    path = os.environ.get(SOCKET_ENV)
+    if path is not None:
+        return path
+    rundir = os.environ.get('XDG_RUNTIME_DIR')
+    if rundir:
+        return os.path.join(rundir, SOCKET_NAME)
+    tmpdir = os.environ.get('TMPDIR', '/tmp')
+    return os.path.join(tmpdir, 'termitheme-%d' % os.getuid(), SOCKET_NAME)
+
+def environment ():
+    """Return this process's values of the ENVIRONMENT variables, None for
+    those unset, as they are sent in a request."""
+
+    # Latin-1 maps every byte, so any value goes through JSON unchanged
+    return dict((name, os.environ[name].decode('latin-1')
+                 if name in os.environ else None)
+                for name in ENVIRONMENT)
+
+
+class _Channel (object):
+    """Frames over a connected socket; sends are safe from any thread."""
+
+    def __init__ (self, sock):
+        self.sock = sock
+        self._rfile = sock.makefile('rb')
+        self._lock = threading.Lock()
+
+    def send (self, kind, data=''):
+        import struct
+        with self._lock:
+            self.sock.sendall(struct.pack('!cI', kind, len(data)) + data)
+
+    def recv (self):
+        """Return the next (kind, data); raise EOFError if the peer left."""
+
+        import struct
+        head = self._rfile.read(5)
+        if len(head) < 5:
+            raise EOFError("Connection closed")
+        kind, size = struct.unpack('!cI', head)
+        data = self._rfile.read(size)
+        if len(data) < size:
+            raise EOFError("Connection closed")
+        return kind, data
+
+    def close (self):
+        self._rfile.close()
+        self.sock.close()
+
+
+#{{{ Client side
+
+def handoff (cmdname, argv, path=None):
+    """Run a command in the daemon, passing through its output.
+
+    Returns the exit status, or None if no daemon is listening, the
+    request can't be sent, or the daemon declines it, in which case the
+    caller should run the command itself."""
+
+    if cmdname not in COMMANDS:
+        return None
+    if path is None:
+        path = socket_path()
+    try:
+        # Only trust a socket of our own; this stat is all it costs to
+        # find that no daemon is running.
+        if not path or os.stat(path).st_uid != os.getuid():
+            return None
+        cwd = os.getcwd().decode(core.CHARSET)
+    except (OSError, UnicodeError):
+        return None
+
+    import json
+    import socket
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        sock.connect(path)
+    except socket.error:
+        sock.close()
+        return None
+
+    umask = os.umask(0)
+    os.umask(umask)
+    request = {'command': cmdname, 'argv': argv, 'cwd': cwd,
+               'umask': umask, 'charset': core.CHARSET,
+               'encoding': sys.stdout.encoding, 'env': environment()}
+    channel = _Channel(sock)
+    try:
+        try:
+            channel.send(REQUEST, json.dumps(request))
+        except socket.error:
+            return None
+        return _relay(channel)
+    finally:
+        channel.close()
+
+def _relay (channel):
+    """Pass the daemon's frames through until the exit status arrives;
+    return None if the daemon declines the command."""
+
+    import socket
+    try:
+        while True:
+            kind, data = channel.recv()
+            if kind == STDOUT:
+                sys.stdout.write(data)
+                sys.stdout.flush()
+            elif kind == STDERR:
+                sys.stderr.write(data)
+                sys.stderr.flush()
+            elif kind == STDIN:
+                channel.send(STDIN, commands._binary(sys.stdin).read())
+            elif kind == EXIT:
+                return int(data)
+            elif kind == DECLINE:
+                return None
+    except (EOFError, socket.error):
+        commands.p_err("Lost the connection to the termitheme daemon.")
+        return 1
+
+#}}}
+
+
+#{{{ Daemon side
+
+def _bad_field (request):
+    """Return the name of the first field of request that is missing or
+    not as handoff sends it, or None if they are all sound."""
+
+    import codecs
+
+    def is_codec (name):
+        try:
+            codecs.lookup(name)
+        except (LookupError, TypeError, UnicodeError):
+            return False
+        return True
+
+    argv = request.get('argv')
+    if not (isinstance(argv, list) and argv and
+            all(isinstance(a, basestring) for a in argv)):
+        return 'argv'
+    if not isinstance(request.get('cwd'), basestring):
+        return 'cwd'
+    umask = request.get('umask')
+    if (not isinstance(umask, (int, long)) or isinstance(umask, bool) or
+        not 0 <= umask <= 0777):
+        return 'umask'
+    charset = request.get('charset')
+    if not (isinstance(charset, basestring) and is_codec(charset)):
+        return 'charset'
+    encoding = request.get('encoding')
+    if encoding is not None and not (isinstance(encoding, basestring) and
+                                     is_codec(encoding)):
+        return 'encoding'
+    env = request.get('env')
+    if not (isinstance(env, dict) and
+            all(v is None or isinstance(v, basestring)
+                for v in env.values())):
+        return 'env'
+    return None
+
+
+class CachingIO (core.TerminalIOBase):
+    """Wraps a terminal IO object, keeping the profiles read through it.
+
+    read_profile hands out copies, so callers may change them freely; any
+    write drops the whole cache, since it can change the default profile
+    or the names in use."""
+
+    def __init__ (self, io):
+        core.TerminalIOBase.__init__(self)
+        self.io = io
+        self._profiles = {} # name (None for the default) => profile
+
+    def profile_names (self):
+        return self.io.profile_names()
+
+    def profile_exists (self, name):
+        return self.io.profile_exists(name)
+
+    def read_profile (self, name=None):
+        if name not in self._profiles:
+            self._profiles[name] = self.io.read_profile(name)
+        return self._profiles[name].copy()
+
+    def write_profile (self, profile, dry_run=False):
+        if not dry_run:
+            self._profiles.clear()
+        return self.io.write_profile(profile, dry_run)
+
+    def dump (self):
+        return self.io.dump()
+
+    def restore (self, profiles, dry_run=False):
+        if not dry_run:
+            self._profiles.clear()
+        return self.io.restore(profiles, dry_run)
+
+    def apply_theme (self, theme, pattern, dry_run=False):
+        if not dry_run:
+            self._profiles.clear()
+        return self.io.apply_theme(theme, pattern, dry_run)
+
+    def __getattr__ (self, name):
+        return getattr(self.io, name)
+
+
+class _ClientOutput (object):
+    """File-like object sending what is written to a client stream."""
+
+    def __init__ (self, channel, kind, encoding=None):
+        self._channel = channel
+        self._kind = kind
+        self.encoding = encoding
+        self.softspace = 0 # for print
+
+    def write (self, data):
+        if isinstance(data, unicode):
+            data = data.encode(self.encoding or 'ascii')
+        if data:
+            self._channel.send(self._kind, data)
+
+    def writelines (self, lines):
+        for line in lines:
+            self.write(line)
+
+    def flush (self):
+        pass
+
+    def isatty (self):
+        return False
+
+
+class _ClientInput (object):
+    """The client's stdin, fetched from it on first read."""
+
+    def __init__ (self, channel):
+        self._channel = channel
+        self._buf = None
+        self._lock = threading.Lock()
+
+    def _fetch (self):
+        with self._lock:
+            if self._buf is None:
+                import cStringIO
+                self._channel.send(STDIN)
+                kind, data = self._channel.recv()
+                self._buf = cStringIO.StringIO(data)
+        return self._buf
+
+    def read (self, size=-1):
+        return self._fetch().read(size)
+
+    def readline (self, size=-1):
+        return self._fetch().readline(size)
+
+    def readlines (self):
+        return self._fetch().readlines()
+
+    def __iter__ (self):
+        return iter(self._fetch())
+
+
+class Server (object):
+    """Serves commands on a Unix socket at path, one at a time."""
+
+    def __init__ (self, path=None, ttl=DEFAULT_TTL):
+        self.path = path or socket_path()
+        self.ttl = ttl
+        self._sock = None
+        self._since = None # when the kept IO objects were made
+
+    def listen (self):
+        """Bind the socket; raise EnvironmentError if a daemon is already
+        listening there."""
+
+        import socket
+        dirname = os.path.dirname(self.path)
+        if dirname and not os.path.isdir(dirname):
+            os.makedirs(dirname, 0700)
+        if os.path.exists(self.path):
+            probe = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+            try:
+                probe.connect(self.path)
+            except socket.error:
+                os.remove(self.path) # left behind by a daemon that died
+            else:
+                import errno
+                raise EnvironmentError(errno.EADDRINUSE,
+                                       "A daemon is already listening")
+            finally:
+                probe.close()
+
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        umask = os.umask(0177) # the socket is for our user only
+        try:
+            sock.bind(self.path)
+        finally:
+            os.umask(umask)
+        sock.listen(16)
+        self._sock = sock
+        core.terminal.keep_io(lambda ctor: CachingIO(ctor()))
+        self._since = time.time()
+
+    def serve (self, count=None):
+        """Serve requests, forever or until count have been served."""
+
+        import socket
+        while count is None or count > 0:
+            conn = self._sock.accept()[0]
+            channel = _Channel(conn)
+            try:
+                self.handle(channel)
+            except (EOFError, socket.error):
+                pass # the client went away
+            except Exception, e:
+                # one bad request must not take the daemon down
+                commands.p_err("Error: Failed to serve a request: %s" % e)
+                try:
+                    channel.send(STDERR, "Error: The daemon failed to run "
+                                 "the command.\n")
+                    channel.send(EXIT, '2')
+                except socket.error:
+                    pass
+            finally:
+                channel.close()
+            if count is not None:
+                count -= 1
+
+    def close (self):
+        if self._sock is not None:
+            self._sock.close()
+            self._sock = None
+            try:
+                os.remove(self.path)
+            except OSError:
+                pass
+        core.terminal.forget_io()
+
+    def handle (self, channel):
+        import json
+        kind, data = channel.recv()
+        if kind != REQUEST:
+            return
+        try:
+            request = json.loads(data)
+        except ValueError:
+            request = None
+        # only ever run the commands handoff sends, whoever is asking
+        if (not isinstance(request, dict) or
+            request.get('command') not in COMMANDS):
+            error = "The daemon only runs %s." % ", ".join(COMMANDS)
+        else:
+            field = _bad_field(request)
+            error = field and "Bad %s in the request." % field
+        if error:
+            channel.send(STDERR, "Error: %s\n" % error)
+            channel.send(EXIT, '2')
+            return
+        if request['env'] != environment():
+            channel.send(DECLINE)
+            return
+        if time.time() - self._since > self.ttl:
+            core.terminal.forget_io()
+            self._since = time.time()
+        rc = self.run(channel, request)
+        channel.send(EXIT, str(rc))
+
+    def run (self, channel, request):
+        """Run the request's command as if in the client; return its exit
+        status."""
+
+        charset = request['charset']
+        saved = (sys.stdin, sys.stdout, sys.stderr, core.CHARSET,
+                 os.getcwd(), os.umask(request['umask']))
+        sys.stdin = _ClientInput(channel)
+        sys.stdout = _ClientOutput(channel, STDOUT, request['encoding'])
+        sys.stderr = _ClientOutput(channel, STDERR)
+        core.CHARSET = charset
+        try:
+            cwd = request['cwd'].encode(charset)
+            try:
+                os.chdir(cwd)
+            except OSError, e:
+                commands.p_err("Cannot change to directory %s: %s" %
+                               (cwd, e.strerror))
+                return 1
+            rc = commands.run_cmd(request['command'], request['argv'])
+        except SystemExit, e: # from optparse, for --help and bad options
+            rc = e.code
+            if rc is not None and not isinstance(rc, int):
+                print >>sys.stderr, rc
+                rc = 1
+        except Exception, e:
+            # as the termitheme script reports it
+            print "Error: %s" % e.args[0]
+            rc = 2
+        finally:
+            sys.stdin, sys.stdout, sys.stderr, core.CHARSET = saved[:4]
+            os.chdir(saved[4])
+            os.umask(saved[5])
+        return rc or 0
+
+#}}}
@@ -0,0 +1,175 @@
+"""Color schemes for other programs, rendered from terminal profiles.
+
+Each format is a Template: text with {key} or {key:conversion} fields,
+where key is a profile key (or name, for the profile's name) and the
+conversion one of CONVERSIONS.  A template is compiled once, into a
+%-format string per line, and can then be filled from any number of
+profiles.  A line with a field the profile doesn't have (a cursor color,
+say) is left out; a profile without one of a template's required keys
+can't be rendered at all.  Output is UTF-8."""
+
+from __future__ import absolute_import, division, with_statement
+
+import json
+import re
+
+from . import core
+
+_FIELD_RE = re.compile(r'\{\{|\}\}|\{(\w+)(?::(\w+))?\}')
+PALETTE_KEYS = ["color%d" % i for i in range(16)]
+REQUIRED_KEYS = ['fgcolor', 'bgcolor'] + PALETTE_KEYS
+
+
+def _xrgb (v):
+    # the 16-bit color spec of XParseColor, which xterm's OSCs accept
+    h = core.color.to48(v)
+    return 'rgb:%s/%s/%s' % (h[1:5], h[5:9], h[9:13])
+
+CONVERSIONS = {
+    'hex': core.color.to24,  # #rrggbb
+    'rgb': core.color.to24dec, # r,g,b
+    'xrgb': _xrgb,  # rgb:rrrr/gggg/bbbb
+    'json': json.dumps,
+    'text': lambda v: unicode(v).replace('\n', ' '),
+}
+
+
+class Template (object):
+    """A text template, compiled once and rendered for many profiles."""
+
+    def __init__ (self, text, required=REQUIRED_KEYS):
+        self.required = list(required)
+        self._lines = [self._compile(line) for line in
+                       text.splitlines(True)]
+
+    def _compile (self, line):
+        """Return (format string, [(key, conversion)]) for line."""
+
+        fmt = []
+        fields = []
+        pos = 0
+        for m in _FIELD_RE.finditer(line):
+            fmt.append(line[pos:m.start()].replace('%', '%%'))
+            pos = m.end()
+            if m.group(1) is None: # {{ or }}
+                fmt.append(m.group(0)[0])
+                continue
+            conv = m.group(2) or 'text'
+            if (m.group(1) != 'name' and
+                m.group(1) not in core.TerminalProfile.PROFILE_KEY_NAMES):
+                raise ValueError("Unknown key '%s'" % m.group(1))
+            elif conv not in CONVERSIONS:
+                raise ValueError("Unknown conversion '%s'" % conv)
+            fmt.append('%s')
+            fields.append((m.group(1), CONVERSIONS[conv]))
+        fmt.append(line[pos:].replace('%', '%%'))
+        return (u''.join(fmt), fields)
+
+    def render (self, profile):
+        """Return the template filled from profile, as unicode."""
+
+        for k in self.required:
+            if k not in profile:
+                raise ValueError("Profile '%s' has no %s" % (profile.name, k))
+        out = []
+        for fmt, fields in self._lines:
+            try:
+                values = tuple([conv(profile.name if k == 'name'
+                                     else profile[k]) for k, conv in fields])
+            except KeyError: # an optional key the profile doesn't have
+                continue
+            out.append(fmt % values)
+        return u''.join(out)
+
+
+class Format (object):
+    """An output format: its name, file name suffix and Template."""
+
+    def __init__ (self, name, suffix, description, text):
+        self.name = name
+        self.suffix = suffix
+        self.description = description
+        self.template = Template(text)
+
+    def render (self, profile):
+        """Return profile in this format, as UTF-8 bytes."""
+        return self.template.render(profile).encode('utf-8')
+
+
+# Cursor keys come from PuTTY: fgcursor is the text under the cursor,
+# bgcursor the cursor itself.  fgbold is the bold foreground.
+_XRESOURCES = """\
+! {name} (exported by termitheme)
+*.foreground: {fgcolor:hex}
+*.background: {bgcolor:hex}
+*.cursorColor: {bgcursor:hex}
+*.colorBD: {fgbold:hex}
+""" + "".join(["*.color%d: {color%d:hex}\n" % (i, i) for i in range(16)])
+
+_XTERM = r"""#!/bin/sh
+# {name} (exported by termitheme), for xterm and compatible terminals
+printf '\033]10;{fgcolor:xrgb}\007'
+printf '\033]11;{bgcolor:xrgb}\007'
+printf '\033]12;{bgcursor:xrgb}\007'
+""" + "".join([r"printf '\033]4;%d;{color%d:xrgb}\007'" "\n" % (i, i)
+               for i in range(16)])
+
+_ANSI_NAMES = ['black', 'red', 'green', 'yellow', 'blue', 'magenta', 'cyan',
+               'white']
+_ALACRITTY = """\
+# {name} (exported by termitheme)
+[colors.primary]
+foreground = "{fgcolor:hex}"
+background = "{bgcolor:hex}"
+bright_foreground = "{fgbold:hex}"
+
+[colors.cursor]
+text = "{fgcursor:hex}"
+cursor = "{bgcursor:hex}"
+
+[colors.normal]
+""" + "".join(['%s = "{color%d:hex}"\n' % (n, i)
+               for i, n in enumerate(_ANSI_NAMES)]) + """
+[colors.bright]
+""" + "".join(['%s = "{color%d:hex}"\n' % (n, i + 8)
+               for i, n in enumerate(_ANSI_NAMES)])
+
+_KITTY = """\
+# {name} (exported by termitheme)
+foreground {fgcolor:hex}
+background {bgcolor:hex}
+cursor {bgcursor:hex}
+cursor_text_color {fgcursor:hex}
+""" + "".join(["color%d {color%d:hex}\n" % (i, i) for i in range(16)])
+
+_JSON = """\
+{{
+  "name": {name:json},
+  "foreground": "{fgcolor:hex}",
+  "background": "{bgcolor:hex}",
+  "bold": "{fgbold:hex}",
+  "cursor": "{bgcursor:hex}",
+  "cursorText": "{fgcursor:hex}",
+  "palette": [
+""" + ",\n".join(['    "{color%d:hex}"' % i for i in range(16)]) + """
+  ]
+}}
+"""
+
+FORMATS = {}
+for _f in [Format('xresources', '.Xresources', "X resources (xrdb)",
+                  _XRESOURCES),
+           Format('xterm', '.sh', "Shell script setting colors by xterm OSC",
+                  _XTERM),
+           Format('alacritty', '.toml', "Alacritty configuration", _ALACRITTY),
+           Format('kitty', '.conf', "kitty configuration", _KITTY),
+           Format('json', '.json', "JSON palette", _JSON)]:
+    FORMATS[_f.name] = _f
+del _f
+
+def get (name):
+    """Return the Format called name; raise KeyError if there is none."""
+
+    if name not in FORMATS:
+        raise KeyError("Unknown format: '%s'" % name)
+    return FORMATS[name]
@@ -0,0 +1,144 @@
+"""Persistent metadata index over a directory of theme files.
+
+The index is a JSON file mapping each theme zip's name to what termitheme
+knows about it: theme name, the Termitheme sections present, the palette,
+a digest of the credits, and the file's size and mtime.  Updating the
+index only re-reads files whose size or mtime changed, and listing or
+filtering works from the index alone."""
+
+from __future__ import absolute_import, division, with_statement
+
+import fnmatch
+import hashlib
+import json
+import os
+import os.path
+import sys
+
+from . import core
+
+INDEX_FILENAME = '.termitheme-index.json'
+INDEX_VERSION = 1
+
+
+def read_entry (path):
+    """Read the theme zip at path into a fresh index entry."""
+
+    st = os.stat(path)
+    entry = {'size': st.st_size, 'mtime': st.st_mtime}
+    themefile = core.ThemeFile(path)
+    try:
+        with themefile:
+            parser = themefile.read_open()
+            profile = themefile.read_profile(parser)
+            credits = themefile.get_credits()
+    except Exception, e:
+        entry['error'] = "%s" % (e.args[0] if e.args else e)
+        return entry
+
+    colors = [(k, v) for k, v in sorted(profile.items())
+              if core.color.is_color(v)]
+    hexes = core.color.format_palette([v for k, v in colors], '48')
+    entry.update({
+        'name': profile.name,
+        'sections': sorted([s for s in parser.sections()
+                            if s.startswith('Termitheme')], reverse=True),
+        'palette': dict(zip([k for k, v in colors], hexes)),
+        'credits_sha1': (hashlib.sha1(credits.encode('utf-8')).hexdigest()
+                         if credits is not None else None),
+    })
+    return entry
+
+
+class ThemeIndex (object):
+    """Index of the theme zips in one directory."""
+
+    def __init__ (self, directory, filename=None):
+        self.directory = directory
+        if filename is None:
+            filename = os.path.join(directory, INDEX_FILENAME)
+        self.filename = filename
+        self._entries = {}
+
+    def load (self):
+        """Load the index file, if it exists; return whether it did."""
+
+        if not os.path.exists(self.filename):
+            return False
+        with open(self.filename, 'rb') as f:
+            data = json.load(f)
+        if data.get('version') != INDEX_VERSION:
+            return False # rebuild from scratch
+        self._entries = data['entries']
+        return True
+
+    def save (self):
+        """Write the index file, replacing the old one in one step."""
+
+        tmp = self.filename + '.tmp'
+        with open(tmp, 'wb') as f:
+            json.dump({'version': INDEX_VERSION, 'entries': self._entries},
+                      f, sort_keys=True, separators=(',', ':'))
+        if sys.platform.startswith("win") and os.path.exists(self.filename):
+            os.remove(self.filename) # rename can't replace a file there
+        os.rename(tmp, self.filename)
+
+    def update (self, map_fn=map):
+        """Bring the index up to date with the directory.
+
+        Only new files and files with a changed size or mtime are read;
+        map_fn(read_entry, paths) may read them in parallel.  Returns a
+        (read, removed) tuple of file name lists."""
+
+        stale = []
+        current = set()
+        for fs_name in os.listdir(self.directory):
+            path = os.path.join(self.directory, fs_name)
+            if (not fs_name.lower().endswith('.zip') or
+                not os.path.isfile(path)):
+                continue
+            # JSON keys are unicode
+            name = fs_name
+            if isinstance(name, str):
+                name = name.decode(core.CHARSET, 'replace')
+            current.add(name)
+            st = os.stat(path)
+            old = self._entries.get(name)
+            if (old is None or old['size'] != st.st_size or
+                old['mtime'] != st.st_mtime):
+                stale.append((name, path))
+
+        removed = sorted([name for name in self._entries
+                          if name not in current])
+        for name in removed:
+            del self._entries[name]
+
+        stale.sort()
+        paths = [path for name, path in stale]
+        for (name, path), entry in zip(stale, map_fn(read_entry, paths)):
+            self._entries[name] = entry
+        return ([name for name, path in stale], removed)
+
+    def entries (self, pattern=None, version=None, valid=True):
+        """Return (file name, entry) pairs from the index, sorted by name.
+
+        pattern filters theme names with case-insensitive shell-style
+        wildcards, version keeps themes that have that Termitheme section
+        (like '1.2'), and valid=False includes files that failed to read."""
+
+        section = None
+        if version:
+            section = 'Termitheme' + core.version_key(version)
+        rv = []
+        for name, entry in sorted(self._entries.items()):
+            if 'error' in entry:
+                if not valid:
+                    rv.append((name, entry))
+                continue
+            if pattern and not fnmatch.fnmatch(entry['name'].lower(),
+                                               pattern.lower()):
+                continue
+            if section and section not in entry['sections']:
+                continue
+            rv.append((name, entry))
+        return rv
@@ -0,0 +1,155 @@
+"""Bulk theme ingestion: archives read on a few threads, saved by one writer.
+
+Ingest reads items (theme file names) with read_fn on up to jobs threads
+and hands the results back, in the order of the items, to whoever iterates
+over it.  The iterating thread is the single writer: terminal backends are
+not safe to use from several threads, and writing in order keeps imports
+of same-named themes predictable.
+
+No more than window items are read ahead of the writer.  When it falls
+behind (a slow backend), the readers wait instead of decoding the whole
+corpus into memory.  Stats records what went where, for a throughput
+report at the end."""
+
+from __future__ import absolute_import, division, with_statement
+
+import os.path
+import sys
+import threading
+import time
+
+# threads reading theme files, unless a command is told otherwise
+DEFAULT_JOBS = 4
+
+
+class Stats (object):
+    """Counters for one Ingest run."""
+
+    def __init__ (self, jobs):
+        self.jobs = jobs
+        self.files = 0
+        self.bytes = 0 # of theme files that are on disk
+        self.read_time = 0.0 # summed over the reader threads
+        self.write_time = 0.0
+        self.peak = 0 # most results read but not yet written
+        self.start = self.end = None
+
+    def _get_wall_time (self):
+        if self.start is None:
+            return 0.0
+        return (self.end or time.time()) - self.start
+    wall_time = property(_get_wall_time)
+
+    def report (self):
+        """Return a summary of the run, two lines of text."""
+
+        wall = self.wall_time or 1e-9
+        return ("%d theme file(s) in %.2f s: %.1f files/s, %.2f MB/s read\n"
+                "reading %.2f s on %d thread(s), writing %.2f s, "
+                "at most %d waiting to be written" %
+                (self.files, wall, self.files / wall,
+                 self.bytes / wall / 1e6, self.read_time, self.jobs,
+                 self.write_time, self.peak))
+
+
+class Ingest (object):
+    """Reads items concurrently and yields read_fn(item) for each, in order.
+
+    Call start() to begin reading early (say, while the writer is still
+    getting ready), then iterate; stop() ends the readers if the writer
+    gives up before the end."""
+
+    def __init__ (self, read_fn, jobs=DEFAULT_JOBS, window=None):
+        self.read_fn = read_fn
+        self.jobs = max(1, jobs)
+        self.window = window or 2 * self.jobs
+        self.stats = Stats(self.jobs)
+        self._items = None
+        self._threads = []
+
+    def start (self, items):
+        self._items = list(items)
+        self._next = 0 # index of the next item to read
+        self._results = {} # index => (exc_info or None, value)
+        self._lock = threading.Lock()
+        self._ready = threading.Condition(self._lock)
+        self._slots = threading.Semaphore(self.window)
+        self._stopped = False
+        self.stats.start = time.time()
+        if self.jobs > 1 and len(self._items) > 1:
+            for i in range(min(self.jobs, len(self._items))):
+                t = threading.Thread(target=self._work,
+                                     name='ingest-%d' % (i + 1))
+                t.setDaemon(True)
+                t.start()
+                self._threads.append(t)
+        self.stats.jobs = max(1, len(self._threads))
+        return self
+
+    def stop (self):
+        """Make the readers exit; results not yet yielded are dropped."""
+
+        self._stopped = True
+        threads, self._threads = self._threads, []
+        for t in threads:
+            self._slots.release() # wake any reader waiting for a slot
+        for t in threads:
+            t.join() # each finishes the item in hand, at most
+        if self.stats.end is None:
+            self.stats.end = time.time()
+
+    def __iter__ (self):
+        if self._items is None:
+            raise ValueError("Ingest.start() has not been called")
+        try:
+            for i in xrange(len(self._items)):
+                if self._threads:
+                    exc_info, value = self._wait_for(i)
+                else:
+                    exc_info, value = self._read(self._items[i])
+                if exc_info:
+                    raise exc_info[0], exc_info[1], exc_info[2]
+                t0 = time.time()
+                yield value
+                self.stats.write_time += time.time() - t0
+                self._slots.release()
+        finally:
+            self.stop()
+
+    def _wait_for (self, i):
+        with self._ready:
+            while i not in self._results:
+                # a timeout keeps Ctrl-C working while waiting
+                self._ready.wait(1.0)
+            return self._results.pop(i)
+
+    def _work (self):
+        while True:
+            self._slots.acquire()
+            with self._lock:
+                i = self._next
+                if self._stopped or i >= len(self._items):
+                    self._slots.release() # pass the wakeup along
+                    return
+                self._next += 1
+            result = self._read(self._items[i])
+            with self._ready:
+                self._results[i] = result
+                self.stats.peak = max(self.stats.peak, len(self._results))
+                self._ready.notifyAll()
+
+    def _read (self, item):
+        t0 = time.time()
+        try:
+            result = (None, self.read_fn(item))
+        except:
+            result = (sys.exc_info(), None)
+        size = 0
+        if isinstance(item, basestring) and os.path.isfile(item):
+            size = os.path.getsize(item)
+        with self._lock:
+            stats = self.stats
+            stats.files += 1
+            stats.bytes += size
+            stats.read_time += time.time() - t0
+        return result
@@ -0,0 +1,144 @@
+"""Find the themes whose palettes look most like a given profile's.
+
+Each palette becomes one vector: the CIELAB coordinates of color0 through
+color15, fgcolor and bgcolor, in that order.  The Euclidean distance
+between two vectors is then the root of the summed squared CIE76 color
+differences.  Searches use a k-d tree from SciPy when it is installed, a
+vectorized NumPy scan when only NumPy is, and plain Python otherwise."""
+
+from __future__ import absolute_import, division, with_statement
+
+import heapq
+import math
+
+from . import core
+
+numpy = core.load_numpy()
+try:
+    from scipy.spatial import cKDTree
+except ImportError:
+    cKDTree = None
+
+# The profile keys compared, in vector order
+SEARCH_KEYS = [k for k in core.TerminalProfile.PROFILE_KEY_NAMES
+               if k.startswith('color')] + ['fgcolor', 'bgcolor']
+
+
+#{{{ sRGB (D65) to CIELAB
+
+_RGB_TO_XYZ = [(0.4124564, 0.3575761, 0.1804375),
+               (0.2126729, 0.7151522, 0.0721750),
+               (0.0193339, 0.1191920, 0.9503041)]
+_WHITE = (0.95047, 1.0, 1.08883)
+_EPSILON = (6 / 29) ** 3
+
+def _lab_py (rgb):
+    lin = []
+    for ch in rgb:
+        c = ch / 65535
+        lin.append(c / 12.92 if c <= 0.04045 else ((c + 0.055) / 1.055) ** 2.4)
+    f = []
+    for row, white in zip(_RGB_TO_XYZ, _WHITE):
+        t = sum([m * c for m, c in zip(row, lin)]) / white
+        f.append(t ** (1 / 3) if t > _EPSILON else
+                 t / (3 * (6 / 29) ** 2) + 4 / 29)
+    return [116 * f[1] - 16, 500 * (f[0] - f[1]), 200 * (f[1] - f[2])]
+
+def _lab_np (block):
+    c = numpy.asarray(block, dtype=numpy.float64) / 65535
+    lin = numpy.where(c <= 0.04045, c / 12.92, ((c + 0.055) / 1.055) ** 2.4)
+    t = lin.dot(numpy.array(_RGB_TO_XYZ).T) / numpy.array(_WHITE)
+    f = numpy.where(t > _EPSILON, t ** (1 / 3),
+                    t / (3 * (6 / 29) ** 2) + 4 / 29)
+    return numpy.column_stack([116 * f[..., 1] - 16,
+                               500 * (f[..., 0] - f[..., 1]),
+                               200 * (f[..., 1] - f[..., 2])])
+
+def lab_vector (colors):
+    """Return the CIELAB coordinates of colors as one flat vector."""
+
+    if numpy is not None:
+        return _lab_np(core.color.palette_block(colors)).ravel()
+    rv = []
+    for c in colors:
+        rv.extend(_lab_py(c))
+    return rv
+
+#}}}
+
+
+def profile_colors (profile):
+    """Return the SEARCH_KEYS colors of profile, or None if any is missing.
+
+    profile may be a TerminalProfile or an index entry's palette dict of
+    48-bit hex strings."""
+
+    try:
+        colors = [profile[k] for k in SEARCH_KEYS]
+    except KeyError:
+        return None
+    if colors and isinstance(colors[0], basestring):
+        colors = core.color.parse_palette(colors, '48')
+    return colors
+
+
+class PaletteSearch (object):
+    """Nearest-palette search over a fixed corpus of themes."""
+
+    def __init__ (self, items):
+        """items is a sequence of (key, palette) pairs; see profile_colors.
+
+        Palettes missing any of SEARCH_KEYS are left out (see skipped)."""
+
+        self.keys = []
+        self.skipped = []
+        colors = []
+        for key, palette in items:
+            c = profile_colors(palette)
+            if c is None:
+                self.skipped.append(key)
+            else:
+                self.keys.append(key)
+                colors.append(c)
+
+        if numpy is not None and colors:
+            # All palettes in one go: (themes * colors) x 3 -> themes x dims
+            flat = numpy.concatenate([core.color.palette_block(c)
+                                      for c in colors])
+            self._matrix = _lab_np(flat).reshape(len(colors), -1)
+            self._tree = cKDTree(self._matrix) if cKDTree else None
+        else:
+            self._matrix = [lab_vector(c) for c in colors]
+            self._tree = None
+
+    def __len__ (self):
+        return len(self.keys)
+
+    def nearest (self, profile, count=10):
+        """Return up to count (distance, key) pairs, nearest first.
+
+        The distance is the RMS CIE76 difference over SEARCH_KEYS."""
+
+        colors = profile_colors(profile)
+        if colors is None:
+            raise KeyError("Profile does not have all of: %s" %
+                           ", ".join(SEARCH_KEYS))
+        count = min(count, len(self.keys))
+        if not count:
+            return []
+        q = lab_vector(colors)
+        scale = math.sqrt(len(SEARCH_KEYS))
+
+        if self._tree is not None:
+            dist, idx = self._tree.query(q, k=count)
+            pairs = zip(numpy.atleast_1d(dist).tolist(),
+                        numpy.atleast_1d(idx).tolist())
+        elif numpy is not None:
+            d = numpy.sqrt(((self._matrix - q) ** 2).sum(axis=1))
+            idx = numpy.argsort(d, kind='mergesort')[:count]
+            pairs = zip(d[idx].tolist(), idx.tolist())
+        else:
+            d = [math.sqrt(sum([(a - b) ** 2 for a, b in zip(row, q)]))
+                 for row in self._matrix]
+            pairs = heapq.nsmallest(count, zip(d, range(len(d))))
+        return [(dist / scale, self.keys[i]) for dist, i in pairs]
@@ -0,0 +1,85 @@
+"""Snapshots of a terminal's whole profile store, for dump and restore.
+
+A snapshot is a gzip-compressed stream of JSON lines.  The first line is a
+header naming the format and the terminal type; every line after it is one
+profile: its name, its theme keys, and the private data of each IO backend
+that has read it.  Profiles are written and read one at a time, so neither
+side holds the whole store as JSON."""
+
+from __future__ import absolute_import, division, with_statement
+
+import gzip
+import json
+
+from . import core
+
+FORMAT = 'termitheme-snapshot'
+FORMAT_VERSION = 1
+DEFAULT_FILENAME = 'termitheme-snapshot.gz'
+
+
+def profile_record (profile):
+    """Return profile as a dict that JSON can hold."""
+
+    private = {}
+    for slave in profile.ioslave_names():
+        with profile.ioslave(slave) as private_data:
+            if private_data:
+                private[slave] = dict(private_data)
+    return {'name': profile.name, 'keys': dict(profile.items()),
+            'private': private}
+
+def record_profile (record, profile_class=None):
+    """Return a new profile from a dict made by profile_record."""
+
+    p = (profile_class or core.TerminalProfile)(record['name'])
+    for k, v in record['keys'].items():
+        p[k] = v
+    for slave, values in record.get('private', {}).items():
+        with p.ioslave(slave) as private_data:
+            private_data.update(values)
+    return p
+
+def write (fileobj, termname, profiles):
+    """Write a snapshot of profiles (any iterable) to fileobj, which is
+    left open.  Returns the number of profiles written."""
+
+    gz = gzip.GzipFile(filename='', mode='wb', fileobj=fileobj)
+    count = 0
+    try:
+        header = {'format': FORMAT, 'version': FORMAT_VERSION,
+                  'terminal': termname}
+        gz.write(json.dumps(header) + '\n')
+        for profile in profiles:
+            gz.write(json.dumps(profile_record(profile),
+                                separators=(',', ':')) + '\n')
+            count += 1
+    finally:
+        gz.close()
+    return count
+
+def read (fileobj, profile_class=None):
+    """Read a snapshot from fileobj, which must be seekable.
+
+    Returns (header, profiles), where profiles is an iterator that reads
+    them as it goes.  Raises ValueError if fileobj holds no snapshot that
+    this version can read."""
+
+    gz = gzip.GzipFile(mode='rb', fileobj=fileobj)
+    try:
+        header = json.loads(gz.readline())
+    except (IOError, ValueError):
+        raise ValueError("Not a termitheme snapshot")
+    if not isinstance(header, dict) or header.get('format') != FORMAT:
+        raise ValueError("Not a termitheme snapshot")
+    elif header.get('version') > FORMAT_VERSION:
+        raise ValueError("Snapshot version %s is not supported" %
+                         header.get('version'))
+
+    def profiles ():
+        try:
+            for line in gz:
+                yield record_profile(json.loads(line), profile_class)
+        finally:
+            gz.close()
+    return (header, profiles())
@@ -0,0 +1,149 @@
+"""Optional timing of command phases, as nested spans.
+
+Tracing is off unless start() is called, and span() costs next to nothing
+then.  Once started, every span is recorded with its thread and nesting
+depth, and finish() writes them to the trace file: in Chrome trace-event
+format (for chrome://tracing or Perfetto) if the filename ends in .json,
+otherwise as JSON lines, one span per line."""
+
+from __future__ import absolute_import, division, with_statement
+
+import os
+import threading
+import time
+
+from contextlib import contextmanager
+
+# Environment variables naming a trace file and a cProfile stats file
+TRACE_ENV = 'TERMITHEME_TRACE'
+PROFILE_ENV = 'TERMITHEME_PROFILE'
+
+_tracer = None
+
+
+class _NullSpan (object):
+    def __enter__ (self):
+        return self
+
+    def __exit__ (self, *exc_info):
+        return False
+
+_null_span = _NullSpan()
+
+
+class Tracer (object):
+    """Collects spans and writes them out to filename."""
+
+    def __init__ (self, filename, fmt=None, t0=None):
+        if not fmt:
+            fmt = 'chrome' if filename.lower().endswith('.json') else 'jsonl'
+        if fmt not in ('chrome', 'jsonl'):
+            raise ValueError("Unknown trace format '%s'" % fmt)
+        self.filename = filename
+        self.format = fmt
+        self.t0 = time.time() if t0 is None else t0
+        self.events = [] # (name, start, end, depth, thread, args)
+        self._local = threading.local()
+
+    @contextmanager
+    def span (self, name, args=None):
+        local = self._local
+        depth = getattr(local, 'depth', 0)
+        local.depth = depth + 1
+        start = time.time()
+        try:
+            yield
+        finally:
+            local.depth = depth
+            self.add(name, start, time.time(), depth, args)
+
+    def add (self, name, start, end, depth=0, args=None):
+        if args:
+            # keep the trace writable: byte strings may not be UTF-8
+            args = dict((k, v.decode('utf-8', 'replace')
+                         if isinstance(v, str) else v)
+                        for k, v in args.items())
+        thread = threading.current_thread().name
+        # list.append is atomic, so pool threads can record spans too
+        self.events.append((name, start, end, depth, thread, args))
+
+    def write (self):
+        import json
+        events = sorted(self.events, key=lambda e: (e[1], e[3]))
+        with open(self.filename, 'wb') as f:
+            if self.format == 'chrome':
+                json.dump(self._chrome_trace(events), f)
+                f.write('\n')
+            else:
+                for e in events:
+                    f.write(json.dumps(self._jsonl_record(e)) + '\n')
+
+    def _us (self, t):
+        return int(round((t - self.t0) * 1e6))
+
+    def _chrome_trace (self, events):
+        pid = os.getpid()
+        threads = {}
+        rv = []
+        for name, start, end, depth, thread, args in events:
+            tid = threads.setdefault(thread, len(threads) + 1)
+            rv.append({'name': name, 'ph': 'X', 'pid': pid, 'tid': tid,
+                       'ts': self._us(start),
+                       'dur': self._us(end) - self._us(start),
+                       'args': args or {}})
+        for thread, tid in threads.items():
+            rv.append({'name': 'thread_name', 'ph': 'M', 'pid': pid,
+                       'tid': tid, 'args': {'name': thread}})
+        return {'traceEvents': rv, 'displayTimeUnit': 'ms'}
+
+    def _jsonl_record (self, event):
+        name, start, end, depth, thread, args = event
+        rv = {'name': name, 'start_ms': (start - self.t0) * 1000,
+              'duration_ms': (end - start) * 1000, 'depth': depth,
+              'thread': thread}
+        if args:
+            rv['args'] = args
+        return rv
+
+
+def start (filename, fmt=None, t0=None):
+    """Start tracing into filename; t0 is when the process started."""
+
+    global _tracer
+    _tracer = Tracer(filename, fmt, t0)
+    return _tracer
+
+def enabled ():
+    return _tracer is not None
+
+def span (name, **args):
+    """Return a context manager timing its block as the span name."""
+
+    if _tracer is None:
+        return _null_span
+    return _tracer.span(name, args)
+
+def record (name, start, end=None, **args):
+    """Record a span that has already happened, from start until end."""
+
+    if _tracer is not None:
+        _tracer.add(name, start, time.time() if end is None else end, 0,
+                    args)
+
+def finish ():
+    """Write out the spans recorded since start(), and stop tracing."""
+
+    global _tracer
+    tracer, _tracer = _tracer, None
+    if tracer is not None:
+        tracer.write()
+
+def profiled (filename, fn, *args, **kwargs):
+    """Call fn under cProfile, dumping the stats to filename."""
+
+    import cProfile
+    prof = cProfile.Profile()
+    try:
+        return prof.runcall(fn, *args, **kwargs)
+    finally:
+        prof.dump_stats(filename)
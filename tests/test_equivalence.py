@@ -0,0 +1,215 @@
+#!/usr/bin/env python
+"""The fast theme.ini reader and writer against the paths they replaced.
+
+Run from the source tree:
+    python -m unittest discover -s tests
+
+ThemeFile.read and read_ini scan theme.ini themselves, falling back to
+ConfigParser for anything unusual; the profile (or the error) must be the
+one ConfigParser gives.  ThemeFile._format marshals each value once for
+all versions; its output must match the old one-version-at-a-time writer
+byte for byte.  Inputs are random, from fixed seeds, so any failure can
+be reproduced.
+"""
+
+from __future__ import absolute_import, division, with_statement
+
+import ConfigParser
+import os.path
+import random
+import StringIO
+import sys
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), os.pardir))
+from termitheme_lib import core
+
+MIN_VERSIONS = [None] + [ver.replace('_', '.') for ver, spec in core._versions]
+
+
+#{{{ Random profiles and theme.ini files
+
+def random_color (rnd, out_of_range=False):
+    if out_of_range and rnd.random() < 0.1:
+        return [rnd.choice([-257, -1, 65536, 70000]) for c in range(3)]
+    return [rnd.randint(0, 65535) for c in range(3)]
+
+def random_profile (rnd, out_of_range=False):
+    profile_class = rnd.choice([core.TerminalProfile,
+                                core.CompactTerminalProfile])
+    p = profile_class(rnd.choice([u"Th\u00e8me %d" % rnd.randint(0, 99),
+                                  u"plain", u"a = b ; c"]))
+    for k in core.TerminalProfile.PROFILE_KEY_NAMES:
+        if rnd.random() < 0.15: # missing key
+            continue
+        if k == 'cursor_shape':
+            p[k] = rnd.choice([u'block', u'ibeam', u'underline'])
+        elif k == 'font':
+            p[k] = u'Monospace %d' % rnd.randint(6, 20)
+        elif k in ('force_font', 'allow_bold', 'use_fgbold'):
+            p[k] = rnd.choice([True, False])
+        else:
+            p[k] = random_color(rnd, out_of_range)
+    return p
+
+# Lines that make the scanner work for its living: comments, separators,
+# quoting, repeated keys and sections, and what it hands to ConfigParser.
+ODD_LINES = [
+    "; comment", "# comment", "rem a comment", "REM shouting", "remark = 1",
+    "", "   ", " continued", "\tcontinued",
+    "[DEFAULT]", "[Other]", "[Termitheme1]", "[Termitheme1_2]",
+    "[Termitheme9]", "[termitheme1]", "[Termitheme1",
+    "name = Renamed", "name:Colons", "name =", 'name = ""',
+    "fgcolor = #ffff00000000", "fgcolor: #ff0000", "FGCOLOR = #00ff00",
+    "bgcolor = #000000000000 ; trailing comment",
+    "bgcolor = #000000000000;no space", "font = Mono %(x)s",
+    "font = 100%", "allow_bold = maybe", "allow_bold = True",
+    "color3 = #12345", "color3 = not a color", "unknown = key",
+    "no separator here", "= no key", ": no key",
+]
+
+def mutate (rnd, text):
+    lines = text.split('\n')
+    for i in range(rnd.randint(1, 4)):
+        op = rnd.random()
+        pos = rnd.randint(0, len(lines))
+        if op < 0.5:
+            lines.insert(pos, rnd.choice(ODD_LINES))
+        elif op < 0.7 and lines:
+            del lines[min(pos, len(lines) - 1)]
+        elif op < 0.85 and lines:
+            lines.insert(pos, rnd.choice(lines)) # repeat a line
+        elif lines:
+            i = min(pos, len(lines) - 1)
+            lines[i] = lines[i][:rnd.randint(0, len(lines[i]))]
+    return '\n'.join(lines)
+
+def outcome (fn, *args):
+    """Return ('ok', name, items) or ('error', exception type, message)."""
+
+    try:
+        p = fn(*args)
+    except Exception, e:
+        return ('error', type(e).__name__, str(e))
+    return ('ok', p.name, sorted(p.items()))
+
+#}}}
+
+
+#{{{ The replaced paths
+
+def old_read (tf, text):
+    # ThemeFile.read before the scanner: RawConfigParser
+    return tf.read_profile(tf._parser(text))
+
+def old_read_ini (tf, text):
+    # ThemeFile.read_ini before the scanner: SafeConfigParser
+    cp = ConfigParser.SafeConfigParser()
+    cp.readfp(StringIO.StringIO(text))
+    return tf.read_profile(cp)
+
+def new_read (tf, text):
+    profile = tf._read_text(text)
+    if profile is None:
+        profile = tf.read_profile(tf._parser(text))
+    return profile
+
+def new_read_ini (tf, text):
+    return tf.read_ini(StringIO.StringIO(text))
+
+def old_format (tf, profile):
+    # ThemeFile.write before marshalling was shared between versions
+    datasets = []
+    for ver, m in core._versions:
+        lines = ["[Termitheme%s]\n" % ver, "name = %s\n" % profile.name]
+        items = [(k, v) for k, v in sorted(profile.items())
+                 if m.writable_key(k)]
+        for k, comment, v in m.marshal_items(items):
+            if comment:
+                lines.append(comment)
+            lines.append("%s = %s\n" % (k, v))
+        datasets.append(''.join(lines))
+        if tf._min_version and ver <= tf._min_version:
+            break
+    return '\n'.join(datasets)
+
+def old_to24 (color):
+    return '#' + ''.join(["%02x" % (v//256,) for v in color])
+
+def old_to48 (color):
+    return '#' + ''.join(["%04x" % v for v in color])
+
+def old_to24dec (color):
+    return ','.join(["%d" % (v//256,) for v in color])
+
+#}}}
+
+
+class ReaderEquivalence (unittest.TestCase):
+    CASES = 2000
+
+    def _check (self, new, old, seed):
+        rnd = random.Random(seed)
+        tf = core.ThemeFile(None)
+        for i in range(self.CASES):
+            text = tf._format(random_profile(rnd)).encode('utf-8')
+            if i: # the first one unchanged
+                text = mutate(rnd, text)
+            self.assertEqual(outcome(new, tf, text), outcome(old, tf, text),
+                             "case %d differs:\n%s" % (i, text))
+
+    def test_read (self):
+        self._check(new_read, old_read, 15)
+
+    def test_read_ini (self):
+        self._check(new_read_ini, old_read_ini, 1015)
+
+
+class WriterEquivalence (unittest.TestCase):
+    CASES = 1000
+
+    def _check (self, seed):
+        rnd = random.Random(seed)
+        for i in range(self.CASES):
+            profile = random_profile(rnd, out_of_range=True)
+            tf = core.ThemeFile(None)
+            tf.min_version = rnd.choice(MIN_VERSIONS)
+            try:
+                new = tf._format(profile)
+            except Exception, e:
+                self.assertRaises(type(e), old_format, tf, profile)
+            else:
+                self.assertEqual(new, old_format(tf, profile),
+                                 "case %d differs" % i)
+
+    def test_format (self):
+        self._check(16)
+
+    def test_format_numpy (self):
+        if core.load_numpy() is None:
+            return # nothing to compare
+        saved = core.NUMPY_MIN_COLORS
+        core.NUMPY_MIN_COLORS = 1
+        try:
+            self._check(1016)
+        finally:
+            core.NUMPY_MIN_COLORS = saved
+
+    def test_rejected (self):
+        profile = core.TerminalProfile(u"bad")
+        profile['fgcolor'] = [1, 2] # not a color
+        tf = core.ThemeFile(None)
+        self.assertRaises(ValueError, old_format, tf, profile)
+        self.assertRaises(ValueError, tf._format, profile)
+
+    def test_color_formats (self):
+        rnd = random.Random(116)
+        for i in range(5000):
+            c = random_color(rnd, out_of_range=True)
+            self.assertEqual(core.color.to24(c), old_to24(c))
+            self.assertEqual(core.color.to48(c), old_to48(c))
+            self.assertEqual(core.color.to24dec(c), old_to24dec(c))
+
+
+if __name__ == '__main__':
+    unittest.main()